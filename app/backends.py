@@ -0,0 +1,379 @@
+import asyncio
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+
+class BackendTimeoutError(TimeoutError):
+    """Raised when a backend call does not finish within its timeout"""
+
+
+class BackendUnavailableError(RuntimeError):
+    """Raised without calling the backend while its circuit breaker is open"""
+
+
+# AWS error codes worth retrying after a backoff, the request itself was fine
+TRANSIENT_ERROR_CODES = frozenset({
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "ServiceUnavailableException",
+    "InternalServerError",
+})
+
+# HTTP statuses from the VLM server that mean "later", not "never"
+TRANSIENT_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# "Slow down" rather than "unhealthy": the limiter backs off, the breaker stays closed
+THROTTLING_ERROR_CODES = frozenset({
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+})
+THROTTLING_STATUS_CODES = frozenset({429})
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Whether a backend failure is throttling or a brief outage rather than a bad document"""
+    # botocore ClientError carries the AWS error code in .response, no botocore import needed
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES
+    # httpx HTTPStatusError carries the response object
+    return getattr(response, "status_code", None) in TRANSIENT_STATUS_CODES
+
+
+def is_throttling(exc: BaseException) -> bool:
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    return getattr(response, "status_code", None) in THROTTLING_STATUS_CODES
+
+
+def is_overload(exc: BaseException) -> bool:
+    """Failures that say the backend is saturated: throttling, brief outages, timeouts, dropped connections"""
+    return is_transient_error(exc) or isinstance(exc, (BackendTimeoutError, ConnectionError))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: +1 per limit's worth of successful calls, times
+    backoff_ratio on throttling, a timeout or latency over latency_threshold
+    Only calls started after the last decrease can decrease it again, so one
+    burst of throttles shrinks the limit once rather than once per call
+    Waiters may sit on different event loops (bare TestClient runs a loop per request)
+    """
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: Optional[int] = None,
+                 backoff_ratio: float = 0.5, latency_threshold: Optional[float] = None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.backoff_ratio = backoff_ratio
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: Optional[float] = None) -> float:
+        """Wait for a slot, returns the start time to report the outcome against"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return time.monotonic()
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            with self._lock:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+            # Granted just as we gave up, hand the slot on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        return time.monotonic()
+
+    def release(self) -> None:
+        """Free a slot, safe from any thread"""
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def on_success(self, started: float, latency: float) -> None:
+        if self.latency_threshold is not None and latency > self.latency_threshold:
+            self.on_overload(started)
+            return
+        with self._lock:
+            # Only grow a limit that is actually being used
+            if self.in_flight * 2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def on_overload(self, started: float) -> None:
+        with self._lock:
+            if started < self._last_decrease:
+                return
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            self._last_decrease = time.monotonic()
+            self.decreases += 1
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            loop, future = self._waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(self._grant, future)
+
+    def _grant(self, future: asyncio.Future) -> None:
+        if future.done():
+            # The waiter timed out or was cancelled after being picked
+            self.release()
+        else:
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, float]:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queued": self.queued,
+                "limit_decreases": self.decreases}
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive outage failures (5xx, timeouts,
+    dropped connections) and fails calls fast for reset_seconds, then lets a
+    single probe through (half open). The probe succeeding closes it again,
+    failing reopens it. Throttling is left to the limiter, a throttled call
+    still shows the backend is up
+    """
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    # Gauge values for /metrics
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opens = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def available(self) -> bool:
+        """Whether a call now would be let through, without claiming the probe"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_seconds
+            return not (self.state == self.HALF_OPEN and self._probing)
+
+    def release_probe(self) -> None:
+        """The call let through never reached the backend, allow another probe"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict[str, float]:
+        return {"breaker_state": self.STATE_VALUES[self.state], "breaker_opens": self.opens,
+                "consecutive_failures": self.consecutive_failures}
+
+
+class BackendPool:
+    """
+    Bounded thread pool for blocking backend calls (Textract, VLM)
+    Keeps the event loop free while boto3 or the VLM client waits on the network
+    The worker count caps concurrency, within it an AdaptiveLimiter backs off
+    when the backend throttles. Overload failures are retried with jittered
+    backoff until max_attempts or the deadline, and a CircuitBreaker fails
+    calls fast while the backend keeps failing. This is the only retry layer:
+    botocore does not retry and neither do the callers, so a failed run() is final
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout_seconds: Optional[float],
+                 limiter: Optional[AdaptiveLimiter] = None, breaker: Optional[CircuitBreaker] = None,
+                 max_attempts: int = 1, deadline_seconds: Optional[float] = None,
+                 retry_base_seconds: float = 0.25, retry_max_seconds: float = 4.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.limiter = limiter or AdaptiveLimiter(max_concurrency)
+        self.breaker = breaker or CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.deadline_seconds = deadline_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.calls = 0
+        self.overloads = 0
+        self.retries = 0
+        self.rejections = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-pool")
+
+    @classmethod
+    def from_env(cls, name: str, default_concurrency: int = 8, default_timeout: float = 60.0,
+                 default_attempts: int = 3, default_deadline: float = 120.0) -> "BackendPool":
+        """
+        Read <NAME>_MAX_CONCURRENCY and <NAME>_TIMEOUT_SECONDS (0 disables the timeout),
+        the limiter's <NAME>_LIMIT_MIN / _LIMIT_INITIAL / _LIMIT_BACKOFF / _LIMIT_LATENCY_SECONDS,
+        <NAME>_CALL_ATTEMPTS / _DEADLINE_SECONDS for retries and <NAME>_BREAKER_FAILURES /
+        _BREAKER_RESET_SECONDS for the circuit breaker
+        """
+        prefix = name.upper()
+        max_concurrency = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(default_concurrency)))
+        timeout = float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", str(default_timeout)))
+        latency_threshold = float(os.getenv(f"{prefix}_LIMIT_LATENCY_SECONDS", "0"))
+        deadline = float(os.getenv(f"{prefix}_DEADLINE_SECONDS", str(default_deadline)))
+        limiter = AdaptiveLimiter(
+            initial=int(os.getenv(f"{prefix}_LIMIT_INITIAL", str(max_concurrency))),
+            min_limit=int(os.getenv(f"{prefix}_LIMIT_MIN", "1")),
+            max_limit=max_concurrency,
+            backoff_ratio=float(os.getenv(f"{prefix}_LIMIT_BACKOFF", "0.5")),
+            latency_threshold=latency_threshold or None,
+        )
+        breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv(f"{prefix}_BREAKER_FAILURES", "5")),
+            reset_seconds=float(os.getenv(f"{prefix}_BREAKER_RESET_SECONDS", "30")),
+        )
+        return cls(
+            name=name,
+            max_concurrency=max_concurrency,
+            timeout_seconds=timeout or None,
+            limiter=limiter,
+            breaker=breaker,
+            max_attempts=int(os.getenv(f"{prefix}_CALL_ATTEMPTS", str(default_attempts))),
+            deadline_seconds=deadline or None,
+        )
+
+    def available(self) -> bool:
+        """False while the circuit breaker is failing calls fast"""
+        return self.breaker.available()
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking call on the pool, retrying overload failures within the deadline"""
+        deadline = time.monotonic() + self.deadline_seconds if self.deadline_seconds else None
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.breaker.allow():
+                self.rejections += 1
+                raise BackendUnavailableError(f"{self.name} is unavailable, circuit breaker open")
+            try:
+                return await self._call(fn, args, kwargs, deadline)
+            except Exception as e:
+                if not is_overload(e):
+                    raise
+                # Full jitter so throttled callers do not all come back at once
+                delay = random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (attempt - 1)))
+                if attempt >= self.max_attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def _call(self, fn: Callable[..., Any], args: Tuple, kwargs: Dict[str, Any],
+                    deadline: Optional[float]) -> Any:
+        timeout = self.timeout_seconds
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BackendTimeoutError(f"{self.name} call deadline of {self.deadline_seconds}s passed")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        # Time spent queued for a slot comes out of the timeout too
+        queued_at = time.monotonic()
+        try:
+            # Post-acquire, so latency and AIMD only measure the backend
+            started = await self.limiter.acquire(timeout)
+        except asyncio.TimeoutError:
+            self.breaker.release_probe()
+            # Our own queue, not a sign the backend is struggling
+            raise BackendTimeoutError(f"{self.name} call waited {timeout:.3g}s for a free slot") from None
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        if timeout is not None:
+            timeout = max(0.0, timeout - (time.monotonic() - queued_at))
+
+        self.calls += 1
+        # Carry the caller's context into the worker thread, like asyncio.to_thread does
+        context = contextvars.copy_context()
+        try:
+            future = self.executor.submit(functools.partial(context.run, fn, *args, **kwargs))
+        except BaseException:
+            self.limiter.release()
+            self.breaker.release_probe()
+            raise
+        # The slot is held until the thread is done, even if we stop waiting on it first
+        future.add_done_callback(lambda _: self.limiter.release())
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # The worker thread keeps running, we just stop waiting on it
+            error: Exception = BackendTimeoutError(f"{self.name} call timed out after {timeout:.3g}s")
+            self._record_failure(error, started)
+            raise error from None
+        except Exception as e:
+            self._record_failure(e, started)
+            raise
+        except BaseException:
+            # Cancelled by the caller, says nothing about the backend
+            self.breaker.release_probe()
+            raise
+        self.limiter.on_success(started, time.monotonic() - started)
+        self.breaker.record_success()
+        return result
+
+    def _record_failure(self, error: Exception, started: float) -> None:
+        if is_overload(error):
+            self.overloads += 1
+            self.limiter.on_overload(started)
+        if is_overload(error) and not is_throttling(error):
+            self.breaker.record_failure()
+        else:
+            # The backend answered: throttled, or the request itself was bad
+            self.breaker.record_success()
+
+    def stats(self) -> Dict[str, float]:
+        return {"calls": self.calls, "overloads": self.overloads, "retries": self.retries,
+                "rejections": self.rejections, **self.limiter.stats(), **self.breaker.stats()}
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,177 @@
+"""
+Offline batch driver for back-catalogue runs
+
+Walks a directory of PDFs and/or stored Textract JSON responses, runs the
+parse_blocks pipeline (the one the API and replay use) across a process
+pool and appends one NDJSON line per document to the output file.
+The output file doubles as the checkpoint: re-running the same command
+skips every path already written, so interrupted runs resume where they stopped.
+
+Usage: python -m app.batch INPUT_DIR OUTPUT.ndjson [--workers N]
+Cross-check the output column-wise with python -m app.columnar OUTPUT.ndjson
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from app.backends import BackendPool
+from app.documents import Document, map_path
+from app.results import ParseResult
+from app.pages import merge_page_blocks, plan_pages
+from app.pipeline import parse_blocks, text_layer_is_confident
+from app.text_layer import text_layer_blocks
+from app.textract_helper import analyze_page, create_textract_client, create_textract_pool
+from app.textract_stream import stream_blocks
+from app.replay import REPLAY_EXTENSIONS
+from app.vlm_helper import extract_fields_with_vlm
+
+# Inputs we know how to parse, PDFs plus stored (or recorded) Textract responses
+BATCH_EXTENSIONS = (".pdf",) + REPLAY_EXTENSIONS
+
+# One Textract client and pool per worker process, created on first OCR call
+_textract_client = None
+_textract_pool: Optional[BackendPool] = None
+
+
+def iter_input_paths(root: Path) -> Iterator[Path]:
+    """Lazily yield every PDF or Textract JSON under root, in a stable order"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(BATCH_EXTENSIONS):
+                yield Path(dirpath) / filename
+
+
+def parse_stored_response(path: Path) -> ParseResult:
+    """
+    Parse a stored analyze_document response, same pipeline as replay and live OCR
+    Blocks are streamed and compacted, so the full response is never loaded
+    """
+    opener = gzip.open if path.name.lower().endswith(".gz") else open
+    with opener(path, "rb") as f:
+        blocks = stream_blocks(f)
+    return parse_blocks(blocks)
+
+
+def document_blocks(document_bytes: Document) -> List[dict]:
+    """Synchronous text-layer-or-OCR step, the batch counterpart of run_textract"""
+    global _textract_client, _textract_pool
+    planned_pages = plan_pages(document_bytes)
+    page_numbers = [page_number for page_number, _ in planned_pages] if planned_pages else [1]
+
+    text_blocks = text_layer_blocks(document_bytes, page_numbers)
+    if text_blocks is not None and text_layer_is_confident(text_blocks):
+        return text_blocks
+
+    if _textract_client is None:
+        _textract_client = create_textract_client()
+        _textract_pool = create_textract_pool()
+
+    # Through a pool like the API, it retries throttling since botocore does not
+    async def ocr_pages() -> List[dict]:
+        return await asyncio.gather(*[_textract_pool.run(analyze_page, document_bytes, page_number, _textract_client)
+                                      for page_number in page_numbers])
+
+    responses = asyncio.run(ocr_pages())
+    if not planned_pages:
+        return responses[0].get("Blocks", [])
+    return merge_page_blocks(page_numbers, responses)
+
+
+def parse_path(path: Path) -> ParseResult:
+    """Full pipeline for one input file"""
+    if path.name.lower().endswith(REPLAY_EXTENSIONS):
+        return parse_stored_response(path)
+    document_bytes = map_path(path)
+    return parse_blocks(document_blocks(document_bytes), document_bytes, extract_fields_with_vlm)
+
+
+def process_path(path: str) -> Dict[str, Any]:
+    """Worker entry point, never raises so one bad file cannot stop a run"""
+    try:
+        response = parse_path(Path(path))
+    except Exception as e:
+        response = ParseResult(success=False, error=f"{type(e).__name__}: {e}")
+    return {"path": path, **response.model_dump()}
+
+
+def completed_paths(output_path: Path) -> Set[str]:
+    """
+    Paths already written to the output file
+    A partially written last line (from a crash) is truncated away
+    """
+    done: Set[str] = set()
+    if not output_path.exists():
+        return done
+    good_bytes = 0
+    with open(output_path, "rb") as f:
+        for raw_line in f:
+            if not raw_line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(raw_line)["path"])
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(raw_line)
+    if good_bytes != output_path.stat().st_size:
+        with open(output_path, "r+b") as f:
+            f.truncate(good_bytes)
+    return done
+
+
+def run_batch(input_dir: Path, output_path: Path, workers: int,
+              max_in_flight: Optional[int] = None) -> Dict[str, int]:
+    """
+    Process every input under input_dir, appending results to output_path
+    At most max_in_flight documents are pending at once, so memory stays
+    flat no matter how large the directory is
+    """
+    done = completed_paths(output_path)
+    max_in_flight = max_in_flight or workers * 2
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+
+    with open(output_path, "a", encoding="utf-8") as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: Set[Future] = set()
+
+        def drain(block_until: int) -> None:
+            nonlocal pending
+            while len(pending) > block_until:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    out.write(json.dumps(record) + "\n")
+                    counts["processed"] += 1
+                    if not record["success"]:
+                        counts["failed"] += 1
+                # Flush per completion so a crash loses at most in-flight work
+                out.flush()
+
+        for path in iter_input_paths(input_dir):
+            if str(path) in done:
+                counts["skipped"] += 1
+                continue
+            pending.add(pool.submit(process_path, str(path)))
+            drain(max_in_flight - 1)
+        drain(0)
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Bulk-parse archived 1040 returns")
+    parser.add_argument("input_dir", type=Path, help="directory of PDFs and/or stored Textract JSON")
+    parser.add_argument("output", type=Path, help="NDJSON output file, also used to resume")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="pending documents (default 2 x workers)")
+    args = parser.parse_args(argv)
+
+    counts = run_batch(args.input_dir, args.output, args.workers, args.max_in_flight)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.documents import Document
+
+# Namespaces stored in the cache
+# Raw Textract blocks do not depend on the parser, derived fields do
+BLOCKS_NAMESPACE = "blocks"
+FIELDS_NAMESPACE = "fields"
+
+
+def document_hash(document_bytes: Document) -> str:
+    """SHA-256 of the uploaded document, used as the content address"""
+    return hashlib.sha256(document_bytes).hexdigest()
+
+
+def _encode(value: Any) -> bytes:
+    """Serialize a cache value to compressed JSON bytes"""
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+
+def _decode(payload: bytes) -> Any:
+    """Inverse of _encode"""
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+class MemoryTier:
+    """In-process LRU tier with entry count, byte size and TTL eviction"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key -> (stored_at, payload), oldest first
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, payload = entry
+            if self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds:
+                self._remove(key)
+                self.expirations += 1
+                return None
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key: str, payload: bytes) -> None:
+        # Never keep a single value larger than the whole tier
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), payload)
+            self.total_bytes += len(payload)
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, payload = self._entries.pop(key)
+        self.total_bytes -= len(payload)
+
+
+class SQLiteTier:
+    """On-disk tier that survives restarts"""
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.expirations = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " key TEXT PRIMARY KEY,"
+            " stored_at REAL NOT NULL,"
+            " payload BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stored_at, payload FROM cache_entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            stored_at, payload = row
+            # Wall clock here since entries outlive the process
+            if self.ttl_seconds and time.time() - stored_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+                self._conn.commit()
+                self.expirations += 1
+                return None
+            return payload
+
+    def set(self, key: str, payload: bytes) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, stored_at, payload) VALUES (?, ?, ?)",
+                (key, time.time(), payload),
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResultCache:
+    """
+    Content-addressed cache for /parse-1040 results
+    Raw Textract blocks are keyed by document hash only
+    Derived fields are keyed by document hash plus parser version,
+    so bumping the parser version re-derives fields from cached blocks
+    without paying for another Textract call
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024,
+                 ttl_seconds: float = 86400.0, db_path: Optional[str] = None):
+        self.memory = MemoryTier(max_entries, max_bytes, ttl_seconds)
+        self.disk = SQLiteTier(db_path, ttl_seconds) if db_path else None
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+        # Time spent in Textract that cache hits avoided paying again
+        self.textract_seconds_saved = 0.0
+
+    @classmethod
+    def from_env(cls) -> Optional["ResultCache"]:
+        """Build the cache from environment variables, None when disabled"""
+        if os.getenv("RESULT_CACHE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+            return None
+        return cls(
+            max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+            ttl_seconds=float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400")),
+            db_path=os.getenv("RESULT_CACHE_DB_PATH") or None,
+        )
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def _get(self, namespace: str, key: str) -> Optional[Any]:
+        """Look up memory first, then disk, promoting disk hits to memory"""
+        full_key = f"{namespace}:{key}"
+        payload = self.memory.get(full_key)
+        if payload is not None:
+            self._count(f"{namespace}_memory_hits")
+            return _decode(payload)
+        if self.disk is not None:
+            payload = self.disk.get(full_key)
+            if payload is not None:
+                self._count(f"{namespace}_disk_hits")
+                self.memory.set(full_key, payload)
+                return _decode(payload)
+        self._count(f"{namespace}_misses")
+        return None
+
+    def _set(self, namespace: str, key: str, value: Any) -> None:
+        full_key = f"{namespace}:{key}"
+        payload = _encode(value)
+        self.memory.set(full_key, payload)
+        if self.disk is not None:
+            self.disk.set(full_key, payload)
+
+    def _record_saving(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self.textract_seconds_saved += entry.get("textract_seconds", 0.0)
+
+    def get_result(self, doc_hash: str, parser_version: str) -> Optional[Dict[str, Any]]:
+        """Return a previously derived result for this document and parser version"""
+        entry = self._get(FIELDS_NAMESPACE, f"{parser_version}:{doc_hash}")
+        if entry is None:
+            return None
+        self._record_saving(entry)
+        return entry["result"]
+
+    def set_result(self, doc_hash: str, parser_version: str, result: Dict[str, Any],
+                   textract_seconds: float = 0.0) -> None:
+        """Store a derived result (the ParseResponse fields and forms)"""
+        self._set(FIELDS_NAMESPACE, f"{parser_version}:{doc_hash}",
+                  {"result": result, "textract_seconds": textract_seconds})
+
+    def get_blocks(self, doc_hash: str) -> Optional[List[dict]]:
+        """Return raw Textract blocks for this document, if we have paid for them before"""
+        entry = self._get(BLOCKS_NAMESPACE, doc_hash)
+        if entry is None:
+            return None
+        self._record_saving(entry)
+        return entry["blocks"]
+
+    def set_blocks(self, doc_hash: str, blocks: List[dict], textract_seconds: float) -> None:
+        self._set(BLOCKS_NAMESPACE, doc_hash, {"blocks": blocks, "textract_seconds": textract_seconds})
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit, miss and eviction counters for monitoring"""
+        with self._lock:
+            counters = dict(self._counters)
+            seconds_saved = self.textract_seconds_saved
+        stats: Dict[str, Any] = {}
+        for namespace in (FIELDS_NAMESPACE, BLOCKS_NAMESPACE):
+            for name in ("memory_hits", "disk_hits", "misses"):
+                stats[f"{namespace}_{name}"] = counters.get(f"{namespace}_{name}", 0)
+        # Every hit, on either namespace, is a Textract call we did not make
+        stats["textract_calls_saved"] = (
+            stats["fields_memory_hits"] + stats["fields_disk_hits"]
+            + stats["blocks_memory_hits"] + stats["blocks_disk_hits"]
+        )
+        stats["textract_seconds_saved"] = round(seconds_saved, 6)
+        stats["memory_entries"] = len(self.memory)
+        stats["memory_bytes"] = self.memory.total_bytes
+        stats["memory_evictions"] = self.memory.evictions
+        stats["memory_expirations"] = self.memory.expirations
+        stats["disk_expirations"] = self.disk.expirations if self.disk else 0
+        return stats
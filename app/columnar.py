@@ -0,0 +1,256 @@
+"""
+Columnar normalisation and cross-checks for back-catalogue results
+
+The single-document path parses one money string at a time (parse_money) and
+validates one Form1040DynamicFields at a time. For hundreds of thousands of
+returns this module keeps one float64 NumPy column per form line instead
+(NaN = line not found), normalises money strings a column at a time and
+evaluates every CrossCheck in app.rules as a vectorised expression, building
+failure reasons only for the rows that fail.
+
+Usage: python -m app.columnar RESULTS.ndjson [--report FAILURES.ndjson]
+(RESULTS.ndjson is the output of python -m app.batch)
+"""
+import argparse
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.pipeline import parse_money
+from app.routing import VLM_FIELDS
+from app.rules import COMPILED_1040_RULES, FORM_1040_CROSS_CHECKS, CrossCheck
+
+# One column per line the pipeline extracts
+LINE_COLUMNS: Tuple[str, ...] = VLM_FIELDS
+
+
+def normalize_money(values: Sequence[Optional[str]]) -> np.ndarray:
+    """
+    Money strings to float64 in bulk, NaN where there is no number
+    Same result as parse_money per value, plus accounting negatives: "(1,234.)" -> -1234.0
+    """
+    text = np.array([value or "" for value in values], dtype=str)
+    result = np.full(text.shape, np.nan)
+    if text.size == 0:
+        return result
+    text = np.strings.strip(text)
+    negative = np.strings.startswith(text, "(") & np.strings.endswith(text, ")")
+    for char in ("(", ")", ",", "$", " "):
+        # A scan is much cheaper than a replace, and most of these never occur
+        if (np.strings.find(text, char) >= 0).any():
+            text = np.strings.replace(text, char, "")
+
+    # Digits, dots and minus signs only, the common case, converted in one go
+    plain = (np.strings.strip(text, "0123456789.-") == "") & (text != "")
+    plain_text = text[plain].tolist()
+    # numpy's str -> float cast is slower than its text parser. The parser rejects
+    # "-" and may split "1.2.3" into extra numbers, either way go value by value
+    try:
+        converted = np.fromstring(" ".join(plain_text), sep=" ") if plain_text else np.empty(0)
+    except ValueError:
+        converted = None
+    if converted is None or len(converted) != len(plain_text):
+        converted = [_parse_or_nan(value) for value in plain_text]
+    result[plain] = converted
+    # Anything else ("USD 1 234", stray letters) gets parse_money's strip-everything treatment
+    other = ~plain & (text != "")
+    if other.any():
+        result[other] = [_parse_or_nan(value) for value in text[other].tolist()]
+
+    return np.where(negative, -np.abs(result), result)
+
+
+def _parse_or_nan(text: str) -> float:
+    value = parse_money(text)
+    return np.nan if value is None else value
+
+
+def to_column(values: Sequence[Any]) -> np.ndarray:
+    """A line's values as float64, numbers pass through and strings are normalised"""
+    if all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return normalize_money([value if isinstance(value, str) else
+                            (None if value is None else repr(float(value))) for value in values])
+
+
+@dataclass
+class ResultTable:
+    """One row per document, one float64 column per form line"""
+    ids: List[str]
+    success: np.ndarray
+    errors: List[Optional[str]]
+    columns: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], id_key: str = "path") -> "ResultTable":
+        """From batch output records ({"path", "success", "error", "fields": {...}})"""
+        ids: List[str] = []
+        success: List[bool] = []
+        errors: List[Optional[str]] = []
+        raw: Dict[str, List[Any]] = {line: [] for line in LINE_COLUMNS}
+        for record in records:
+            ids.append(record.get(id_key))
+            success.append(bool(record.get("success")))
+            errors.append(record.get("error"))
+            fields = record.get("fields") or {}
+            for line in LINE_COLUMNS:
+                raw[line].append(fields.get(line))
+        return cls(ids, np.array(success, dtype=bool), errors, {line: to_column(raw[line]) for line in LINE_COLUMNS})
+
+    @classmethod
+    def from_key_values(cls, rows: Iterable[Tuple[str, Dict[str, str]]]) -> "ResultTable":
+        """
+        From raw (id, textract_to_dict output) pairs, matching keys like match_1040_fields does
+        Key matching stays per key, every value string is normalised in one pass per table
+        """
+        field_index = {line: i for i, line in enumerate(LINE_COLUMNS)}
+        ids: List[str] = []
+        # One entry per candidate value: row, column, raw text, default if blank, blank-only
+        cand_rows: List[int] = []
+        cand_cols: List[int] = []
+        cand_text: List[str] = []
+        cand_default: List[float] = []
+        cand_blank_only: List[bool] = []
+
+        def add(row: int, rule, value_text: str, blank_only: bool) -> None:
+            cand_rows.append(row)
+            cand_cols.append(field_index[rule.field])
+            cand_text.append(value_text)
+            cand_default.append(np.nan if rule.default_if_blank is None else rule.default_if_blank)
+            cand_blank_only.append(blank_only)
+
+        for row, (row_id, textract_dict) in enumerate(rows):
+            ids.append(row_id)
+            for key_text, value_text in textract_dict.items():
+                rules = [rule for rule in COMPILED_1040_RULES.match(key_text) if rule.field in field_index]
+                if not rules:
+                    continue
+                # A key's value either parses, then its first rule takes it, or it does not,
+                # then the first rule with a blank default does
+                add(row, rules[0], value_text, False)
+                if rules[0].default_if_blank is None:
+                    fallback = next((rule for rule in rules if rule.default_if_blank is not None), None)
+                    if fallback is not None:
+                        add(row, fallback, value_text, True)
+
+        count = len(ids)
+        columns = {line: np.full(count, np.nan) for line in LINE_COLUMNS}
+        if cand_rows:
+            parsed = normalize_money(cand_text)
+            blank = np.isnan(parsed)
+            values = np.where(blank, np.array(cand_default), parsed)
+            keep = ~np.isnan(values) & (~np.array(cand_blank_only) | blank)
+            rows_kept = np.array(cand_rows)[keep]
+            cols_kept = np.array(cand_cols)[keep]
+            values = values[keep]
+            # Later keys overwrite earlier ones in match_1040_fields, so the last candidate wins
+            flat = rows_kept * len(LINE_COLUMNS) + cols_kept
+            _, last_from_end = np.unique(flat[::-1], return_index=True)
+            last = len(flat) - 1 - last_from_end
+            for col, line in enumerate(LINE_COLUMNS):
+                mask = cols_kept[last] == col
+                columns[line][rows_kept[last][mask]] = values[last][mask]
+
+        for field_name, default_value in COMPILED_1040_RULES.defaults:
+            column = columns[field_name]
+            column[np.isnan(column)] = default_value
+        return cls(ids, np.ones(count, dtype=bool), [None] * count, columns)
+
+
+@dataclass
+class CheckResults:
+    """Per-check boolean columns, plus the signed difference target - expected"""
+    checks: Tuple[CrossCheck, ...]
+    parsed: np.ndarray
+    errors: List[Optional[str]]
+    passed: Dict[str, np.ndarray]
+    missing: Dict[str, Dict[str, np.ndarray]]
+    difference: Dict[str, np.ndarray]
+
+    @property
+    def valid(self) -> np.ndarray:
+        """Parsed and every check passing"""
+        valid = self.parsed.copy()
+        for passed in self.passed.values():
+            valid &= passed
+        return valid
+
+    def failure_reasons(self) -> Dict[int, List[str]]:
+        """{row index: reasons} for the failing rows only, valid rows cost nothing"""
+        reasons: Dict[int, List[str]] = {}
+        for row in np.flatnonzero(~self.parsed).tolist():
+            reasons.setdefault(row, []).append(f"not parsed: {self.errors[row]}")
+        for check in self.checks:
+            failed = ~self.passed[check.name] & self.parsed
+            for line, missing in self.missing[check.name].items():
+                for row in np.flatnonzero(failed & missing).tolist():
+                    reasons.setdefault(row, []).append(f"{check.name}: missing {line}")
+            description = check.describe()
+            difference = self.difference[check.name]
+            off = np.flatnonzero(failed & ~np.isnan(difference))
+            for row, diff in zip(off.tolist(), difference[off].tolist()):
+                reasons.setdefault(row, []).append(f"{check.name}: {description} is off by {diff:.2f}")
+        return dict(sorted(reasons.items()))
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "rows": int(len(self.parsed)),
+            "parsed": int(self.parsed.sum()),
+            "valid": int(self.valid.sum()),
+            **{f"failed_{name}": int((~passed & self.parsed).sum()) for name, passed in self.passed.items()},
+        }
+
+
+def run_cross_checks(table: ResultTable, checks: Tuple[CrossCheck, ...] = FORM_1040_CROSS_CHECKS) -> CheckResults:
+    """Evaluate every check over every row at once"""
+    passed: Dict[str, np.ndarray] = {}
+    missing: Dict[str, Dict[str, np.ndarray]] = {}
+    difference: Dict[str, np.ndarray] = {}
+    for check in checks:
+        # NaN in a required line leaves NaN in the difference, which never passes
+        check_missing = {line: np.isnan(table.columns[line]) for line in check.lines
+                         if line not in check.blank_as_zero}
+        expected = np.zeros(len(table))
+        for line, sign in check.terms:
+            column = table.columns[line]
+            if line in check.blank_as_zero:
+                column = np.nan_to_num(column, nan=0.0)
+            expected += sign * column
+        diff = table.columns[check.target] - expected
+        with np.errstate(invalid="ignore"):
+            passed[check.name] = np.abs(diff) < check.tolerance
+        missing[check.name] = check_missing
+        difference[check.name] = diff
+    return CheckResults(checks, table.success, table.errors, passed, missing, difference)
+
+
+def read_ndjson(path: Path) -> Iterable[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Cross-check batch results column-wise")
+    parser.add_argument("results", type=Path, help="NDJSON output of python -m app.batch")
+    parser.add_argument("--report", type=Path, default=None, help="write one NDJSON line per failing row")
+    args = parser.parse_args(argv)
+
+    table = ResultTable.from_records(read_ndjson(args.results))
+    results = run_cross_checks(table)
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as out:
+            for row, reasons in results.failure_reasons().items():
+                out.write(json.dumps({"path": table.ids[row], "reasons": reasons}) + "\n")
+    print(json.dumps(results.summary()))
+
+
+if __name__ == "__main__":
+    main()
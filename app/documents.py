@@ -0,0 +1,86 @@
+"""
+Documents as shared buffers rather than copies
+
+A document is either bytes or a memoryview, typically over a memory-mapped
+upload or batch file. Hashing, page planning, rendering and OCR submission all
+read the same pages; these helpers cover the few places that need more than
+the buffer protocol.
+"""
+import io
+import mmap
+import os
+from pathlib import Path
+from typing import Union
+
+# A whole document, either read into memory or mapped from a file
+Document = Union[bytes, memoryview]
+
+
+def is_pdf(document: Document) -> bool:
+    return bytes(document[:4]) == b"%PDF"
+
+
+def map_file(file) -> memoryview:
+    """Read-only view of an open file's contents, mapped rather than read"""
+    size = os.fstat(file.fileno()).st_size
+    if size == 0:
+        return memoryview(b"")
+    # The map keeps its own handle, the view stays valid after the file is closed
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def map_path(path: Path) -> memoryview:
+    with open(path, "rb") as f:
+        return map_file(f)
+
+
+def document_stream(document: Document) -> io.RawIOBase:
+    """File-like reader over a document for libraries that want a stream (pypdf)"""
+    if isinstance(document, bytes):
+        # BytesIO shares a bytes object until it is written to
+        return io.BytesIO(document)
+    return BufferReader(document)
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only stream over a memoryview, io.BytesIO would copy it first"""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view.cast("B") if view.format != "B" else view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._position:self._position + len(buffer)]
+        size = len(chunk)
+        buffer[:size] = chunk
+        self._position += size
+        return size
+
+    def readall(self) -> bytes:
+        data = bytes(self._view[self._position:])
+        self._position = len(self._view)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        return self._position
@@ -0,0 +1,145 @@
+"""
+Registry of the forms the pipeline knows how to read
+
+Each form is declared as data: its field rules (with blank defaults) and the
+arithmetic cross-checks between its lines, plus a handful of fingerprint
+phrases that show up in its keys and nowhere else. Rule tables are compiled the
+first time a page of that form comes through, so a worker that only ever sees
+1040s never builds the schedule tables. Pages whose header did not say which
+form they are get dispatched on their keys instead, by counting each form's
+fingerprint phrases in the joined keys (plain substring checks, a few times
+faster here than one big regex alternation).
+
+Adding a form is a FieldRule/CrossCheck table in app.rules and a register call
+here, see benchmarks/bench_forms.py for its extraction cost.
+"""
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from app.pages import FORM_1040
+from app.rules import (
+    COMPILED_1040_RULES, FORM_1040_CROSS_CHECKS, FORM_1040_RULES, FORM_W2_CROSS_CHECKS, FORM_W2_RULES,
+    SCHEDULE_1_CROSS_CHECKS, SCHEDULE_1_RULES, SCHEDULE_A_CROSS_CHECKS, SCHEDULE_A_RULES,
+    SCHEDULE_B_CROSS_CHECKS, SCHEDULE_B_RULES, CompiledRules, CrossCheck, FieldRule,
+)
+
+
+@dataclass(frozen=True)
+class FormSpec:
+    """
+    Everything the pipeline knows about one form type
+    generic_lines keeps a "line_<n>" value for numbered keys no rule claims,
+    off for forms whose numbers are not line numbers (W-2 boxes)
+    """
+    form_type: str
+    rules: Tuple[FieldRule, ...]
+    cross_checks: Tuple[CrossCheck, ...] = ()
+    fingerprint: Tuple[str, ...] = ()
+    generic_lines: bool = True
+
+
+class FormRegistry:
+    """Form type -> FormSpec, rule tables compiled and cached on first use"""
+
+    # Distinct fingerprint phrases a page needs before its keys alone decide the form
+    MIN_FINGERPRINT_HITS = 2
+
+    def __init__(self):
+        self.specs: Dict[str, FormSpec] = {}
+        self._compiled: Dict[str, CompiledRules] = {}
+        # ((phrase, form types), ...), rebuilt after register
+        self._fingerprint_index: Optional[Tuple[Tuple[str, Tuple[str, ...]], ...]] = None
+        self._lock = threading.Lock()
+
+    def register(self, spec: FormSpec, compiled: Optional[CompiledRules] = None) -> None:
+        """Add or replace a form, compiled skips the lazy compile for a table that already exists"""
+        with self._lock:
+            self.specs[spec.form_type] = spec
+            self._compiled.pop(spec.form_type, None)
+            if compiled is not None:
+                self._compiled[spec.form_type] = compiled
+            self._fingerprint_index = None
+
+    def __contains__(self, form_type: str) -> bool:
+        return form_type in self.specs
+
+    def get(self, form_type: str) -> Optional[FormSpec]:
+        return self.specs.get(form_type)
+
+    def compiled(self, form_type: str) -> CompiledRules:
+        """The form's compiled rule table, built on the first call"""
+        compiled = self._compiled.get(form_type)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.get(form_type)
+                if compiled is None:
+                    compiled = self._compiled[form_type] = CompiledRules(self.specs[form_type].rules)
+        return compiled
+
+    def compiled_forms(self) -> Tuple[str, ...]:
+        """Form types whose tables have been built so far"""
+        return tuple(self._compiled)
+
+    def _fingerprints(self) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+        index = self._fingerprint_index
+        if index is None:
+            with self._lock:
+                owners: Dict[str, List[str]] = {}
+                for spec in self.specs.values():
+                    for phrase in spec.fingerprint:
+                        owners.setdefault(phrase, []).append(spec.form_type)
+                index = self._fingerprint_index = tuple((phrase, tuple(forms)) for phrase, forms in owners.items())
+        return index
+
+    def fingerprint(self, textract_dict: Dict[str, str]) -> Optional[str]:
+        """
+        Form type whose fingerprint phrases occur most often among these keys
+        None when no form reaches MIN_FINGERPRINT_HITS distinct phrases, or two forms tie
+        """
+        if not textract_dict:
+            return None
+        keys = "\n".join(textract_dict)
+        hits: Dict[str, int] = {}
+        for phrase, form_types in self._fingerprints():
+            if phrase in keys:
+                for form_type in form_types:
+                    hits[form_type] = hits.get(form_type, 0) + 1
+        ranked = sorted(((count, form_type) for form_type, count in hits.items()), reverse=True)
+        if not ranked or ranked[0][0] < self.MIN_FINGERPRINT_HITS:
+            return None
+        if len(ranked) > 1 and ranked[1][0] == ranked[0][0]:
+            return None
+        return ranked[0][1]
+
+
+FORMS = FormRegistry()
+FORMS.register(FormSpec(
+    FORM_1040, FORM_1040_RULES, FORM_1040_CROSS_CHECKS,
+    fingerprint=("adjusted gross income", "standard deduction", "this is your total income",
+                 "this is your taxable income", "qualified business income", "this is your total tax",
+                 "these are your total payments", "filing status"),
+), compiled=COMPILED_1040_RULES)
+FORMS.register(FormSpec(
+    "schedule_1", SCHEDULE_1_RULES, SCHEDULE_1_CROSS_CHECKS,
+    fingerprint=("taxable refunds", "alimony received", "unemployment compensation", "educator expenses",
+                 "student loan interest", "self-employed health insurance", "this is your additional income",
+                 "total other income", "these are your adjustments to income"),
+))
+FORMS.register(FormSpec(
+    "schedule_a", SCHEDULE_A_RULES, SCHEDULE_A_CROSS_CHECKS,
+    fingerprint=("medical and dental", "state and local", "home mortgage interest", "investment interest",
+                 "gifts by cash or check", "carryover from prior year", "casualty and theft"),
+))
+FORMS.register(FormSpec(
+    "schedule_b", SCHEDULE_B_RULES, SCHEDULE_B_CROSS_CHECKS,
+    fingerprint=("add the amounts on line 1", "add the amounts on line 5", "excludable interest",
+                 "series ee", "form 8815", "name of payer", "foreign financial account", "foreign trust"),
+))
+FORMS.register(FormSpec(
+    "form_w-2", FORM_W2_RULES, FORM_W2_CROSS_CHECKS,
+    fingerprint=("wages, tips, other compensation", "federal income tax withheld", "social security wages",
+                 "social security tax withheld", "medicare wages", "medicare tax withheld",
+                 "employer identification number", "employee's social security number", "control number"),
+    generic_lines=False,
+))
@@ -0,0 +1,321 @@
+"""
+In-process job engine behind both the job API and the synchronous endpoint
+
+Jobs sit in a priority heap and are drained by up to JOB_WORKERS worker
+tasks, which only exist while there is work, so the engine holds nothing
+on the event loop when idle. Jobs are not retried here: the BackendPool
+around each Textract or VLM call is the one retry layer. Identical documents
+submitted while an earlier job for them is still queued or running share that
+job (single-flight): synchronous callers await the same result, errors included.
+Finished jobs are POSTed to their callback URL only when it is on a host or
+under a URL prefix listed in JOB_CALLBACK_ALLOWED_HOSTS; with none listed,
+callbacks are refused.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+from urllib.parse import urlsplit
+
+from app.cache import document_hash
+from app.documents import Document
+from app.lazy import lazy_import
+from app.metrics import stage
+from app.results import ParseResult
+
+# Only needed once a job with a webhook finishes
+httpx = lazy_import("httpx")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+# Every synchronous caller went away before the job started
+CANCELLED = "cancelled"
+
+# parse(document_bytes) -> response
+ParseFunction = Callable[[Document], Awaitable[ParseResult]]
+
+
+@dataclass
+class Job:
+    """One document's trip through the engine"""
+    id: str
+    doc_hash: str
+    priority: int
+    document_bytes: Optional[Document]
+    callback_urls: List[str] = field(default_factory=list)
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[ParseResult] = None
+    error: Optional[str] = None
+    # callback url -> HTTP status or error of the delivery
+    callback_status: Dict[str, str] = field(default_factory=dict)
+    waiters: List[asyncio.Future] = field(default_factory=list)
+    # Submitted through the job API, someone may poll for it so it must run to completion
+    detached: bool = False
+    # Submitter's context, so stage timings land on the request that queued the job
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED, CANCELLED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Public view for the poll endpoint and webhooks"""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result.model_dump() if self.result is not None else None,
+            "error": self.error,
+            "callback_status": self.callback_status,
+        }
+
+
+def path_under(path: str, prefix: str) -> bool:
+    """Whether path is the prefix path or below it, so /tenant covers /tenant/done but not /tenant-evil"""
+    prefix = prefix.rstrip("/")
+    return not prefix or path == prefix or path.startswith(prefix + "/")
+
+
+class JobEngine:
+    """Priority queue, worker pool, retries and in-flight dedup for parse jobs"""
+
+    def __init__(self, parse: ParseFunction, workers: int = 16, max_retained: int = 1000,
+                 callback_timeout_seconds: float = 10.0,
+                 callback_allowed_hosts: Sequence[str] = ()):
+        self.parse = parse
+        self.workers = workers
+        self.max_retained = max_retained
+        self.callback_timeout_seconds = callback_timeout_seconds
+        # Hosts ("hooks.example.com", "10.0.0.5:8080") or URL prefixes ("https://example.com/hooks/")
+        self.callback_allowed_hosts = tuple(entry.strip() for entry in callback_allowed_hosts if entry.strip())
+
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # doc hash -> job still queued or running, for dedup
+        self._inflight: Dict[str, Job] = {}
+        self._heap: List[Tuple[int, int, str]] = []
+        self._sequence = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker_tasks: Set[asyncio.Task] = set()
+        # Workers currently inside a parse
+        self._busy = 0
+        # Webhook deliveries in flight, referenced so they are not garbage collected
+        self._callback_tasks: Set[asyncio.Task] = set()
+        self.counters = {"submitted": 0, "deduplicated": 0, "coalesced": 0, "succeeded": 0, "failed": 0,
+                         "cancelled": 0}
+
+    @classmethod
+    def from_env(cls, parse: ParseFunction) -> "JobEngine":
+        """
+        Read JOB_WORKERS, JOB_MAX_RETAINED and JOB_CALLBACK_ALLOWED_HOSTS (comma separated)
+        """
+        return cls(
+            parse,
+            workers=int(os.getenv("JOB_WORKERS", "16")),
+            max_retained=int(os.getenv("JOB_MAX_RETAINED", "1000")),
+            callback_allowed_hosts=os.getenv("JOB_CALLBACK_ALLOWED_HOSTS", "").split(","),
+        )
+
+    def callback_allowed(self, callback_url: str) -> bool:
+        """An http(s) URL on an allowed host or under an allowed URL prefix"""
+        url = urlsplit(callback_url)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            return False
+        for allowed in self.callback_allowed_hosts:
+            if "://" in allowed:
+                # Compared by parts, so "https://example.com" does not allow "https://example.com.evil.io"
+                prefix = urlsplit(allowed)
+                if ((url.scheme, url.netloc.lower()) == (prefix.scheme.lower(), prefix.netloc.lower())
+                        and path_under(url.path, prefix.path)):
+                    return True
+            elif allowed.lower() in (url.hostname, url.netloc.lower()):
+                return True
+        return False
+
+    def submit(self, document_bytes: Document, priority: int = 0,
+               callback_url: Optional[str] = None) -> Tuple[Job, bool]:
+        """
+        Queue a document for the job API, higher priority runs first
+        Returns (job, deduplicated), an identical in-flight document returns its existing job
+        Raises ValueError for a callback_url that is not allowed
+        """
+        if callback_url and not self.callback_allowed(callback_url):
+            raise ValueError("callback_url is not on a JOB_CALLBACK_ALLOWED_HOSTS host")
+        job, deduplicated = self._join_or_queue(document_bytes, priority)
+        job.detached = True
+        if callback_url:
+            job.callback_urls.append(callback_url)
+        if deduplicated:
+            self.counters["deduplicated"] += 1
+        return job, deduplicated
+
+    async def run(self, document_bytes: Document, priority: int = 0) -> ParseResult:
+        """
+        Submit and wait, for the synchronous endpoint
+        Concurrent identical documents coalesce onto one job and all get its response
+        """
+        job, coalesced = self._join_or_queue(document_bytes, priority)
+        if not coalesced:
+            return await self.wait(job)
+        self.counters["coalesced"] += 1
+        with stage("coalesced_wait"):
+            return await self.wait(job)
+
+    async def wait(self, job: Job) -> ParseResult:
+        """
+        Wait for a job to finish and return its result
+        Cancelling one waiter never cancels the job for the others, but a job
+        nobody is waiting on any more is dropped if it has not started yet
+        """
+        if not job.finished:
+            waiter = asyncio.get_running_loop().create_future()
+            job.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                job.waiters.remove(waiter)
+                if not job.waiters and not job.detached and job.status == QUEUED:
+                    self._cancel(job)
+                raise
+        return job.result
+
+    def _join_or_queue(self, document_bytes: Document, priority: int) -> Tuple[Job, bool]:
+        """The in-flight job for this document, or a newly queued one"""
+        doc_hash = document_hash(document_bytes)
+        existing = self._inflight.get(doc_hash)
+        if existing is not None and not existing.finished:
+            if priority > existing.priority and existing.status == QUEUED:
+                # Requeue at the higher priority, the stale heap entry is skipped when popped
+                existing.priority = priority
+                self._push(existing)
+            return existing, True
+
+        job = Job(id=uuid.uuid4().hex, doc_hash=doc_hash, priority=priority, document_bytes=document_bytes)
+        self.jobs[job.id] = job
+        self._inflight[doc_hash] = job
+        self.counters["submitted"] += 1
+        self._push(job)
+        return job, False
+
+    def _cancel(self, job: Job) -> None:
+        job.status = CANCELLED
+        job.finished_at = time.time()
+        job.document_bytes = None
+        self.counters["cancelled"] += 1
+        if self._inflight.get(job.doc_hash) is job:
+            del self._inflight[job.doc_hash]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self.counters,
+            "queued": len(self._heap),
+            "running": sum(1 for job in self.jobs.values() if job.status == RUNNING),
+            "workers": sum(1 for task in self._worker_tasks if not task.done()),
+        }
+
+    def _push(self, job: Job) -> None:
+        heapq.heappush(self._heap, (-job.priority, next(self._sequence), job.id))
+        self._spawn_workers()
+
+    def _spawn_workers(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # A new event loop (tests, reloads), workers from the old one are gone
+            self._loop = loop
+            self._worker_tasks = set()
+            self._busy = 0
+            for job in self.jobs.values():
+                if job.status == RUNNING:
+                    job.status = QUEUED
+                    heapq.heappush(self._heap, (-job.priority, next(self._sequence), job.id))
+        # A finished worker's done callback may not have run yet
+        self._worker_tasks = {task for task in self._worker_tasks if not task.done()}
+        # Idle workers pick up queued jobs themselves, only spawn for the rest
+        while (len(self._worker_tasks) < self.workers
+               and len(self._heap) > len(self._worker_tasks) - self._busy):
+            task = loop.create_task(self._drain())
+            self._worker_tasks.add(task)
+            task.add_done_callback(self._worker_tasks.discard)
+
+    async def _drain(self) -> None:
+        """Worker loop, exits once the queue is empty"""
+        while self._heap:
+            _, _, job_id = heapq.heappop(self._heap)
+            job = self.jobs.get(job_id)
+            # Cancelled, or already picked up via a higher-priority entry
+            if job is None or job.status != QUEUED:
+                continue
+            self._busy += 1
+            try:
+                await self._run_job(job)
+            finally:
+                self._busy -= 1
+
+    async def _run_job(self, job: Job) -> None:
+        job.status = RUNNING
+        job.started_at = job.started_at or time.time()
+        try:
+            result = await job.context.run(asyncio.ensure_future, self.parse(job.document_bytes))
+        except asyncio.CancelledError:
+            # Worker cancelled mid-parse (shutdown), callers and pollers must not wait forever
+            self._finish(job, ParseResult(success=False, error="CancelledError: job was cancelled while running"))
+            raise
+        except Exception as e:
+            result = ParseResult(success=False, error=f"{type(e).__name__}: {str(e)}")
+        self._finish(job, result)
+
+    def _finish(self, job: Job, result: ParseResult) -> None:
+        job.result = result
+        job.error = result.error
+        job.status = SUCCEEDED if result.success else FAILED
+        job.finished_at = time.time()
+        job.document_bytes = None
+        self.counters["succeeded" if result.success else "failed"] += 1
+        if self._inflight.get(job.doc_hash) is job:
+            del self._inflight[job.doc_hash]
+        for waiter in job.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        job.waiters.clear()
+        for callback_url in job.callback_urls:
+            task = asyncio.get_running_loop().create_task(self._send_callback(job, callback_url))
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+        self._evict_finished()
+
+    async def _send_callback(self, job: Job, callback_url: str) -> None:
+        """POST the finished job to a webhook, best effort"""
+        if not self.callback_allowed(callback_url):
+            # The allowlist may have been narrowed since the job was queued
+            job.callback_status[callback_url] = "error: not allowed"
+            return
+        try:
+            async with httpx.AsyncClient(timeout=self.callback_timeout_seconds) as http:
+                response = await http.post(callback_url, json=job.to_dict())
+            job.callback_status[callback_url] = str(response.status_code)
+        except httpx.HTTPError as e:
+            job.callback_status[callback_url] = f"error: {type(e).__name__}"
+
+    def _evict_finished(self) -> None:
+        """Forget the oldest finished jobs beyond max_retained"""
+        excess = len(self.jobs) - self.max_retained
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished][:excess]:
+            del self.jobs[job_id]
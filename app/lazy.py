@@ -0,0 +1,51 @@
+"""
+Deferred imports for the heavy backends (boto3, pypdf, pdf2image, httpx)
+
+lazy_import returns the module object straight away and only executes it on
+first attribute access, so importing app.main stays cheap for workers that never
+OCR anything (replay, cached results). Because the module object is the real
+one, patch("app.textract_helper.boto3.client") keeps working.
+
+Python 3.11's LazyLoader is not thread safe: two threads touching a module
+for the first time at once can see it half initialised. Code that may first
+touch one from a worker thread calls ensure_loaded on it beforehand.
+"""
+import importlib
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+_load_lock = threading.Lock()
+
+# Imported by the serving path only when a request needs them
+HEAVY_MODULES = ("boto3", "pypdf", "pdf2image", "httpx")
+
+
+def lazy_import(name: str) -> ModuleType:
+    """The named module, executed on first attribute access unless it is already imported"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def ensure_loaded(*modules: ModuleType) -> None:
+    """Finish loading lazily imported modules, one thread at a time"""
+    with _load_lock:
+        for module in modules:
+            # Any attribute access runs the deferred import
+            getattr(module, "__name__")
+
+
+def prewarm() -> None:
+    """Import every heavy backend now rather than on the first request that needs it"""
+    ensure_loaded(*(lazy_import(name) for name in HEAVY_MODULES))
@@ -1,141 +1,160 @@
-from fastapi import FastAPI, File, UploadFile
-from app.models import ParseResponse, Form1040DynamicFields
-from app.textract_helper import analyze_1040
+from fastapi import FastAPI, File, Form, HTTPException, Request, Response, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from app.models import Form1040DynamicFields
+from app.results import ParseResult, encode_result
+from app.textract_helper import analyze_1040, analyze_page, create_textract_client, create_textract_pool
 from app.vlm_helper import extract_fields_with_vlm
+from app.vlm_client import DEFAULT_CONCURRENCY as VLM_DEFAULT_CONCURRENCY, get_vlm_client, is_vlm_failure
+from app.backends import BackendPool, BackendUnavailableError, is_overload
+from app.jobs import JobEngine
+from app.cache import ResultCache, document_hash
+from app.pages import merge_page_blocks, plan_pages
+from app.batch import parse_stored_response
+from app.metrics import (REQUEST_SECONDS, record_document, record_vlm_route, render_gauges, render_metrics,
+                         server_timing_enabled, stage, start_request)
+from app.routing import is_success, merge_vlm_fields, plan_vlm, vlm_router
+from app.replay import REPLAY_EXTENSIONS, ResponseRecorder, ResponseTooLargeError, decode_response, replay_response
+from app.lazy import prewarm
+from app.documents import Document, map_path
+from app.uploads import UploadLimitMiddleware, max_batch_upload_bytes, max_upload_bytes, too_large_detail, upload_view
+from app.text_layer import is_text_layer, path_stats, text_layer_blocks
+from app.pipeline import base_source, build_response, fields_from_blocks, text_layer_is_confident
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from typing import Dict, List
-import re
-
-load_dotenv()
-
-app = FastAPI()
-
-# Keep numeric values, decimals, and signs
-numeric_regex = re.compile(r"[^\d\.\-]")
-# Normalize whitespace
-whitespace_regex = re.compile(r"\s+")
-
-def parse_money(text: str | None) -> float | None:
-    """Parse monetary strings into float values"""
-    if not text:
-        return None
-    cleaned = numeric_regex.sub("", text)
-    # Handle invalid cases, should be integer or float
-    if cleaned in ("", "-", ".", "-."):
-        return None
-    try:
-        return float(cleaned)
-    except ValueError:
-        return None
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+import asyncio
+import json
+import os
+import threading
+import time
 
-def build_block_index(blocks: List[dict]) -> dict:
-    """Index blocks by ID for easy and fast lookup"""
-    return {b["Id"]: b for b in blocks}
+# Set LOAD_DOTENV=false where the environment is already complete (containers)
+if os.getenv("LOAD_DOTENV", "true").lower() != "false":
+    load_dotenv()
 
-def child_text_retriever(idx: Dict[str, dict], block: dict) -> str:
-    """
-    Get readable text for all CHILD elements of a block
-    Uses LINE text if available
-    Otherwise use WORD text
-    """
-    # If no block or no relationships, return empty text
-    if not block or "Relationships" not in block:
-        return ""
-    
-    # Collect text from LINEs or WORDs
-    line_texts: List[str] = []
-    word_texts: List[str] = []
-    
-    # Inspect each relationship in this block
-    for relationship in block.get("Relationships", []):
-        # Only care about CHILD relationships
-        if relationship.get("Type") != "CHILD":
-            continue
-        # Each CHILD has an ID pointing to another block
-        for child_id in relationship.get("Ids", []):
-            child = idx.get(child_id)
-            if not child:
-                continue
-            block_type = child.get("BlockType")
-            if block_type == "LINE":
-                child_text = child.get("Text", "")
-                if child_text:
-                    line_texts.append(child_text)
-            elif block_type == "WORD":
-                child_text = child.get("Text", "")
-                if child_text:
-                    word_texts.append(child_text)
-
-    # Prefer LINE text if available, otherwise use WORD text
-    if line_texts:
-        total_text = " ".join(line_texts)
-    else:
-        total_text = " ".join(word_texts)
-
-    # Normalize whitespace and return clean string
-    return whitespace_regex.sub(" ", total_text).strip()
-
-def value_text_retriever(idx: Dict[str, dict], key_block: dict) -> str:
-    """Get the text connected to a KEY block"""
-    # Look at each relationship the key block has
-    for rel in key_block.get("Relationships", []):
-        # Only care about VALUE relationships
-        if rel.get("Type") == "VALUE":
-            # Go through all the value block IDs connected to this key
-            for value_id in rel.get("Ids", []):
-                # Look up the value block by ID in our index
-                value_block = idx.get(value_id)
-                if value_block:
-                    # Extract text from the value block
-                    v = child_text_retriever(idx, value_block)
-                    if v:
-                        # Stop at the first one
-                        return v.strip()
-    
-    # If no value found, return empty string
-    return ""
+# startup: import backends and build the Textract client before serving (default)
+# background: start serving at once, warm up in a thread
+# lazy: build everything on the first request that needs it
+BACKEND_INIT_MODES = ("startup", "background", "lazy")
+_textract_client_lock = threading.Lock()
 
 
-def textract_to_dict(blocks: List[dict]) -> Dict[str, str]:
+def get_textract_pool(app: FastAPI) -> BackendPool:
+    """Shared pool for Textract calls, created on first use if startup did not run"""
+    if getattr(app.state, "textract_pool", None) is None:
+        app.state.textract_pool = create_textract_pool()
+    return app.state.textract_pool
+
+
+def get_textract_client(app: FastAPI):
     """
-    Convert Textract Blocks into dictionary
+    Shared Textract client, built on first use unless startup already built it
+    None without lifespan (e.g. bare TestClient), then each call makes its own
     """
-    textract_dict = {}
-    idx = build_block_index(blocks)
-    for block in blocks:
-        if block.get("BlockType") == "KEY_VALUE_SET" and "KEY" in block.get("EntityTypes", []):
-            key_text = child_text_retriever(idx, block).lower().strip()
-            value_text = value_text_retriever(idx, block)
-            # Only if we have both key and value
-            if key_text and value_text:
-                textract_dict[key_text] = value_text
-    return textract_dict
-
-def is_line_match(key_text: str, n: int, *need: str) -> bool:
-    """Matching line number with required substring(s)"""
-    # Makes it easier to match whole words this way
-    key_text = " " + key_text.strip().lower() + " "
-    # Check if the text starts with the line number
-    starts_with_line = key_text.startswith(f" {n} ")
-    # Check if it contains "line {n}" in the middle
-    contains_line = f" line {n} " in key_text
-    # Check if it ends with the line number
-    ends_with_line = key_text.endswith(f" {n} ")
-    # Combine all three checks
-    has_line_number = starts_with_line or contains_line or ends_with_line
-
-    return has_line_number and all(substring in key_text for substring in need)
-
-def fill_commonly_blank_fields(dyn: Form1040DynamicFields, field_name: str, default_value: float) -> None:
-    """Fill commonly blank fields with default values"""
-    # Most likely filling with 0.0
-    if Form1040DynamicFields.get_field(dyn, field_name) is None:
-        Form1040DynamicFields.add_field(dyn, field_name, default_value)
+    client = getattr(app.state, "textract_client", None)
+    if client is not None or getattr(app.state, "backend_init", "startup") == "startup":
+        return client
+    with _textract_client_lock:
+        if app.state.textract_client is None:
+            app.state.textract_client = create_textract_client()
+    return app.state.textract_client
+
+
+def backend_init_mode() -> str:
+    mode = os.getenv("BACKEND_INIT", "startup").lower()
+    if mode not in BACKEND_INIT_MODES:
+        raise ValueError(f"BACKEND_INIT must be one of {', '.join(BACKEND_INIT_MODES)}, got {mode!r}")
+    return mode
+
+
+def warm_backends(app: FastAPI) -> None:
+    """Import the heavy backends and build the Textract client"""
+    prewarm()
+    get_textract_client(app)
+
+
+def textract_failover_enabled() -> bool:
+    """Whether documents go to the VLM alone while Textract's circuit breaker is open"""
+    return os.getenv("TEXTRACT_FAILOVER_TO_VLM", "true").lower() != "false"
+
+
+def get_vlm_pool(app: FastAPI) -> BackendPool:
+    """Shared pool for VLM calls, created on first use if startup did not run"""
+    if getattr(app.state, "vlm_pool", None) is None:
+        app.state.vlm_pool = BackendPool.from_env("vlm", default_concurrency=VLM_DEFAULT_CONCURRENCY,
+                                                  default_timeout=120.0, default_attempts=2, default_deadline=180.0)
+    return app.state.vlm_pool
+
+
+def get_job_engine(app: FastAPI) -> JobEngine:
+    """Shared job engine behind the job API and the synchronous endpoint"""
+    if getattr(app.state, "job_engine", None) is None:
+        app.state.job_engine = JobEngine.from_env(
+            lambda doc_bytes: parse_document(app, doc_bytes)
+        )
+    return app.state.job_engine
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create one long-lived, connection-pooled Textract client, the backend pools and the job engine"""
+    app.state.backend_init = backend_init_mode()
+    app.state.textract_client = None
+    if app.state.backend_init == "startup":
+        prewarm()
+        app.state.textract_client = create_textract_client()
+    elif app.state.backend_init == "background":
+        threading.Thread(target=warm_backends, args=(app,), name="backend-warmup", daemon=True).start()
+    get_textract_pool(app)
+    get_vlm_pool(app)
+    get_job_engine(app)
+    yield
+    app.state.textract_pool.shutdown()
+    app.state.vlm_pool.shutdown()
+    app.state.textract_client = None
+    app.state.textract_pool = None
+    app.state.vlm_pool = None
+    app.state.job_engine = None
+
+
+app = FastAPI(lifespan=lifespan)
+# Every route taking an UploadFile needs an entry here
+# Batch requests carry many documents, each file is also held to MAX_UPLOAD_BYTES on its own
+UPLOAD_LIMITS = {
+    "/parse-1040": max_upload_bytes,
+    "/parse-1040/jobs": max_upload_bytes,
+    "/parse-1040/replay": max_upload_bytes,
+    "/parse-1040/batch": max_batch_upload_bytes,
+}
+app.add_middleware(UploadLimitMiddleware, limits=UPLOAD_LIMITS)
+
+# Bump whenever field extraction changes so cached fields are re-derived
+# Cached Textract blocks stay valid across parser versions
+# 2: lines missed by key/value pairs are located by Textract geometry
+PARSER_VERSION = "2"
+
+# None unless RESULT_CACHE_ENABLED is set
+result_cache = ResultCache.from_env()
+
+# Synchronous requests have a client waiting on them, so they jump ahead of queued jobs
+SYNC_PRIORITY = int(os.getenv("JOB_SYNC_PRIORITY", "10"))
+
+# None unless TEXTRACT_RECORD_DIR is set
+response_recorder = ResponseRecorder.from_env()
+
+
+class ResultResponse(Response):
+    """JSON response for a ParseResult, encoded directly instead of through jsonable_encoder"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return encode_result(content)
 
 
 @app.exception_handler(Exception)
 async def generic_exception_handler(request, exc):
-    return ParseResponse(success=False, error=str(exc)).__dict__
+    return ResultResponse(ParseResult(success=False, error=str(exc)), status_code=500)
 
 
 @app.get("/")
@@ -143,96 +162,331 @@ def root():
     return {"message": "1040 Parser API"}
 
 
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit, miss and eviction counters for the result cache"""
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+
+@app.get("/ingest/stats")
+def ingest_stats():
+    """How many documents used the text layer vs rendered OCR, and their latency"""
+    return path_stats.snapshot()
+
+
+@app.get("/routing/stats")
+def routing_stats():
+    """Recent VLM fallback outcomes per form version and layout, for each route"""
+    return vlm_router.stats()
+
+
+@app.get("/backends/stats")
+def backend_stats():
+    """Adaptive concurrency limit, retries and circuit breaker state for Textract and the VLM"""
+    return {pool.name: pool.stats() for pool in (get_textract_pool(app), get_vlm_pool(app))}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus text format: stage timings, source/fallback/validation counters, cache, ingest and VLM client stats"""
+    extra_lines = []
+    if result_cache is not None:
+        extra_lines.extend(render_gauges("result_cache", result_cache.stats()))
+    for path, stats in path_stats.snapshot().items():
+        extra_lines.extend(render_gauges(f"ingest_{path}", stats))
+    extra_lines.extend(render_gauges("jobs", get_job_engine(app).stats()))
+    for pool in (get_textract_pool(app), get_vlm_pool(app)):
+        extra_lines.extend(render_gauges(f"backend_{pool.name}", pool.stats()))
+    extra_lines.extend(render_gauges("vlm_client", get_vlm_client().stats()))
+    return render_metrics(extra_lines)
+
+
 @app.post("/parse-1040")
-async def parse_1040(file: UploadFile = File(...)):
+async def parse_1040(request: Request, file: UploadFile = File(...)):
     """Parse a 1040 form using AWS Textract"""
     if file.filename and not file.filename.lower().endswith('.pdf'):
-        return ParseResponse(success=False, error="Only PDF files are supported")
+        return ResultResponse(ParseResult(success=False, error="Only PDF files are supported"))
     
+    start = time.perf_counter()
+    timings = start_request()
     try:
-        doc_bytes = await file.read()
+        with stage("upload_read"):
+            doc_bytes = await upload_view(file)
     except Exception as e:
-        return ParseResponse(success=False, error=f"Error reading file: {str(e)}")
+        return ResultResponse(ParseResult(success=False, error=f"Error reading file: {str(e)}"))
     
+    result = await get_job_engine(request.app).run(doc_bytes, priority=SYNC_PRIORITY)
+    REQUEST_SECONDS.observe(time.perf_counter() - start)
+    headers = {"Server-Timing": timings.server_timing()} if server_timing_enabled() else None
+    return ResultResponse(result, headers=headers)
+
+
+@app.post("/parse-1040/jobs", status_code=202)
+async def submit_job(request: Request, file: UploadFile = File(...), priority: int = Form(0),
+                     callback_url: Optional[str] = Form(None)):
+    """
+    Queue a 1040 for parsing and return immediately with a job id to poll
+    callback_url, if given, receives the finished job as a JSON POST; it must be an
+    http(s) URL on a host or under a prefix listed in JOB_CALLBACK_ALLOWED_HOSTS
+    """
+    if file.filename and not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files are supported")
+    engine = get_job_engine(request.app)
+    if callback_url and not engine.callback_allowed(callback_url):
+        raise HTTPException(status_code=400,
+                            detail="callback_url must be an http(s) URL on a JOB_CALLBACK_ALLOWED_HOSTS host")
+    doc_bytes = await upload_view(file)
+    job, deduplicated = engine.submit(doc_bytes, priority, callback_url)
+    return {"job_id": job.id, "status": job.status, "deduplicated": deduplicated}
+
+
+@app.get("/parse-1040/jobs/{job_id}")
+def get_job(request: Request, job_id: str):
+    """Status of a queued job, with its result once finished"""
+    job = get_job_engine(request.app).get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return job.to_dict()
+
+
+@app.get("/replay/stats")
+def replay_stats():
+    """How many live Textract responses have been recorded for replay"""
+    if response_recorder is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_recorder.stats()}
+
+
+@app.post("/parse-1040/replay")
+async def parse_1040_replay(file: UploadFile = File(...)):
+    """
+    Parse a saved Textract analyze_document response (.json or .json.gz) without calling AWS
+    MAX_UPLOAD_BYTES bounds the upload and, for .json.gz, the JSON it decompresses to
+    """
+    limit = max_upload_bytes()
+    if limit and (file.size or 0) > limit:
+        raise HTTPException(status_code=413, detail=too_large_detail(limit))
     try:
-        textract_response = analyze_1040(doc_bytes)
+        textract_response = decode_response(await file.read(), limit)
+    except ResponseTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (OSError, ValueError) as e:
+        return ResultResponse(ParseResult(success=False, error=f"Invalid Textract response: {str(e)}"))
+    if not isinstance(textract_response, dict):
+        return ResultResponse(ParseResult(success=False, error="Invalid Textract response: expected a JSON object"))
+    return ResultResponse(await asyncio.to_thread(replay_response, textract_response))
+
+
+@app.post("/parse-1040/batch")
+async def parse_1040_batch(request: Request, files: List[UploadFile] = File(default=[]),
+                           manifest: Optional[UploadFile] = File(default=None)):
+    """
+    Parse many documents in one request
+    Accepts uploaded PDFs and/or a manifest (JSON list of paths under BATCH_ROOT,
+    PDFs or stored Textract JSON) and streams one NDJSON line per document as it completes
+    """
+    items: List[Tuple[str, Union[UploadFile, Path, str]]] = [(f.filename or "", f) for f in files]
+    if manifest is not None:
+        if max_upload_bytes() and (manifest.size or 0) > max_upload_bytes():
+            error = f"Invalid manifest: {too_large_detail(max_upload_bytes())}"
+            return ResultResponse(ParseResult(success=False, error=error))
+        try:
+            manifest_paths = json.loads(await manifest.read())
+        except ValueError as e:
+            return ResultResponse(ParseResult(success=False, error=f"Invalid manifest: {str(e)}"))
+        if not isinstance(manifest_paths, list):
+            return ResultResponse(ParseResult(success=False, error="Manifest must be a JSON list of paths"))
+        items.extend((str(path), resolve_batch_path(str(path))) for path in manifest_paths)
+
+    return StreamingResponse(stream_batch(request.app, items), media_type="application/x-ndjson")
+
+
+def resolve_batch_path(path: str) -> Union[Path, str]:
+    """Manifest path resolved under BATCH_ROOT, or an error message"""
+    batch_root = os.getenv("BATCH_ROOT")
+    if not batch_root:
+        return "Manifest paths are disabled, BATCH_ROOT is not set"
+    root = Path(batch_root).resolve()
+    resolved = (root / path).resolve()
+    if not resolved.is_relative_to(root):
+        return "Path is outside BATCH_ROOT"
+    if not resolved.name.lower().endswith((".pdf",) + REPLAY_EXTENSIONS):
+        return "Only PDF and Textract JSON files are supported"
+    return resolved
+
+
+async def parse_batch_item(app: FastAPI, name: str, source: Union[UploadFile, Path, str]) -> Dict[str, Any]:
+    """One NDJSON record, failures are reported per document rather than failing the batch"""
+    try:
+        if isinstance(source, str):
+            response = ParseResult(success=False, error=source)
+        elif isinstance(source, Path) and source.name.lower().endswith(REPLAY_EXTENSIONS):
+            response = await asyncio.to_thread(parse_stored_response, source)
+        elif isinstance(source, Path):
+            response = await get_job_engine(app).run(await asyncio.to_thread(map_path, source))
+        elif name and not name.lower().endswith('.pdf'):
+            response = ParseResult(success=False, error="Only PDF files are supported")
+        elif max_upload_bytes() and (source.size or 0) > max_upload_bytes():
+            response = ParseResult(success=False, error=too_large_detail(max_upload_bytes()))
+        else:
+            response = await get_job_engine(app).run(await upload_view(source))
     except Exception as e:
-        return ParseResponse(success=False, error=f"Textract error: {str(e)}")
-    
-    blocks = textract_response.get('Blocks', [])
-    textract_dict = textract_to_dict(blocks)
-    dyn = Form1040DynamicFields()
-    # Could add textract_dict to dyn fields for less overall compute
-
-    for key_text, value_text in textract_dict.items():
-        if is_line_match(key_text, 9, "total", "income") or "9 add lines" in key_text:
-            val = parse_money(value_text)
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_9", val)
-                continue
-        if (is_line_match(key_text, 10, "adjustment")
-            or (key_text.endswith(' 10') and 'adjustment' in key_text)):
-            val = parse_money(value_text)
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_10", val)
-                continue
-        if (is_line_match(key_text, 11, "adjusted", "gross", "income")
-            or (is_line_match(key_text, 11) and 'subtract' in key_text)):
-            val = parse_money(value_text)
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_11", val)
-                continue
-        if is_line_match(key_text, 12, "deduction") and ("standard" in key_text or "itemized" in key_text):
-            val = parse_money(value_text)
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_12", val)
-                continue
-        if is_line_match(key_text, 13, "qualified", "deduction"):
-            val = parse_money(value_text)
-            # Seemingly commonly left empty, filling with 0.0 if found but empty
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_13", val)
-            else:
-                Form1040DynamicFields.add_field(dyn, "line_13", 0.0)
-            continue
-        if is_line_match(key_text, 14, "total", "deductions") or "14 add lines" in key_text:
-            val = parse_money(value_text)
-            if val is not None:
-                Form1040DynamicFields.add_field(dyn, "line_14", val)
+        response = ParseResult(success=False, error=f"{type(e).__name__}: {str(e)}")
+    return {"name": name, **response.model_dump()}
+
+
+async def stream_batch(app: FastAPI, items: List[Tuple[str, Union[UploadFile, Path, str]]]) -> AsyncIterator[str]:
+    """
+    Run batch items with at most BATCH_MAX_CONCURRENCY in flight, yielding results
+    in completion order so slow documents do not hold back fast ones
+    """
+    max_in_flight = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+    pending = set()
+    try:
+        for name, source in items:
+            pending.add(asyncio.ensure_future(parse_batch_item(app, name, source)))
+            if len(pending) < max_in_flight:
                 continue
-    
-    # Can absolutely remove this and change validation logic later
-    fill_commonly_blank_fields(dyn, "line_13", 0.0)
-    
-    # VLM Fallback if line content is missing from Textract extraction
-    if not all(field_name in dyn.fields for field_name in ("line_9", "line_10", "line_11")):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield json.dumps(task.result()) + "\n"
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield json.dumps(task.result()) + "\n"
+    finally:
+        # Client went away mid-stream, stop the remaining work
+        for task in pending:
+            task.cancel()
+
+
+async def parse_document(app: FastAPI, doc_bytes: Document) -> ParseResult:
+    """
+    Parse one document and count it in the metrics
+    Backend failures come back as an unsuccessful result, the backend pools already retried them
+    """
+    response, source = await _parse_document(app, doc_bytes)
+    record_document(len(doc_bytes), source, response.success, (response.fields or {}).get("is_valid"))
+    return response
+
+
+async def _parse_document(app: FastAPI, doc_bytes: Document) -> Tuple[ParseResult, Optional[str]]:
+    """Cache lookup, OCR (or text layer), field extraction and validation, plus where the fields came from"""
+    # Serve repeat uploads from the cache when enabled
+    doc_hash = document_hash(doc_bytes) if result_cache is not None else None
+    if result_cache is not None:
+        with stage("cache_lookup"):
+            cached_result = result_cache.get_result(doc_hash, PARSER_VERSION)
+        if cached_result is not None:
+            return ParseResult.from_dict(cached_result), "cache"
+
+    blocks = None
+    if result_cache is not None:
+        with stage("cache_lookup"):
+            blocks = result_cache.get_blocks(doc_hash)
+    textract_seconds = 0.0
+    if blocks is None:
         try:
-            vlm_data = extract_fields_with_vlm(doc_bytes)
-            for line in ("line_9", "line_10", "line_11", "line_12", "line_13", "line_14"):
-                vlm_value = vlm_data.get(line)
-                # Ensures VLM output is numeric
-                if vlm_value is not None and isinstance(vlm_value, (int, float)):
-                    Form1040DynamicFields.add_field(dyn, line, float(vlm_value))
-            Form1040DynamicFields.add_field(dyn, "source", "vlm")
-            
-        # If both VLM and Textract fail, return error
-        except Exception:
-            return ParseResponse(success=False, error="Could not parse all required fields")
-    else:
-        Form1040DynamicFields.add_field(dyn, "source", "textract")
-    
-    # Final check to ensure required fields are present after VLM extraction
-    if not all(name in dyn.fields for name in ("line_9", "line_10", "line_11")):
-        return ParseResponse(success=False, error="Could not parse all required fields")
-    
-    # Include both line 11 and line 14 validation results, requiring both to be valid
-    # Can absolutely change to just validating line 11 calculation
-    is_valid = (Form1040DynamicFields.validate_line_11_totals(dyn) 
-                and Form1040DynamicFields.validate_line_14_totals(dyn))
+            start = time.perf_counter()
+            blocks = await run_textract(app, doc_bytes)
+            textract_seconds = time.perf_counter() - start
+        except BackendUnavailableError as e:
+            if not (textract_failover_enabled() and get_vlm_pool(app).available()):
+                return ParseResult(success=False, error=f"Textract error: {str(e)}"), None
+            # Textract is failing fast, let the VLM read the whole page instead
+            blocks = []
+        except Exception as e:
+            if not (is_overload(e) and not get_textract_pool(app).available()
+                    and textract_failover_enabled() and get_vlm_pool(app).available()):
+                return ParseResult(success=False, error=f"Textract error: {str(e)}"), None
+            # The pool's retries just opened Textract's breaker, go to the VLM now
+            blocks = []
+        else:
+            if result_cache is not None:
+                result_cache.set_blocks(doc_hash, blocks, textract_seconds)
+            # Text-layer blocks cost nothing to regenerate, only OCR output is worth keeping
+            if response_recorder is not None and not is_text_layer(blocks):
+                await asyncio.to_thread(response_recorder.record, doc_hash or document_hash(doc_bytes), blocks)
 
-    Form1040DynamicFields.add_field(dyn, "is_valid", is_valid)
-    
-    return ParseResponse(success=True, fields=dyn.fields)
+    response = await extract_fields(blocks, doc_bytes, get_vlm_pool(app))
+    if result_cache is not None and response.success:
+        result_cache.set_result(doc_hash, PARSER_VERSION, response.model_dump(), textract_seconds)
+    return response, (response.fields or {}).get("source")
+
+
+async def run_textract(app: FastAPI, doc_bytes: Document) -> List[dict]:
+    """
+    OCR the document and return its Textract blocks
+    PDFs with a usable text layer skip OCR entirely
+    Multi-page PDFs fan out one Textract call per relevant page, concurrently,
+    so wall-clock time tracks the slowest page rather than the sum
+    """
+    start = time.perf_counter()
+    # Reading the text layer is CPU work, keep it off the event loop
+    with stage("plan_pages"):
+        planned_pages = await asyncio.to_thread(plan_pages, doc_bytes)
+    page_numbers = [page_number for page_number, _ in planned_pages] if planned_pages else [1]
+
+    with stage("text_layer"):
+        text_blocks = await asyncio.to_thread(text_layer_blocks, doc_bytes, page_numbers)
+    if text_blocks is not None and text_layer_is_confident(text_blocks):
+        path_stats.record("text_layer", time.perf_counter() - start)
+        return text_blocks
+
+    pool = get_textract_pool(app)
+    # Without startup (e.g. bare TestClient) analyze_1040 builds its own client
+    textract_client = getattr(app.state, "textract_client", None)
+    if textract_client is None:
+        # Lazy or still warming up, building it imports boto3 so keep it off the event loop
+        textract_client = await asyncio.to_thread(get_textract_client, app)
+    # Wall time including pool queueing, render and textract are timed inside the workers
+    with stage("ocr"):
+        if not planned_pages:
+            textract_response = await pool.run(analyze_1040, doc_bytes, textract_client)
+            blocks = textract_response.get('Blocks', [])
+        else:
+            responses = await asyncio.gather(*[
+                pool.run(analyze_page, doc_bytes, page_number, textract_client) for page_number in page_numbers
+            ])
+            blocks = merge_page_blocks(page_numbers, responses)
+    path_stats.record("ocr", time.perf_counter() - start)
+    return blocks
+
+
+async def extract_fields(blocks: List[dict], doc_bytes: Document, vlm_pool: BackendPool) -> ParseResult:
+    """Derive and validate 1040 fields from Textract blocks, with per-field VLM fallback"""
+    dyn, forms = fields_from_blocks(blocks)
+    source = base_source(blocks)
+    plan = plan_vlm(dyn, blocks, vlm_router)
+    if plan is None:
+        Form1040DynamicFields.add_field(dyn, "source", source)
+        return build_response(dyn, forms)
+
+    start = time.perf_counter()
+    try:
+        with stage("vlm"):
+            vlm_data = await vlm_pool.run(extract_fields_with_vlm, doc_bytes, plan.fields, plan.region)
+    except BackendUnavailableError:
+        # VLM circuit open, keep what Textract read without counting it against the route
+        Form1040DynamicFields.add_field(dyn, "source", source)
+        return build_response(dyn, forms)
+    # If both VLM and Textract fail, build_response returns the error
+    except Exception as e:
+        # Only the model's own failures say anything about the route, not a missing
+        # VLM_BASE_URL or an image that could not be read
+        if is_vlm_failure(e):
+            vlm_router.record(plan.route_key, plan.route, False, None, time.perf_counter() - start)
+            record_vlm_route(plan.route, False)
+        Form1040DynamicFields.add_field(dyn, "source", source)
+        return build_response(dyn, forms)
+
+    merge_vlm_fields(dyn, plan, vlm_data, source)
+    success = is_success(dyn)
+    vlm_router.record(plan.route_key, plan.route, success, vlm_data.get("usage"), time.perf_counter() - start)
+    record_vlm_route(plan.route, success)
+    return build_response(dyn, forms)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,228 @@
+"""
+Per-request stage timing and Prometheus-style counters
+
+stage("textract") times a block of work into the parse_stage_seconds histogram
+and, when a request is being tracked, into that request's RequestTimings
+(surfaced as a Server-Timing header). Overhead is two perf_counter calls,
+a contextvar lookup and one uncontended lock per stage, see benchmarks/bench_metrics.py
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Stage latencies, 1ms .. 60s
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Uploaded document sizes, 16KB .. 64MB
+BYTES_BUCKETS = tuple(16 * 1024 * 4 ** i for i in range(7))
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter:
+    """Monotonic counter, optionally labelled"""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally labelled"""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(label_values)
+            if counts is None:
+                counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+                self._sums[label_values] = 0.0
+            counts[index] += 1
+            self._sums[label_values] += value
+
+    def count(self, *label_values: str) -> int:
+        with self._lock:
+            return sum(self._counts.get(label_values, ()))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.label_names, label_values, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[label_values])}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_gauges(prefix: str, stats: Dict[str, float]) -> List[str]:
+    """Expose a flat stats dict (cache, ingest path) as gauges, non-numeric values are skipped"""
+    lines = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{key}"
+        lines.extend([f"# TYPE {name} gauge", f"{name} {_format_value(value)}"])
+    return lines
+
+
+# Pipeline metrics
+STAGE_SECONDS = Histogram("parse_stage_seconds", "Time spent in each parse stage", SECONDS_BUCKETS, ("stage",))
+REQUEST_SECONDS = Histogram("parse_request_seconds", "End-to-end /parse-1040 latency", SECONDS_BUCKETS)
+DOCUMENT_BYTES = Histogram("parse_document_bytes", "Size of parsed documents", BYTES_BUCKETS)
+DOCUMENTS = Counter("parse_documents_total", "Parsed documents by field source", ("source",))
+VLM_FALLBACKS = Counter("parse_vlm_fallbacks_total", "Documents that needed the VLM fallback")
+VLM_ROUTES = Counter("parse_vlm_route_calls_total", "VLM fallback calls by route and whether the result validated",
+                     ("route", "outcome"))
+VALIDATION_FAILURES = Counter("parse_validation_failures_total", "Parsed documents whose totals do not add up")
+PARSE_FAILURES = Counter("parse_failures_total", "Documents that could not be parsed")
+
+ALL_METRICS = (STAGE_SECONDS, REQUEST_SECONDS, DOCUMENT_BYTES, DOCUMENTS, VLM_FALLBACKS, VLM_ROUTES,
+               VALIDATION_FAILURES, PARSE_FAILURES)
+
+
+class RequestTimings:
+    """Stage durations for one request, summed when a stage runs more than once (e.g. per page)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage_name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in milliseconds"""
+        with self._lock:
+            return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items())
+
+
+_current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def metrics_enabled() -> bool:
+    return os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+
+
+def server_timing_enabled() -> bool:
+    return os.getenv("SERVER_TIMING_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+# Read once, flipping it at runtime is for benchmarks only
+_enabled = metrics_enabled()
+
+
+def set_enabled(enabled: bool) -> None:
+    global _enabled
+    _enabled = enabled
+
+
+def start_request() -> RequestTimings:
+    """Begin collecting stage timings for the current request (and tasks/threads it spawns)"""
+    timings = RequestTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+class stage:
+    """
+    Time the enclosed block as stage_name
+    A plain class rather than @contextmanager, which costs about twice as much per use
+    """
+    __slots__ = ("stage_name", "start")
+
+    def __init__(self, stage_name: str):
+        self.stage_name = stage_name
+        self.start = 0.0
+
+    def __enter__(self) -> None:
+        if _enabled:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        if not _enabled:
+            return
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, self.stage_name)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(self.stage_name, seconds)
+
+
+def record_document(document_size: int, source: Optional[str], success: bool, is_valid: Optional[bool]) -> None:
+    """Count one parsed document by outcome"""
+    if not _enabled:
+        return
+    DOCUMENT_BYTES.observe(document_size)
+    if not success:
+        PARSE_FAILURES.inc()
+        DOCUMENTS.inc("none")
+        return
+    DOCUMENTS.inc(source or "unknown")
+    # "vlm" for a whole-page fallback, "textract+vlm" / "text_layer+vlm" when only some lines came from it
+    if source is not None and "vlm" in source:
+        VLM_FALLBACKS.inc()
+    if is_valid is False:
+        VALIDATION_FAILURES.inc()
+
+
+def record_vlm_route(route: str, success: bool) -> None:
+    """Count one VLM fallback call by route ("partial" or "full")"""
+    if _enabled:
+        VLM_ROUTES.inc(route, "success" if success else "failure")
+
+
+def render_metrics(extra_lines: Sequence[str] = ()) -> str:
+    """Prometheus text exposition format for every metric"""
+    lines: List[str] = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,149 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from app.documents import Document, document_stream, is_pdf
+from app.lazy import ensure_loaded, lazy_import
+
+# Loaded on the first PDF, see app.lazy
+pypdf = lazy_import("pypdf")
+
+# Form type labels
+FORM_1040 = "1040"
+UNKNOWN_FORM = "unknown"
+
+# Normalize whitespace
+whitespace_regex = re.compile(r"\s+")
+# Leftmost form title wins, so "Form 2441 ... Attach to Form 1040" is a 2441
+# "SCHEDULE 1 (Form 1040)", "Schedule SE (Form 1040) 2024 Page 2",
+# "Form1040 2024U.S. Individual...", "Form 1040 (2024) Page 2", "Form 8949", "Form W-2"
+form_title_regex = re.compile(r"schedule\s+([a-z0-9]{1,3})\s*\(form\s*1040|\bform\s*(w-2|\d{4}[a-z-]*)")
+# Tax year printed in the form header, e.g. "2024"
+tax_year_regex = re.compile(r"\b(19[89]\d|20\d\d)\b")
+# Line labels such as "9", "1a", "25d" at the start or end of a key
+line_label_regex = re.compile(r"^\d{1,2}[a-z]?$")
+
+# How much leading text is enough to classify a page
+HEADER_CHARS = 160
+
+
+class _HeaderComplete(Exception):
+    """Stops pypdf text extraction once the page header has been read"""
+
+
+def classify_text(text: str) -> str:
+    """Cheap form-type classification from the first text on a page"""
+    header = whitespace_regex.sub(" ", text[:HEADER_CHARS]).lower()
+    title = form_title_regex.search(header)
+    if title is None:
+        return UNKNOWN_FORM
+    schedule, form_number = title.groups()
+    if schedule:
+        return f"schedule_{schedule}"
+    if form_number == FORM_1040:
+        return FORM_1040
+    return f"form_{form_number}"
+
+
+def page_header_text(page) -> str:
+    """Leading text of a pypdf page, without extracting the whole page"""
+    chunks: List[str] = []
+    collected = 0
+
+    def visitor(text, *_):
+        nonlocal collected
+        chunks.append(text)
+        collected += len(text)
+        if collected >= HEADER_CHARS:
+            raise _HeaderComplete
+
+    try:
+        page.extract_text(visitor_text=visitor)
+    except _HeaderComplete:
+        pass
+    return "".join(chunks)
+
+
+def relevant_forms() -> Tuple[str, ...]:
+    """Form types worth sending to OCR, from OCR_FORMS"""
+    configured = os.getenv("OCR_FORMS", "1040,schedule_1,schedule_a,schedule_b,form_w-2,unknown")
+    return tuple(form.strip().lower() for form in configured.split(",") if form.strip())
+
+
+def plan_pages(document_bytes: Document) -> Optional[List[Tuple[int, str]]]:
+    """
+    Classify every page of a multi-page PDF from its text layer
+    Returns [(page_number, form_type)] for the pages worth OCR,
+    or None when the document is not a multi-page PDF
+    """
+    if not is_pdf(document_bytes):
+        return None
+    try:
+        ensure_loaded(pypdf)
+        reader = pypdf.PdfReader(document_stream(document_bytes))
+        page_count = len(reader.pages)
+    except Exception:
+        return None
+    if page_count <= 1:
+        return None
+
+    wanted = relevant_forms()
+    max_pages = int(os.getenv("OCR_MAX_PAGES", "8"))
+    planned: List[Tuple[int, str]] = []
+    for page_number, page in enumerate(reader.pages, start=1):
+        try:
+            form_type = classify_text(page_header_text(page))
+        except Exception:
+            form_type = UNKNOWN_FORM
+        if form_type in wanted:
+            planned.append((page_number, form_type))
+        if len(planned) >= max_pages:
+            break
+    return planned
+
+
+def merge_page_blocks(page_numbers: List[int], responses: List[dict]) -> List[dict]:
+    """
+    Concatenate per-page Textract responses into one Blocks list
+    Each block is tagged with its Page, the same way multi-page Textract output is
+    """
+    merged: List[dict] = []
+    for page_number, response in zip(page_numbers, responses):
+        for block in response.get("Blocks", []):
+            block["Page"] = page_number
+            merged.append(block)
+    return merged
+
+
+def group_blocks_by_page(blocks: List[dict]) -> Dict[int, List[dict]]:
+    """Split a Blocks list by page, untagged blocks belong to page 1"""
+    pages: Dict[int, List[dict]] = {}
+    for block in blocks:
+        pages.setdefault(block.get("Page", 1), []).append(block)
+    return dict(sorted(pages.items()))
+
+
+def classify_blocks(blocks: List[dict]) -> str:
+    """Form-type classification from OCR'd LINE text, for pages without a text layer"""
+    return classify_text(" ".join(b.get("Text", "") for b in blocks if b.get("BlockType") == "LINE"))
+
+
+def form_version(blocks: List[dict]) -> str:
+    """Form type and tax year of the first page, e.g. "1040:2024", for per-version routing stats"""
+    return page_version(group_blocks_by_page(blocks).get(1, blocks) if blocks else [])
+
+
+def page_version(page_blocks: List[dict]) -> str:
+    """form_version for blocks already known to be the first page"""
+    header = " ".join(b.get("Text", "") for b in page_blocks if b.get("BlockType") == "LINE")[:HEADER_CHARS]
+    year = tax_year_regex.search(header)
+    return f"{classify_text(header)}:{year.group(1) if year else 'unknown'}"
+
+
+def line_label(key_text: str) -> Optional[str]:
+    """Generic "line_<n>" label for a key that starts or ends with a line number"""
+    tokens = key_text.split(" ")
+    for token in (tokens[0], tokens[-1]):
+        if line_label_regex.match(token):
+            return f"line_{token}"
+    return None
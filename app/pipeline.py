@@ -0,0 +1,317 @@
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.documents import Document
+from app.metrics import stage
+from app.models import Form1040DynamicFields
+from app.forms import FORMS
+from app.pages import FORM_1040, UNKNOWN_FORM, classify_blocks, group_blocks_by_page, line_label
+from app.results import FormResult, ParseResult, Source
+from app.rules import CompiledRules
+from app.routing import REQUIRED_FIELDS, fields_to_ask, merge_vlm_fields, plan_vlm, vlm_router
+from app.spatial import fill_from_geometry, spatial_enabled
+from app.text_layer import is_text_layer
+
+# Keep numeric values, decimals, and signs
+numeric_regex = re.compile(r"[^\d\.\-]")
+# Normalize whitespace
+whitespace_regex = re.compile(r"\s+")
+
+def parse_money(text: str | None) -> float | None:
+    """Parse monetary strings into float values"""
+    if not text:
+        return None
+    cleaned = numeric_regex.sub("", text)
+    # Handle invalid cases, should be integer or float
+    if cleaned in ("", "-", ".", "-."):
+        return None
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+def build_block_index(blocks: List[dict]) -> dict:
+    """Index blocks by ID for easy and fast lookup"""
+    return {b["Id"]: b for b in blocks}
+
+def child_text_retriever(idx: Dict[str, dict], block: dict) -> str:
+    """
+    Get readable text for all CHILD elements of a block
+    Uses LINE text if available
+    Otherwise use WORD text
+    """
+    # If no block or no relationships, return empty text
+    if not block or "Relationships" not in block:
+        return ""
+    
+    # Collect text from LINEs or WORDs
+    line_texts: List[str] = []
+    word_texts: List[str] = []
+    
+    # Inspect each relationship in this block
+    for relationship in block.get("Relationships", []):
+        # Only care about CHILD relationships
+        if relationship.get("Type") != "CHILD":
+            continue
+        # Each CHILD has an ID pointing to another block
+        for child_id in relationship.get("Ids", []):
+            child = idx.get(child_id)
+            if not child:
+                continue
+            block_type = child.get("BlockType")
+            if block_type == "LINE":
+                child_text = child.get("Text", "")
+                if child_text:
+                    line_texts.append(child_text)
+            elif block_type == "WORD":
+                child_text = child.get("Text", "")
+                if child_text:
+                    word_texts.append(child_text)
+
+    # Prefer LINE text if available, otherwise use WORD text
+    if line_texts:
+        total_text = " ".join(line_texts)
+    else:
+        total_text = " ".join(word_texts)
+
+    # Normalize whitespace and return clean string
+    return whitespace_regex.sub(" ", total_text).strip()
+
+def value_text_retriever(idx: Dict[str, dict], key_block: dict) -> str:
+    """Get the text connected to a KEY block"""
+    # Look at each relationship the key block has
+    for rel in key_block.get("Relationships", []):
+        # Only care about VALUE relationships
+        if rel.get("Type") == "VALUE":
+            # Go through all the value block IDs connected to this key
+            for value_id in rel.get("Ids", []):
+                # Look up the value block by ID in our index
+                value_block = idx.get(value_id)
+                if value_block:
+                    # Extract text from the value block
+                    v = child_text_retriever(idx, value_block)
+                    if v:
+                        # Stop at the first one
+                        return v.strip()
+    
+    # If no value found, return empty string
+    return ""
+
+
+def textract_to_dict(blocks: List[dict], confidences: Optional[Dict[str, float]] = None) -> Dict[str, str]:
+    """
+    Convert Textract Blocks into dictionary
+    confidences, if given, also gets Textract's confidence in each key/value pair
+    """
+    textract_dict = {}
+    idx = build_block_index(blocks)
+    for block in blocks:
+        if block.get("BlockType") == "KEY_VALUE_SET" and "KEY" in block.get("EntityTypes", []):
+            key_text = child_text_retriever(idx, block).lower().strip()
+            value_text = value_text_retriever(idx, block)
+            # Only if we have both key and value
+            if key_text and value_text:
+                textract_dict[key_text] = value_text
+                if confidences is not None and "Confidence" in block:
+                    confidences[key_text] = block["Confidence"]
+    return textract_dict
+
+def is_line_match(key_text: str, n: int, *need: str) -> bool:
+    """Matching line number with required substring(s)"""
+    # Makes it easier to match whole words this way
+    key_text = " " + key_text.strip().lower() + " "
+    # Check if the text starts with the line number
+    starts_with_line = key_text.startswith(f" {n} ")
+    # Check if it contains "line {n}" in the middle
+    contains_line = f" line {n} " in key_text
+    # Check if it ends with the line number
+    ends_with_line = key_text.endswith(f" {n} ")
+    # Combine all three checks
+    has_line_number = starts_with_line or contains_line or ends_with_line
+
+    return has_line_number and all(substring in key_text for substring in need)
+
+def fill_commonly_blank_fields(dyn: Form1040DynamicFields, field_name: str, default_value: float) -> None:
+    """Fill commonly blank fields with default values"""
+    # Most likely filling with 0.0
+    if Form1040DynamicFields.get_field(dyn, field_name) is None:
+        Form1040DynamicFields.add_field(dyn, field_name, default_value, Source.DEFAULT)
+
+
+def text_layer_is_confident(blocks: List[dict]) -> bool:
+    """Trust the text layer only if it yields every required line and they add up"""
+    textract_dict, _ = form_1040_dict(blocks)
+    dyn = match_1040_fields(textract_dict)
+    return (all(name in dyn.fields for name in ("line_9", "line_10", "line_11"))
+            and Form1040DynamicFields.validate_line_11_totals(dyn))
+
+
+def page_form_type(header_form: str, textract_dict: Dict[str, str]) -> str:
+    """The header's form type, or the key fingerprint's when the header named no form"""
+    if header_form != UNKNOWN_FORM:
+        return header_form
+    return FORMS.fingerprint(textract_dict) or UNKNOWN_FORM
+
+
+def match_form_fields(compiled: CompiledRules, textract_dict: Dict[str, str],
+                      matched_keys: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, float]:
+    """
+    Run one form's rule table over every key/value, blank defaults are left to the caller
+    matched_keys, if given, gets the key each field was read from (None for a blank's default)
+    """
+    fields: Dict[str, float] = {}
+    for key_text, value_text in textract_dict.items():
+        # Rules come back in table order, first one with a usable value wins
+        for rule in compiled.match(key_text):
+            val = parse_money(value_text)
+            from_key: Optional[str] = key_text
+            if val is None:
+                val, from_key = rule.default_if_blank, None
+            if val is not None:
+                fields[rule.field] = val
+                if matched_keys is not None:
+                    matched_keys[rule.field] = from_key
+                break
+    return fields
+
+
+def extract_forms(page_dicts: Dict[int, Dict[str, str]], page_forms: Dict[int, str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Merge per-page key/values into {form: {field: value}}, first value found wins
+    Registered forms go through their own rule table, defaults and cross-checks (is_valid),
+    other forms and numbered keys no rule claimed keep a generic "line_<n>" label
+    """
+    forms: Dict[str, Dict[str, Any]] = {}
+    for page_number, textract_dict in page_dicts.items():
+        form_type = page_forms[page_number]
+        form_lines = forms.setdefault(form_type, {})
+        spec = FORMS.get(form_type)
+        if spec is not None:
+            for field_name, val in match_form_fields(FORMS.compiled(form_type), textract_dict).items():
+                form_lines.setdefault(field_name, val)
+            if not spec.generic_lines:
+                continue
+        for key_text, value_text in textract_dict.items():
+            label = line_label(key_text)
+            if label is None or label in form_lines:
+                continue
+            val = parse_money(value_text)
+            if val is not None:
+                form_lines[label] = val
+
+    # Defaults and checks once every page of a form is in, schedules run over two pages
+    for form_type, form_lines in forms.items():
+        spec = FORMS.get(form_type)
+        if spec is None:
+            continue
+        for field_name, default_value in FORMS.compiled(form_type).defaults:
+            form_lines.setdefault(field_name, default_value)
+        if spec.cross_checks:
+            form_lines["is_valid"] = all(check.passes(form_lines) for check in spec.cross_checks)
+    return forms
+
+
+def form_1040_dict(blocks: List[dict], confidences: Optional[Dict[str, float]] = None
+                   ) -> Tuple[Dict[str, str], Optional[Dict[str, Dict[str, Any]]]]:
+    """
+    Key/values of the 1040 pages, plus {form: {line: value}} for multi-page documents
+    Single-page documents return None for the forms, confidences as in textract_to_dict
+    """
+    pages = group_blocks_by_page(blocks)
+    if len(pages) <= 1:
+        return textract_to_dict(blocks, confidences), None
+    page_dicts = {page_number: textract_to_dict(page_blocks, confidences)
+                  for page_number, page_blocks in pages.items()}
+    page_forms = {page_number: page_form_type(classify_blocks(page_blocks), page_dicts[page_number])
+                  for page_number, page_blocks in pages.items()}
+    # 1040 lines only come from 1040 pages, unless no page could be classified as one
+    form_1040_pages = [n for n, form in page_forms.items() if form == FORM_1040] or list(pages)
+    textract_dict: Dict[str, str] = {}
+    for page_number in form_1040_pages:
+        for key_text, value_text in page_dicts[page_number].items():
+            textract_dict.setdefault(key_text, value_text)
+    return textract_dict, extract_forms(page_dicts, page_forms)
+
+
+def match_1040_fields(textract_dict: Dict[str, str], source: Source = Source.TEXTRACT,
+                      confidences: Optional[Dict[str, float]] = None) -> Form1040DynamicFields:
+    """Run the 1040 rule table over every key/value, recording source and confidence per line"""
+    compiled = FORMS.compiled(FORM_1040)
+    matched_keys: Dict[str, Optional[str]] = {}
+    dyn = Form1040DynamicFields(fields=match_form_fields(compiled, textract_dict, matched_keys))
+    for field_name, key_text in matched_keys.items():
+        if key_text is None:
+            dyn.provenance[field_name] = (Source.DEFAULT, None)
+        else:
+            dyn.provenance[field_name] = (source, confidences.get(key_text) if confidences else None)
+
+    # Can absolutely remove this and change validation logic later
+    for field_name, default_value in compiled.defaults:
+        fill_commonly_blank_fields(dyn, field_name, default_value)
+    return dyn
+
+
+def fields_from_blocks(blocks: List[dict]) -> Tuple[Form1040DynamicFields, Optional[Dict[str, Dict[str, Any]]]]:
+    """Match 1040 fields from Textract (or text-layer) blocks, plus forms for multi-page documents"""
+    confidences: Dict[str, float] = {}
+    with stage("block_index"):
+        textract_dict, forms = form_1040_dict(blocks, confidences)
+    with stage("key_matching"):
+        dyn = match_1040_fields(textract_dict, base_source(blocks), confidences)
+    # Only when key matching left something for the VLM, located amounts may spare the call
+    if spatial_enabled() and fields_to_ask(dyn):
+        with stage("spatial"):
+            fill_from_geometry(dyn, blocks)
+    return dyn, forms
+
+
+def needs_vlm(dyn: Form1040DynamicFields) -> bool:
+    """VLM Fallback if line content is missing from Textract extraction"""
+    return not all(field_name in dyn.fields for field_name in REQUIRED_FIELDS)
+
+
+def base_source(blocks: List[dict]) -> Source:
+    """Where key-matched lines come from, before any VLM help"""
+    return Source.TEXT_LAYER if is_text_layer(blocks) else Source.TEXTRACT
+
+
+def build_response(dyn: Form1040DynamicFields, forms: Optional[Dict[str, Dict[str, Any]]] = None) -> ParseResult:
+    """Final required-field check and validation"""
+    # Final check to ensure required fields are present after VLM extraction
+    if not all(name in dyn.fields for name in REQUIRED_FIELDS):
+        return ParseResult(success=False, error="Could not parse all required fields")
+    
+    # Include both line 11 and line 14 validation results, requiring both to be valid
+    # Can absolutely change to just validating line 11 calculation
+    with stage("validation"):
+        is_valid = (Form1040DynamicFields.validate_line_11_totals(dyn) 
+                    and Form1040DynamicFields.validate_line_14_totals(dyn))
+
+    Form1040DynamicFields.add_field(dyn, "is_valid", is_valid)
+    
+    form_results = None
+    if forms is not None:
+        form_results = {form_type: FormResult.from_fields(form_type, lines) for form_type, lines in forms.items()}
+    return ParseResult(success=True, form=FormResult.from_fields(FORM_1040, dyn.fields, dyn.provenance),
+                       form_results=form_results)
+
+
+def parse_blocks(blocks: List[dict], document_bytes: Optional[Document] = None,
+                 vlm_extract: Optional[Callable[..., Dict[str, Any]]] = None) -> ParseResult:
+    """
+    Synchronous blocks -> fields -> validation pipeline, for batch and offline use
+    The VLM fallback only runs when both the document and a VLM function are given,
+    vlm_extract(document_bytes, fields, region) is asked only for the lines plan_vlm picks
+    """
+    dyn, forms = fields_from_blocks(blocks)
+    source = base_source(blocks)
+    plan = plan_vlm(dyn, blocks, vlm_router) if vlm_extract is not None and document_bytes is not None else None
+    if plan is not None:
+        try:
+            merge_vlm_fields(dyn, plan, vlm_extract(document_bytes, plan.fields, plan.region), source)
+        # If both VLM and Textract fail, build_response returns the error
+        except Exception:
+            Form1040DynamicFields.add_field(dyn, "source", source)
+    else:
+        Form1040DynamicFields.add_field(dyn, "source", source)
+    return build_response(dyn, forms)
@@ -0,0 +1,174 @@
+"""
+Record live Textract responses and replay stored ones through the parser
+
+Record mode (TEXTRACT_RECORD_DIR) writes every OCR'd document's blocks as
+gzip-compressed analyze_document JSON, one file per document hash.
+Replay runs a saved response, recorded or hand-picked like tests/fixtures,
+through the same extraction and validation as a live upload, with no AWS calls.
+
+Usage: python -m app.replay PATH [PATH ...] [--output OUT.ndjson]
+"""
+import argparse
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.results import ParseResult
+from app.pipeline import parse_blocks
+
+# Stored responses we know how to replay
+REPLAY_EXTENSIONS = (".json", ".json.gz")
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class ResponseTooLargeError(ValueError):
+    """A stored response bigger than allowed once decompressed"""
+
+
+def gunzip(payload: bytes, max_bytes: int = 0) -> bytes:
+    """
+    gzip.decompress that stops once the output passes max_bytes (0 means no limit),
+    so a small upload cannot inflate into gigabytes
+    """
+    output = bytearray()
+    while payload:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            output += decompressor.decompress(payload, max_bytes + 1 - len(output) if max_bytes else 0)
+        except zlib.error as e:
+            raise ValueError(f"Invalid gzip data: {e}") from None
+        if max_bytes and len(output) > max_bytes:
+            raise ResponseTooLargeError(f"Decompressed response is larger than the {max_bytes} byte limit")
+        if not decompressor.eof:
+            raise ValueError("Compressed response ended before the end-of-stream marker")
+        # Concatenated members, gzip padding with zeros is allowed between them
+        payload = decompressor.unused_data.lstrip(b"\x00")
+    return bytes(output)
+
+
+def decode_response(payload: bytes, max_bytes: int = 0) -> Dict[str, Any]:
+    """analyze_document JSON from plain or gzip-compressed bytes, at most max_bytes of it (0 means no limit)"""
+    if payload.startswith(GZIP_MAGIC):
+        payload = gunzip(payload, max_bytes)
+    elif max_bytes and len(payload) > max_bytes:
+        raise ResponseTooLargeError(f"Response is larger than the {max_bytes} byte limit")
+    return json.loads(payload)
+
+
+def load_response(path: Path) -> Dict[str, Any]:
+    """Read a stored analyze_document response, .json or .json.gz"""
+    return decode_response(Path(path).read_bytes())
+
+
+def replay_response(response: Dict[str, Any]) -> ParseResult:
+    """Run a stored analyze_document response through extraction and validation"""
+    return parse_blocks(response.get("Blocks", []))
+
+
+def replay_path(path: Path) -> ParseResult:
+    """replay_response for a file on disk"""
+    return replay_response(load_response(path))
+
+
+def iter_replay_paths(paths: List[Path]) -> Iterator[Path]:
+    """Stored responses named directly or found under the given directories"""
+    for path in paths:
+        if path.is_dir():
+            for found in sorted(path.rglob("*")):
+                if found.name.lower().endswith(REPLAY_EXTENSIONS):
+                    yield found
+        else:
+            yield path
+
+
+class ResponseRecorder:
+    """Persists live Textract responses to disk so they can be replayed later"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseRecorder"]:
+        """Recorder for TEXTRACT_RECORD_DIR, or None when recording is off"""
+        directory = os.getenv("TEXTRACT_RECORD_DIR")
+        if not directory:
+            return None
+        return cls(directory)
+
+    def path_for(self, doc_hash: str) -> Path:
+        """Where a document's response lives, fanned out by hash prefix"""
+        return self.directory / doc_hash[:2] / f"{doc_hash}.json.gz"
+
+    def record(self, doc_hash: str, blocks: List[dict]) -> Optional[Path]:
+        """
+        Write blocks as an analyze_document response
+        Recording is best effort, a full disk must not fail the upload
+        """
+        path = self.path_for(doc_hash)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            payload = gzip.compress(json.dumps({"Blocks": blocks}, separators=(",", ":")).encode("utf-8"))
+            # Write then rename so a reader never sees a half-written file
+            with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+                tmp.write(payload)
+            os.replace(tmp.name, path)
+        except OSError:
+            with self._lock:
+                self.errors += 1
+            return None
+        with self._lock:
+            self.recorded += 1
+        return path
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"directory": str(self.directory), "recorded": self.recorded, "errors": self.errors}
+
+
+def replay_all(paths: List[Path]) -> Iterator[Tuple[Path, ParseResult]]:
+    """Replay every stored response, a broken file is reported rather than raised"""
+    for path in iter_replay_paths(paths):
+        try:
+            response = replay_path(path)
+        except Exception as e:
+            response = ParseResult(success=False, error=f"{type(e).__name__}: {e}")
+        yield path, response
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Replay stored Textract responses through the parser")
+    parser.add_argument("paths", type=Path, nargs="+", help="response files or directories of them")
+    parser.add_argument("--output", type=Path, default=None, help="write one NDJSON result per document")
+    args = parser.parse_args(argv)
+
+    counts = {"documents": 0, "succeeded": 0, "failed": 0}
+    start = time.perf_counter()
+    out = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        for path, response in replay_all(args.paths):
+            counts["documents"] += 1
+            counts["succeeded" if response.success else "failed"] += 1
+            if out is not None:
+                out.write(json.dumps({"path": str(path), **response.model_dump()}) + "\n")
+    finally:
+        if out is not None:
+            out.close()
+    seconds = time.perf_counter() - start
+    counts["seconds"] = round(seconds, 3)
+    counts["documents_per_second"] = round(counts["documents"] / seconds, 1) if seconds else 0.0
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Typed parse results and their JSON encoding
+
+The pipeline still works on Form1040DynamicFields while it extracts, but what
+it hands back is a ParseResult: slotted, one FormResult per form with a slot
+for every line the form's rules know (anything else goes to extra), and a
+LineValue per line carrying where the value came from and how sure Textract
+was. Nothing here is validated again on the way out, the values were checked
+when they were extracted.
+
+encode_result writes the exact bytes FastAPI's JSONResponse wrote for the old
+ParseResponse ({"success", "fields", "error", "source", "forms"}, lines in the
+order they were found, "source" and "is_valid" last), through orjson when it is
+installed and the standard library otherwise. Provenance and confidence are not
+part of that shape, they are there for batch and internal consumers.
+"""
+import json
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, FrozenSet, List, Optional
+
+from app.forms import FORMS
+from app.pages import FORM_1040
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt, json gives the same bytes
+    orjson = None
+
+
+class Source(str, Enum):
+    """Where a document's fields (or one line) came from, the value is what "source" has always said"""
+    TEXTRACT = "textract"
+    TEXT_LAYER = "text_layer"
+    VLM = "vlm"
+    TEXTRACT_VLM = "textract+vlm"
+    TEXT_LAYER_VLM = "text_layer+vlm"
+    # Per line only
+    SPATIAL = "spatial"
+    DEFAULT = "default"
+
+
+@dataclass(slots=True)
+class LineValue:
+    value: Any
+    source: Optional[Source] = None
+    # Textract's confidence (0-100) in the key/value pair the line was read from
+    confidence: Optional[float] = None
+
+
+class FormResult:
+    """
+    Lines of one form, in the order they were found
+    form_result_type() subclasses this per registered form with a slot per known line
+    """
+    __slots__ = ("form_type", "order", "extra", "source", "is_valid")
+    known: FrozenSet[str] = frozenset()
+
+    def __init__(self, form_type: str, source: Optional[Source] = None, is_valid: Optional[bool] = None):
+        self.form_type = form_type
+        self.order: List[str] = []
+        self.extra: Dict[str, LineValue] = {}
+        self.source = source
+        self.is_valid = is_valid
+
+    def get(self, name: str) -> Optional[LineValue]:
+        if name in self.known:
+            return getattr(self, name, None)
+        return self.extra.get(name)
+
+    def set(self, name: str, value: Any, source: Optional[Source] = None, confidence: Optional[float] = None) -> None:
+        line = LineValue(value, source, confidence)
+        if name in self.known:
+            if getattr(self, name, None) is None:
+                self.order.append(name)
+            setattr(self, name, line)
+        else:
+            if name not in self.extra:
+                self.order.append(name)
+            self.extra[name] = line
+
+    def lines(self) -> Dict[str, LineValue]:
+        return {name: self.get(name) for name in self.order}
+
+    def to_fields(self) -> Dict[str, Any]:
+        """The untyped {"line_9": 280300.0, ..., "source": ..., "is_valid": ...} dict clients get"""
+        fields = {name: self.get(name).value for name in self.order}
+        if self.source is not None:
+            fields["source"] = self.source.value
+        if self.is_valid is not None:
+            fields["is_valid"] = self.is_valid
+        return fields
+
+    @classmethod
+    def from_fields(cls, form_type: str, fields: Dict[str, Any],
+                    provenance: Optional[Dict[str, Any]] = None) -> "FormResult":
+        """Typed result for an untyped fields dict, provenance is {line: (Source, confidence)}"""
+        result = form_result_type(form_type)(form_type)
+        provenance = provenance or {}
+        # Same as calling set() per line, but this runs for every response
+        known, order, extra = result.known, result.order, result.extra
+        for name, value in fields.items():
+            if name == "source":
+                result.source = value if isinstance(value, Source) else Source(value)
+            elif name == "is_valid":
+                result.is_valid = value
+            else:
+                line = LineValue(value, *provenance.get(name, ()))
+                if name in known:
+                    setattr(result, name, line)
+                else:
+                    extra[name] = line
+                order.append(name)
+        return result
+
+
+_result_types: Dict[str, type] = {}
+
+
+def form_result_type(form_type: str) -> type:
+    """FormResult subclass with a slot per line the form's rules extract, built on first use"""
+    result_type = _result_types.get(form_type)
+    if result_type is None:
+        spec = FORMS.get(form_type)
+        known = tuple(dict.fromkeys(rule.field for rule in spec.rules)) if spec is not None else ()
+        name = "".join(part.capitalize() for part in form_type.replace("-", "_").split("_")) + "Result"
+        result_type = type(name, (FormResult,), {"__slots__": known, "known": frozenset(known)})
+        # Losing a race just builds an identical class twice
+        result_type = _result_types.setdefault(form_type, result_type)
+    return result_type
+
+
+@dataclass(slots=True)
+class ParseResult:
+    """
+    Result of parsing one document, form is the 1040 and forms every form of a multi-page return
+    Reads like ParseResponse (success, fields, error, source, forms, model_dump) for existing callers
+    """
+    success: bool
+    form: Optional[FormResult] = None
+    error: Optional[str] = None
+    source: Optional[str] = None
+    form_results: Optional[Dict[str, FormResult]] = None
+
+    @property
+    def fields(self) -> Optional[Dict[str, Any]]:
+        return self.form.to_fields() if self.form is not None else None
+
+    @property
+    def forms(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        if self.form_results is None:
+            return None
+        return {form_type: result.to_fields() for form_type, result in self.form_results.items()}
+
+    def model_dump(self) -> Dict[str, Any]:
+        return {"success": self.success, "fields": self.fields, "error": self.error,
+                "source": self.source, "forms": self.forms}
+
+    @classmethod
+    def from_dict(cls, content: Dict[str, Any]) -> "ParseResult":
+        """Back from model_dump(), e.g. a cached result"""
+        fields, forms = content.get("fields"), content.get("forms")
+        return cls(
+            success=content["success"],
+            form=FormResult.from_fields(FORM_1040, fields) if fields is not None else None,
+            error=content.get("error"),
+            source=content.get("source"),
+            form_results=({form_type: FormResult.from_fields(form_type, lines) for form_type, lines in forms.items()}
+                          if forms is not None else None),
+        )
+
+
+def encode_result(result: Any) -> bytes:
+    """JSON bytes for a ParseResult, ParseResponse or plain dict, same bytes JSONResponse would write"""
+    content = result if isinstance(result, dict) else result.model_dump()
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,249 @@
+"""
+Per-field VLM fallback routing
+
+Instead of sending the whole page to the VLM whenever a required line is missing
+and overwriting every line, plan_vlm asks only for the missing lines plus the
+lines of any failed total check, and points the VLM at the band of the page
+those lines sit in. VlmRouter keeps recent outcomes per form version and layout
+and picks whichever route (narrowed "partial" or whole-page "full") has been
+accurate for the fewest tokens.
+"""
+import os
+import random
+import re
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.models import Form1040DynamicFields
+from app.pages import form_version, group_blocks_by_page
+from app.results import Source
+from app.text_layer import is_text_layer
+
+# Lines the VLM prompt asks for
+VLM_FIELDS = ("line_9", "line_10", "line_11", "line_12", "line_13", "line_14")
+# Lines that must be present for a successful parse
+REQUIRED_FIELDS = ("line_9", "line_10", "line_11")
+# A failed total check re-asks every line it covers
+VALIDATION_GROUPS = (
+    (("line_9", "line_10", "line_11"), Form1040DynamicFields.validate_line_11_totals),
+    (("line_12", "line_13", "line_14"), Form1040DynamicFields.validate_line_14_totals),
+)
+
+PARTIAL_ROUTE = "partial"
+FULL_ROUTE = "full"
+ROUTES = (PARTIAL_ROUTE, FULL_ROUTE)
+
+# Printed row label on the form, e.g. "12 Standard deduction or itemized..."
+row_label_regex = re.compile(r"^(\d{1,2})\s+[A-Za-z]")
+
+# Normalized page coordinates, (left, top, width, height)
+Region = Tuple[float, float, float, float]
+# Extra page height kept above and below the rows we ask for
+REGION_MARGIN = 0.02
+
+
+@dataclass
+class VlmPlan:
+    """What to ask the VLM for and how"""
+    fields: Tuple[str, ...]
+    region: Optional[Region]
+    route: str
+    route_key: str
+
+
+def _failed_groups(dyn: Form1040DynamicFields) -> List[Tuple[str, ...]]:
+    """Lines of every total check that has all its inputs yet does not add up"""
+    failed = []
+    for group, validate in VALIDATION_GROUPS:
+        if all(name in dyn.fields for name in group) and not validate(dyn):
+            failed.append(group)
+    return failed
+
+
+def fields_to_ask(dyn: Form1040DynamicFields, recheck_invalid: bool = True) -> Tuple[str, ...]:
+    """
+    Lines to ask the VLM for, empty when it is not needed
+    The VLM is needed when a required line is missing, or (with recheck_invalid)
+    when a total check fails; then it is asked for every missing line plus the
+    lines of the failed checks
+    """
+    missing_required = any(name not in dyn.fields for name in REQUIRED_FIELDS)
+    failed = _failed_groups(dyn) if recheck_invalid else []
+    if not missing_required and not failed:
+        return ()
+    wanted = {name for name in VLM_FIELDS if name not in dyn.fields}
+    for group in failed:
+        wanted.update(group)
+    return tuple(name for name in VLM_FIELDS if name in wanted)
+
+
+def region_for_fields(blocks: List[dict], fields: Tuple[str, ...]) -> Optional[Region]:
+    """
+    Full-width band of page 1 covering the printed rows of the requested lines and their
+    neighbours (so a missing row is bracketed by the rows around it), None if not located
+    """
+    if not blocks or is_text_layer(blocks):
+        return None
+    numbers = {int(name.split("_")[1]) for name in fields}
+    wanted = numbers | {n - 1 for n in numbers} | {n + 1 for n in numbers}
+    tops, bottoms = [], []
+    for block in group_blocks_by_page(blocks).get(1, []):
+        if block.get("BlockType") != "LINE":
+            continue
+        label = row_label_regex.match(block.get("Text", ""))
+        box = block.get("Geometry", {}).get("BoundingBox")
+        if label is None or box is None or int(label.group(1)) not in wanted:
+            continue
+        tops.append(box["Top"])
+        bottoms.append(box["Top"] + box["Height"])
+    if not tops:
+        return None
+    top = max(0.0, min(tops) - REGION_MARGIN)
+    bottom = min(1.0, max(bottoms) + REGION_MARGIN)
+    return (0.0, top, 1.0, bottom - top)
+
+
+def route_key(blocks: List[dict]) -> str:
+    """Routing stats bucket: form version plus layout (embedded text layer vs OCR)"""
+    layout = "text_layer" if is_text_layer(blocks) else "ocr"
+    return f"{form_version(blocks)}:{layout}"
+
+
+@dataclass
+class Outcome:
+    success: bool
+    tokens: Optional[int]
+    seconds: float
+
+
+class VlmRouter:
+    """Chooses between the narrowed and whole-page VLM routes from recent outcomes"""
+
+    def __init__(self, window: int = 50, min_samples: int = 10, explore: float = 0.05,
+                 accuracy_margin: float = 0.05, rng: Optional[random.Random] = None):
+        self.window = window
+        self.min_samples = min_samples
+        self.explore = explore
+        self.accuracy_margin = accuracy_margin
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._outcomes: Dict[Tuple[str, str], Deque[Outcome]] = {}
+
+    @classmethod
+    def from_env(cls) -> "VlmRouter":
+        """Read VLM_ROUTER_WINDOW, VLM_ROUTER_MIN_SAMPLES, VLM_ROUTER_EXPLORE, VLM_ROUTER_ACCURACY_MARGIN"""
+        return cls(
+            window=int(os.getenv("VLM_ROUTER_WINDOW", "50")),
+            min_samples=int(os.getenv("VLM_ROUTER_MIN_SAMPLES", "10")),
+            explore=float(os.getenv("VLM_ROUTER_EXPLORE", "0.05")),
+            accuracy_margin=float(os.getenv("VLM_ROUTER_ACCURACY_MARGIN", "0.05")),
+        )
+
+    def _summary(self, key: str, route: str) -> Optional[Dict[str, Any]]:
+        outcomes = self._outcomes.get((key, route))
+        if not outcomes:
+            return None
+        tokens = [o.tokens for o in outcomes if o.tokens is not None]
+        return {
+            "samples": len(outcomes),
+            "success_rate": sum(o.success for o in outcomes) / len(outcomes),
+            "mean_tokens": sum(tokens) / len(tokens) if tokens else None,
+            "mean_seconds": sum(o.seconds for o in outcomes) / len(outcomes),
+        }
+
+    def choose(self, key: str) -> str:
+        """
+        Narrowed route until it has a track record, the whole page while gathering a
+        comparison if the narrowed one is not reliably accurate, then the cheapest
+        route whose success rate is within accuracy_margin of the best.
+        A small share of calls explores the other route
+        """
+        if self.rng.random() < self.explore:
+            return self.rng.choice(ROUTES)
+        with self._lock:
+            partial, full = (self._summary(key, route) for route in ROUTES)
+        if partial is None or partial["samples"] < self.min_samples:
+            return PARTIAL_ROUTE
+        if full is None or full["samples"] < self.min_samples:
+            return PARTIAL_ROUTE if partial["success_rate"] >= 1 - self.accuracy_margin else FULL_ROUTE
+
+        summaries = {PARTIAL_ROUTE: partial, FULL_ROUTE: full}
+        best_rate = max(partial["success_rate"], full["success_rate"])
+        eligible = [route for route in ROUTES if summaries[route]["success_rate"] >= best_rate - self.accuracy_margin]
+
+        def cost(route: str) -> Tuple[float, float]:
+            summary = summaries[route]
+            tokens = summary["mean_tokens"] if summary["mean_tokens"] is not None else float("inf")
+            return (tokens, summary["mean_seconds"])
+
+        return min(eligible, key=cost)
+
+    def record(self, key: str, route: str, success: bool, tokens: Optional[int], seconds: float) -> None:
+        with self._lock:
+            outcomes = self._outcomes.setdefault((key, route), deque(maxlen=self.window))
+            outcomes.append(Outcome(success, tokens, seconds))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """{route key: {route: summary}} for /routing/stats"""
+        with self._lock:
+            keys = sorted({key for key, _ in self._outcomes})
+            return {key: {route: s for route in ROUTES if (s := self._summary(key, route))} for key in keys}
+
+
+def plan_vlm(dyn: Form1040DynamicFields, blocks: List[dict], router: VlmRouter) -> Optional[VlmPlan]:
+    """Decide whether to call the VLM, for which lines, and on which part of the page"""
+    fields = fields_to_ask(dyn, recheck_invalid=os.getenv("VLM_RECHECK_INVALID", "true").lower() == "true")
+    if not fields:
+        return None
+    key = route_key(blocks)
+    # Textract read none of the required lines, so there is no narrower question to ask
+    if not any(name in dyn.fields for name in REQUIRED_FIELDS):
+        return VlmPlan(fields=VLM_FIELDS, region=None, route=FULL_ROUTE, route_key=key)
+    route = router.choose(key)
+    if route == FULL_ROUTE:
+        return VlmPlan(fields=fields, region=None, route=FULL_ROUTE, route_key=key)
+    return VlmPlan(fields=fields, region=region_for_fields(blocks, fields), route=PARTIAL_ROUTE, route_key=key)
+
+
+def merge_vlm_fields(dyn: Form1040DynamicFields, plan: VlmPlan, vlm_data: Dict[str, Any], base_source: Source) -> None:
+    """
+    Fill the planned lines from the VLM, leaving everything Textract got right alone
+    Lines of a failed total check are only replaced if the VLM's values add up
+    """
+    original = dict(dyn.fields)
+    original_provenance = dict(dyn.provenance)
+    for name in plan.fields:
+        value = vlm_data.get(name)
+        # Ensures VLM output is numeric
+        if value is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+            Form1040DynamicFields.add_field(dyn, name, float(value), Source.VLM)
+    for group, validate in VALIDATION_GROUPS:
+        if all(name in original for name in group) and not validate(dyn):
+            for name in group:
+                Form1040DynamicFields.add_field(dyn, name, original[name])
+                if name in original_provenance:
+                    dyn.provenance[name] = original_provenance[name]
+                else:
+                    dyn.provenance.pop(name, None)
+
+    from_vlm = {name for name in plan.fields
+                if name in dyn.fields and (name not in original or dyn.fields[name] != original[name])}
+    if all(name in from_vlm for name in REQUIRED_FIELDS):
+        source = Source.VLM
+    elif from_vlm:
+        source = Source.TEXT_LAYER_VLM if base_source == Source.TEXT_LAYER else Source.TEXTRACT_VLM
+    else:
+        source = base_source
+    Form1040DynamicFields.add_field(dyn, "source", source)
+
+
+def is_success(dyn: Form1040DynamicFields) -> bool:
+    """Every required line present and every total check passing"""
+    return (all(name in dyn.fields for name in REQUIRED_FIELDS)
+            and all(validate(dyn) for _, validate in VALIDATION_GROUPS))
+
+
+# Shared across requests, for /routing/stats
+vlm_router = VlmRouter.from_env()
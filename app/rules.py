@@ -0,0 +1,245 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+
+@dataclass(frozen=True)
+class FieldRule:
+    """
+    Declarative matching rule for one form line
+    A key matches when it carries the line number (at the start, at the end,
+    or as "line N") and contains every token of at least one token set,
+    or when it contains any of the alternate phrases anywhere
+    """
+    field: str
+    # Printed line (or box) number, e.g. 9 or "5a"
+    line: Union[int, str]
+    token_sets: Tuple[Tuple[str, ...], ...] = ((),)
+    phrases: Tuple[str, ...] = ()
+    # Value used when the key is found but blank, and when it is never found
+    default_if_blank: Optional[float] = None
+
+
+# Order matters, first matching rule wins just like the original if-chain
+FORM_1040_RULES: Tuple[FieldRule, ...] = (
+    FieldRule("line_9", 9, token_sets=(("total", "income"),), phrases=("9 add lines",)),
+    FieldRule("line_10", 10, token_sets=(("adjustment",),)),
+    FieldRule("line_11", 11, token_sets=(("adjusted", "gross", "income"), ("subtract",))),
+    FieldRule("line_12", 12, token_sets=(("deduction", "standard"), ("deduction", "itemized"))),
+    # Seemingly commonly left empty, filling with 0.0 if found but empty
+    FieldRule("line_13", 13, token_sets=(("qualified", "deduction"),), default_if_blank=0.0),
+    FieldRule("line_14", 14, token_sets=(("total", "deductions"),), phrases=("14 add lines",)),
+)
+
+
+class CompiledRules:
+    """
+    Rule table compiled once into a line-number index and a combined phrase regex
+    Classifying a key splits it once and only checks rules for the line
+    numbers it actually carries, instead of running every rule against it
+    """
+
+    def __init__(self, rules: Tuple[FieldRule, ...]):
+        self.rules = rules
+        # Line number text -> [(position in table, rule)]
+        self.by_line: Dict[str, List[Tuple[int, FieldRule]]] = {}
+        # Phrase -> [(position in table, rule)]
+        self.by_phrase: Dict[str, List[Tuple[int, FieldRule]]] = {}
+        for position, rule in enumerate(rules):
+            self.by_line.setdefault(str(rule.line), []).append((position, rule))
+            for phrase in rule.phrases:
+                self.by_phrase.setdefault(phrase, []).append((position, rule))
+        # One scan tells us whether any phrase occurs at all, which is rare
+        self.phrase_regex = (
+            re.compile("|".join(re.escape(p) for p in self.by_phrase)) if self.by_phrase else None
+        )
+        self.defaults = tuple(
+            (rule.field, rule.default_if_blank) for rule in rules if rule.default_if_blank is not None
+        )
+
+    def match(self, key_text: str) -> List[FieldRule]:
+        """Return every rule matching this key, in table order"""
+        key_text = key_text.strip().lower()
+        # Same whole-word semantics as the padded " {n} " checks in is_line_match
+        padded = " " + key_text + " "
+        tokens = key_text.split(" ")
+        line_numbers = {tokens[0], tokens[-1]}
+        # Textract often reads "5a" as "5 a"
+        if len(tokens) > 1 and len(tokens[1]) == 1 and tokens[1].isalpha():
+            line_numbers.add(tokens[0] + tokens[1])
+        for i in range(len(tokens) - 1):
+            if tokens[i] == "line":
+                line_numbers.add(tokens[i + 1])
+
+        matched: Dict[int, FieldRule] = {}
+        for number in line_numbers:
+            for position, rule in self.by_line.get(number, ()):
+                if any(all(token in padded for token in token_set) for token_set in rule.token_sets):
+                    matched[position] = rule
+        if self.phrase_regex is not None and self.phrase_regex.search(key_text):
+            # Phrases can overlap, so check each one once we know something is there
+            for phrase, entries in self.by_phrase.items():
+                if phrase in key_text:
+                    for position, rule in entries:
+                        matched[position] = rule
+        return [matched[position] for position in sorted(matched)]
+
+
+# Every return has a 1040, so its table is compiled once at import,
+# the other forms' tables are compiled on first use by app.forms
+COMPILED_1040_RULES = CompiledRules(FORM_1040_RULES)
+
+
+@dataclass(frozen=True)
+class CrossCheck:
+    """
+    Arithmetic check between form lines: target == sum(factor * line for line, factor in terms)
+    Lines in blank_as_zero count as 0.0 when missing, any other missing line fails the check
+    """
+    name: str
+    target: str
+    terms: Tuple[Tuple[str, float], ...]
+    blank_as_zero: Tuple[str, ...] = ()
+    tolerance: float = 0.01
+
+    @property
+    def lines(self) -> Tuple[str, ...]:
+        return (self.target,) + tuple(line for line, _ in self.terms)
+
+    def describe(self) -> str:
+        """e.g. "line_11 = line_9 - line_10" or "box_4 = 0.062 * box_3" """
+        parts = []
+        for line, factor in self.terms:
+            weight = "" if abs(factor) == 1 else f"{abs(factor):g} * "
+            parts.append(f"{'-' if factor < 0 else '+'} {weight}{line}")
+        return f"{self.target} = " + " ".join(parts).lstrip("+ ")
+
+    def passes(self, fields: Dict[str, Any]) -> bool:
+        """Evaluate the check for one document's fields"""
+        target = fields.get(self.target)
+        if target is None:
+            return False
+        expected = 0.0
+        for line, factor in self.terms:
+            value = fields.get(line)
+            if value is None:
+                if line not in self.blank_as_zero:
+                    return False
+                value = 0.0
+            expected += factor * value
+        return abs(target - expected) < self.tolerance
+
+
+# Form1040DynamicFields.validate_line_11_totals / validate_line_14_totals run these,
+# the columnar batch checks run the whole tuple, add new ones here
+LINE_11_TOTALS = CrossCheck("line_11_totals", "line_11", (("line_9", 1), ("line_10", -1)))
+LINE_14_TOTALS = CrossCheck("line_14_totals", "line_14", (("line_12", 1), ("line_13", 1)),
+                            blank_as_zero=("line_12", "line_13"))
+FORM_1040_CROSS_CHECKS: Tuple[CrossCheck, ...] = (LINE_11_TOTALS, LINE_14_TOTALS)
+
+
+def line_sum(name: str, target: str, lines: Tuple[str, ...]) -> CrossCheck:
+    """target == sum of lines, the usual "Add lines ..." check, blank lines count as 0.0"""
+    return CrossCheck(name, target, tuple((line, 1) for line in lines), blank_as_zero=lines)
+
+
+# Schedule 1 (Form 1040), Additional Income and Adjustments to Income
+SCHEDULE_1_RULES: Tuple[FieldRule, ...] = (
+    FieldRule("line_1", 1, token_sets=(("taxable", "refunds"),)),
+    FieldRule("line_2a", "2a", token_sets=(("alimony",),)),
+    FieldRule("line_3", 3, token_sets=(("business", "income"),)),
+    FieldRule("line_4", 4, token_sets=(("other", "gains"),)),
+    FieldRule("line_5", 5, token_sets=(("rental", "real", "estate"),)),
+    FieldRule("line_6", 6, token_sets=(("farm", "income"),)),
+    FieldRule("line_7", 7, token_sets=(("unemployment",),)),
+    FieldRule("line_9", 9, token_sets=(("total", "other", "income"),)),
+    FieldRule("line_10", 10, token_sets=(("combine", "lines"),), phrases=("this is your additional income",)),
+    FieldRule("line_11", 11, token_sets=(("educator",),)),
+    FieldRule("line_15", 15, token_sets=(("self-employment", "tax"),)),
+    FieldRule("line_16", 16, token_sets=(("qualified", "plans"),)),
+    FieldRule("line_17", 17, token_sets=(("health", "insurance"),)),
+    FieldRule("line_20", 20, token_sets=(("ira", "deduction"),)),
+    FieldRule("line_21", 21, token_sets=(("student", "loan"),)),
+    FieldRule("line_25", 25, token_sets=(("total", "other", "adjustments"),)),
+    FieldRule("line_26", 26, token_sets=(("adjustments", "income"), ("add", "lines", "11"))),
+)
+
+SCHEDULE_1_CROSS_CHECKS: Tuple[CrossCheck, ...] = (
+    line_sum("line_10_totals", "line_10",
+             ("line_1", "line_2a", "line_3", "line_4", "line_5", "line_6", "line_7", "line_9")),
+    line_sum("line_26_totals", "line_26",
+             ("line_11", "line_12", "line_13", "line_14", "line_15", "line_16", "line_17", "line_18",
+              "line_19a", "line_20", "line_21", "line_23", "line_25")),
+)
+
+# Schedule A (Form 1040), Itemized Deductions
+SCHEDULE_A_RULES: Tuple[FieldRule, ...] = (
+    FieldRule("line_1", 1, token_sets=(("medical", "dental"),)),
+    FieldRule("line_2", 2, token_sets=(("amount", "1040"),)),
+    FieldRule("line_3", 3, token_sets=(("multiply", "line 2"),)),
+    FieldRule("line_4", 4, token_sets=(("subtract", "line 3"),)),
+    FieldRule("line_5a", "5a", token_sets=(("income", "taxes"), ("sales", "taxes"))),
+    FieldRule("line_5b", "5b", token_sets=(("real", "estate"),)),
+    FieldRule("line_5c", "5c", token_sets=(("personal", "property"),)),
+    FieldRule("line_5d", "5d", token_sets=(("add", "lines", "5a"),)),
+    FieldRule("line_5e", "5e", token_sets=(("smaller",),)),
+    FieldRule("line_6", 6, token_sets=(("other", "taxes"),), default_if_blank=0.0),
+    FieldRule("line_7", 7, token_sets=(("add", "lines", "5e"),)),
+    FieldRule("line_8a", "8a", token_sets=(("mortgage", "interest"),)),
+    FieldRule("line_8e", "8e", token_sets=(("add", "lines", "8a"),)),
+    FieldRule("line_9", 9, token_sets=(("investment", "interest"),), default_if_blank=0.0),
+    FieldRule("line_10", 10, token_sets=(("add", "lines", "8e"),)),
+    FieldRule("line_11", 11, token_sets=(("cash", "check"),)),
+    FieldRule("line_12", 12, token_sets=(("other", "than", "cash"),)),
+    FieldRule("line_13", 13, token_sets=(("carryover",),), default_if_blank=0.0),
+    FieldRule("line_14", 14, token_sets=(("add", "lines", "11"),)),
+    FieldRule("line_15", 15, token_sets=(("casualty",),)),
+    FieldRule("line_16", 16, token_sets=(("other",),)),
+    FieldRule("line_17", 17, token_sets=(("add", "amounts"), ("itemized", "deductions"))),
+)
+
+SCHEDULE_A_CROSS_CHECKS: Tuple[CrossCheck, ...] = (
+    line_sum("line_5d_totals", "line_5d", ("line_5a", "line_5b", "line_5c")),
+    line_sum("line_7_totals", "line_7", ("line_5e", "line_6")),
+    line_sum("line_10_totals", "line_10", ("line_8e", "line_9")),
+    line_sum("line_14_totals", "line_14", ("line_11", "line_12", "line_13")),
+    line_sum("line_17_totals", "line_17", ("line_4", "line_7", "line_10", "line_14", "line_15", "line_16")),
+)
+
+# Schedule B (Form 1040), Interest and Ordinary Dividends
+# Lines 1 and 5 are one row per payer, keyed by the payer's name, so only the totals have rules
+SCHEDULE_B_RULES: Tuple[FieldRule, ...] = (
+    FieldRule("line_2", 2, token_sets=(("add", "amounts"),)),
+    # Seemingly commonly left empty, same as 1040 line 13
+    FieldRule("line_3", 3, token_sets=(("excludable",), ("8815",)), default_if_blank=0.0),
+    FieldRule("line_4", 4, token_sets=(("subtract", "line 3"),)),
+    FieldRule("line_6", 6, token_sets=(("add", "amounts"),)),
+)
+
+SCHEDULE_B_CROSS_CHECKS: Tuple[CrossCheck, ...] = (
+    CrossCheck("line_4_totals", "line_4", (("line_2", 1), ("line_3", -1)), blank_as_zero=("line_3",)),
+)
+
+# Form W-2, Wage and Tax Statement, numbered boxes rather than lines
+FORM_W2_RULES: Tuple[FieldRule, ...] = (
+    # Box captions are often read without their number, the phrases catch those
+    FieldRule("box_1", 1, token_sets=(("wages", "tips"),), phrases=("wages, tips, other compensation",)),
+    FieldRule("box_2", 2, token_sets=(("federal", "income", "tax"),), phrases=("federal income tax withheld",)),
+    FieldRule("box_3", 3, token_sets=(("social", "security", "wages"),), phrases=("social security wages",)),
+    FieldRule("box_4", 4, token_sets=(("social", "security", "tax"),), phrases=("social security tax withheld",)),
+    FieldRule("box_5", 5, token_sets=(("medicare", "wages"),), phrases=("medicare wages and tips",)),
+    FieldRule("box_6", 6, token_sets=(("medicare", "tax"),), phrases=("medicare tax withheld",)),
+    FieldRule("box_7", 7, token_sets=(("social", "security", "tips"),)),
+    FieldRule("box_8", 8, token_sets=(("allocated", "tips"),)),
+    FieldRule("box_10", 10, token_sets=(("dependent", "care"),)),
+    FieldRule("box_11", 11, token_sets=(("nonqualified", "plans"),)),
+    FieldRule("box_16", 16, token_sets=(("state", "wages"),)),
+    FieldRule("box_17", 17, token_sets=(("state", "income", "tax"),)),
+    FieldRule("box_18", 18, token_sets=(("local", "wages"),)),
+    FieldRule("box_19", 19, token_sets=(("local", "income", "tax"),)),
+)
+
+FORM_W2_CROSS_CHECKS: Tuple[CrossCheck, ...] = (
+    # Social security tax is a flat 6.2% of box 3 (already capped at the wage base), rounding allowed
+    CrossCheck("box_4_rate", "box_4", (("box_3", 0.062),), tolerance=1.0),
+)
@@ -0,0 +1,283 @@
+"""
+Geometry-aware 1040 line extraction
+
+Textract's FORMS key/value pairs miss a row now and then (no KEY_VALUE_SET for
+it, or a key whose text never mentions the line number), and every miss used to
+mean a VLM call. The amount is usually still on the page as a LINE block, and a
+1040 has a fixed layout: row label on the left, the line number repeated in a
+narrow column, the amount box to the right of it.
+
+SpatialIndex buckets blocks into a uniform grid over the page so a nearest
+neighbour lookup only visits the few cells around a point. AnchorTemplates
+remembers, per form revision, where the line-number column, the amount column
+and each row sat on earlier pages, so a row whose printed number OCR missed can
+still be found (shifted by however far this scan is offset from the last ones).
+"""
+import math
+import os
+import threading
+from dataclasses import dataclass, field
+from statistics import median
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from app.models import Form1040DynamicFields
+from app.pages import page_version
+from app.results import Source
+from app.routing import VALIDATION_GROUPS, VLM_FIELDS, fields_to_ask, row_label_regex
+from app.text_layer import is_text_layer
+
+# Grid cell size in normalized page units, a 1040 row is about 0.015 tall
+CELL_SIZE = 0.05
+# How far (page heights) an amount's center may sit from its row's center
+ROW_TOLERANCE = 0.006
+# Printed line numbers in the narrow column left of the amount boxes are right of this
+NUMBER_COLUMN_MIN_X = 0.5
+# Weight of each new page in the running template positions
+TEMPLATE_ALPHA = 0.2
+
+
+class Box(NamedTuple):
+    """A LINE block's text and normalized bounding box"""
+    text: str
+    left: float
+    top: float
+    right: float
+    bottom: float
+
+    @property
+    def center_x(self) -> float:
+        return (self.left + self.right) / 2
+
+    @property
+    def center_y(self) -> float:
+        return (self.top + self.bottom) / 2
+
+
+def block_box(block: dict) -> Optional[Box]:
+    box = block.get("Geometry", {}).get("BoundingBox")
+    if box is None:
+        return None
+    return Box(block.get("Text", ""), box["Left"], box["Top"], box["Left"] + box["Width"], box["Top"] + box["Height"])
+
+
+def parse_amount(text: str) -> Optional[float]:
+    """Amount box text like "280,300." or "9,631" as a number, None for anything else"""
+    cleaned = text.replace(",", "").replace("$", "").strip().rstrip(".")
+    if not cleaned or not any(c.isdigit() for c in cleaned):
+        return None
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+class SpatialIndex:
+    """Uniform grid over box centers, for nearest neighbour lookups on one page"""
+
+    def __init__(self, boxes: Iterable[Box], cell_size: float = CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], List[Box]] = {}
+        for box in boxes:
+            self.cells.setdefault(self._cell(box.center_x, box.center_y), []).append(box)
+        # Rings past the occupied cells cannot find anything
+        self.extent = max((max(abs(i), abs(j)) for i, j in self.cells), default=0) + 1
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def _ring(self, cx: int, cy: int, ring: int, rows: range) -> Iterable[Tuple[int, int]]:
+        """Cells at Chebyshev distance ring from (cx, cy), limited to the given grid rows"""
+        if ring == 0:
+            if cy in rows:
+                yield cx, cy
+            return
+        for j in range(max(cy - ring, rows.start), min(cy + ring, rows.stop - 1) + 1):
+            if abs(j - cy) == ring:
+                for i in range(cx - ring, cx + ring + 1):
+                    yield i, j
+            else:
+                yield cx - ring, j
+                yield cx + ring, j
+
+    def nearest(self, x: float, y: float, accept: Callable[[Box], bool] = lambda box: True,
+                max_distance: float = 0.25, max_dy: Optional[float] = None) -> Optional[Box]:
+        """
+        Accepted box whose center is closest to (x, y), searching outwards ring by ring
+        Stops once no cell further out can hold anything closer than the best so far.
+        max_dy limits the search to a horizontal band, e.g. one form row
+        """
+        cx, cy = self._cell(x, y)
+        band = max_dy if max_dy is not None else max_distance
+        rows = range(int((y - band) // self.cell_size), int((y + band) // self.cell_size) + 1)
+        best, best_distance = None, max_distance
+        max_ring = min(int(math.ceil(max_distance / self.cell_size)) + 1, self.extent + max(abs(cx), abs(cy)))
+        for ring in range(max_ring + 1):
+            # Every center in this ring is at least (ring - 1) cells away
+            if best is not None and (ring - 1) * self.cell_size > best_distance:
+                break
+            for cell in self._ring(cx, cy, ring, rows):
+                for box in self.cells.get(cell, ()):
+                    distance = math.hypot(box.center_x - x, box.center_y - y)
+                    if distance <= best_distance and accept(box):
+                        best, best_distance = box, distance
+        return best
+
+
+@dataclass
+class Template:
+    """Where one form revision puts its line-number column, amount column and rows"""
+    number_x: Optional[float] = None
+    amount_x: Optional[float] = None
+    rows: Dict[int, float] = field(default_factory=dict)
+    pages: int = 0
+
+
+def _blend(old: Optional[float], new: float) -> float:
+    return new if old is None else old + TEMPLATE_ALPHA * (new - old)
+
+
+class AnchorTemplates:
+    """Running per-revision templates, learned from every page the extractor locates rows on"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates: Dict[str, Template] = {}
+
+    def get(self, version: str) -> Optional[Template]:
+        with self._lock:
+            template = self._templates.get(version)
+            if template is None:
+                return None
+            return Template(template.number_x, template.amount_x, dict(template.rows), template.pages)
+
+    def learn(self, version: str, number_xs: List[float], amount_xs: List[float], rows: Dict[int, float]) -> None:
+        if not number_xs and not amount_xs and not rows:
+            return
+        with self._lock:
+            template = self._templates.setdefault(version, Template())
+            if number_xs:
+                template.number_x = _blend(template.number_x, median(number_xs))
+            if amount_xs:
+                template.amount_x = _blend(template.amount_x, median(amount_xs))
+            for line, y in rows.items():
+                template.rows[line] = _blend(template.rows.get(line), y)
+            template.pages += 1
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        with self._lock:
+            return {version: {"pages": t.pages, "number_x": t.number_x, "amount_x": t.amount_x,
+                              "rows": len(t.rows)}
+                    for version, t in self._templates.items()}
+
+
+def _row_anchors(boxes: List[Box], lines: Iterable[int],
+                 template: Optional[Template]) -> Tuple[Dict[int, Box], Dict[int, float]]:
+    """
+    ({line: printed line-number box}, {line: row center y}) for the lines that can be located
+    The number column is preferred, then the row label ("10 Adjustments to income...")
+    """
+    wanted = {str(line): line for line in lines}
+    numbers: Dict[int, List[Box]] = {}
+    labels: Dict[int, Box] = {}
+    for box in boxes:
+        text = box.text.strip()
+        if text in wanted and box.center_x > NUMBER_COLUMN_MIN_X:
+            numbers.setdefault(wanted[text], []).append(box)
+            continue
+        label = row_label_regex.match(text)
+        if label is not None and label.group(1) in wanted and box.center_x < NUMBER_COLUMN_MIN_X:
+            labels.setdefault(wanted[label.group(1)], box)
+
+    number_boxes: Dict[int, Box] = {}
+    for line, candidates in numbers.items():
+        # The same digits can appear elsewhere in the right half, take the one in the learned column
+        target_x = template.number_x if template and template.number_x is not None else candidates[0].center_x
+        number_boxes[line] = min(candidates, key=lambda box: abs(box.center_x - target_x))
+    rows = {line: box.center_y for line, box in number_boxes.items()}
+    for line, box in labels.items():
+        rows.setdefault(line, box.center_y)
+
+    # Rows found on neither side come from the template, offset like the rows that were found
+    if template and template.rows:
+        offsets = [y - template.rows[line] for line, y in rows.items() if line in template.rows]
+        shift = median(offsets) if offsets else 0.0
+        for line in wanted.values():
+            if line not in rows and line in template.rows:
+                rows[line] = template.rows[line] + shift
+    return number_boxes, rows
+
+
+def extract_lines(blocks: List[dict], lines: Iterable[int] = range(9, 15),
+                  templates: Optional["AnchorTemplates"] = None) -> Dict[str, float]:
+    """
+    {"line_<n>": amount} for every requested 1040 line whose amount box can be located on page 1
+    Locating rows also updates the revision's template (pass templates=None to use the shared one)
+    """
+    templates = templates if templates is not None else anchor_templates
+    lines_on_page = [b for b in blocks if b.get("BlockType") == "LINE" and b.get("Page", 1) == 1]
+    boxes = [box for box in map(block_box, lines_on_page) if box is not None]
+    if not boxes:
+        return {}
+    version = page_version(lines_on_page)
+    template = templates.get(version)
+    number_boxes, rows = _row_anchors(boxes, lines, template)
+    index = SpatialIndex(boxes)
+
+    found: Dict[str, float] = {}
+    amount_xs: List[float] = []
+    for line, row_y in rows.items():
+        number_box = number_boxes.get(line)
+        # Amounts sit right of the number column, or right of the page middle if it was not read
+        min_x = number_box.right if number_box else (template.number_x if template and template.number_x
+                                                     else NUMBER_COLUMN_MIN_X)
+        if template and template.amount_x is not None:
+            target_x = template.amount_x
+        else:
+            # Nothing learned yet: first amount after the number column, else the rightmost one on the row
+            target_x = number_box.right if number_box else 1.0
+
+        def accept(box: Box) -> bool:
+            return (box.left >= min_x and abs(box.center_y - row_y) <= ROW_TOLERANCE
+                    and parse_amount(box.text) is not None)
+
+        amount_box = index.nearest(target_x, row_y, accept, max_distance=1.0, max_dy=ROW_TOLERANCE)
+        if amount_box is not None:
+            found[f"line_{line}"] = parse_amount(amount_box.text)
+            amount_xs.append(amount_box.center_x)
+
+    # Only rows anchored on this page itself teach the template, not ones it predicted
+    templates.learn(version, [box.center_x for box in number_boxes.values()], amount_xs,
+                    {line: box.center_y for line, box in number_boxes.items()})
+    return found
+
+
+def spatial_enabled() -> bool:
+    return os.getenv("SPATIAL_MATCHING_ENABLED", "true").lower() not in ("0", "false", "no")
+
+
+def fill_from_geometry(dyn: Form1040DynamicFields, blocks: List[dict]) -> None:
+    """
+    Fill lines the key/value matching missed from their position on the page
+    Lines of a total check that still does not add up (including defaulted blanks such as
+    line 13) are replaced only if the located amounts do add up
+    """
+    # Text-layer blocks carry no geometry
+    if not fields_to_ask(dyn) or is_text_layer(blocks):
+        return
+    # Every line, not just the ones asked for, a check may only fail once missing lines are filled
+    located = extract_lines(blocks, [int(name.split("_")[1]) for name in VLM_FIELDS])
+    for name in VLM_FIELDS:
+        if name not in dyn.fields and name in located:
+            Form1040DynamicFields.add_field(dyn, name, located[name], Source.SPATIAL)
+    for group, validate in VALIDATION_GROUPS:
+        if validate(dyn):
+            continue
+        candidate = Form1040DynamicFields(fields={**dyn.fields, **{n: located[n] for n in group if n in located}})
+        if validate(candidate):
+            for name in group:
+                Form1040DynamicFields.add_field(dyn, name, candidate.fields[name],
+                                                Source.SPATIAL if name in located else None)
+
+
+# Shared across requests
+anchor_templates = AnchorTemplates()
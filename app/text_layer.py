@@ -0,0 +1,162 @@
+import logging
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from app.documents import Document, document_stream, is_pdf
+from app.lazy import ensure_loaded, lazy_import
+
+# Loaded on the first PDF, see app.lazy
+pypdf = lazy_import("pypdf")
+
+# Normalize whitespace
+whitespace_regex = re.compile(r"\s+")
+# Dot leaders between a line's label and its amount box
+dot_leader_regex = re.compile(r"(?:\s*\.){2,}")
+# A single printed amount, e.g. "280,300." or "(1,250.00)"
+money_regex = re.compile(r"^\(?-?\$?\d{1,3}(?:,\d{3})*(?:\.\d*)?\)?$")
+# A run that starts with a line number, e.g. "9" or "12 Standard deduction"
+line_start_regex = re.compile(r"^\d{1,2}[a-z]?\b")
+
+# A label needs at least one real word, which rules out stray header digits like "20 24"
+word_regex = re.compile(r"[a-z]{2,}")
+
+# pypdf warns about every embedded font it cannot fully decode, the text we need is fine
+logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+# Marker on synthetic blocks, Textract never sets this key
+TEXT_LAYER_SOURCE = "text_layer"
+
+# Text runs whose baselines are this close (in points) are on the same row
+ROW_TOLERANCE = 0.75
+
+
+def _page_runs(page) -> List[Tuple[float, float, str]]:
+    """(x, y, text) for every non-empty text run on a page, in content order"""
+    runs: List[Tuple[float, float, str]] = []
+
+    def visitor(text, cm, tm, font_dict, font_size):
+        if text.strip():
+            x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+            y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+            runs.append((x, y, text))
+
+    page.extract_text(visitor_text=visitor)
+    return runs
+
+
+def _rows(runs: List[Tuple[float, float, str]]) -> List[List[Tuple[float, float, str]]]:
+    """Group runs into rows top to bottom, each row left to right"""
+    rows: List[List[Tuple[float, float, str]]] = []
+    # Stable sort keeps content order for runs pypdf reports at the same x
+    for run in sorted(runs, key=lambda r: -r[1]):
+        if rows and abs(rows[-1][-1][1] - run[1]) <= ROW_TOLERANCE:
+            rows[-1].append(run)
+        else:
+            rows.append([run])
+    return [sorted(row, key=lambda r: r[0]) for row in rows]
+
+
+def page_key_values(page) -> Tuple[str, Dict[str, str]]:
+    """
+    Read label/amount pairs straight from a page's text layer
+    Returns the page's leading text (for classification) and {key text: amount},
+    keys normalized the way textract_to_dict normalizes Textract keys
+    """
+    runs = _page_runs(page)
+    header = " ".join(text for _, _, text in runs[:20])
+    pairs: Dict[str, str] = {}
+    for row in _rows(runs):
+        if len(row) < 2:
+            continue
+        value = row[-1][2].strip()
+        if not money_regex.match(value):
+            continue
+        labels = [text for _, _, text in row[:-1]]
+        # Drop margin text that happens to share the row, the label starts at its line number
+        for i, text in enumerate(labels):
+            if line_start_regex.match(text.strip()):
+                labels = labels[i:]
+                break
+        key_text = dot_leader_regex.sub(" ", " ".join(labels))
+        key_text = whitespace_regex.sub(" ", key_text).strip().lower()
+        if not word_regex.search(key_text):
+            continue
+        # A blank amount box leaves the repeated line number as the last run
+        tokens = key_text.split(" ")
+        if value in (tokens[0], tokens[-1]):
+            continue
+        pairs.setdefault(key_text, value)
+    return header, pairs
+
+
+def key_values_to_blocks(page_number: int, header: str, pairs: Dict[str, str]) -> List[dict]:
+    """
+    Shape text-layer pairs like Textract output, so caching, page grouping and
+    textract_to_dict work on them unchanged
+    """
+    prefix = f"text-{page_number}"
+    blocks: List[dict] = [
+        {"BlockType": "LINE", "Id": f"{prefix}-header", "Text": header, "Page": page_number,
+         "Source": TEXT_LAYER_SOURCE}
+    ]
+    for i, (key_text, value_text) in enumerate(pairs.items()):
+        key_id, value_id = f"{prefix}-key-{i}", f"{prefix}-value-{i}"
+        blocks.extend([
+            {"BlockType": "KEY_VALUE_SET", "Id": key_id, "EntityTypes": ["KEY"], "Page": page_number,
+             "Relationships": [{"Type": "CHILD", "Ids": [f"{key_id}-word"]},
+                               {"Type": "VALUE", "Ids": [value_id]}]},
+            {"BlockType": "KEY_VALUE_SET", "Id": value_id, "EntityTypes": ["VALUE"], "Page": page_number,
+             "Relationships": [{"Type": "CHILD", "Ids": [f"{value_id}-word"]}]},
+            {"BlockType": "WORD", "Id": f"{key_id}-word", "Text": key_text, "Page": page_number},
+            {"BlockType": "WORD", "Id": f"{value_id}-word", "Text": value_text, "Page": page_number},
+        ])
+    return blocks
+
+
+def is_text_layer(blocks: List[dict]) -> bool:
+    """Whether blocks came from key_values_to_blocks rather than Textract"""
+    return bool(blocks) and blocks[0].get("Source") == TEXT_LAYER_SOURCE
+
+
+def text_layer_blocks(document_bytes: Document, page_numbers: List[int]) -> Optional[List[dict]]:
+    """Textract-shaped blocks from the embedded text layer, None when there is none"""
+    if not is_pdf(document_bytes):
+        return None
+    try:
+        ensure_loaded(pypdf)
+        reader = pypdf.PdfReader(document_stream(document_bytes))
+        blocks: List[dict] = []
+        for page_number in page_numbers:
+            header, pairs = page_key_values(reader.pages[page_number - 1])
+            if pairs:
+                blocks.extend(key_values_to_blocks(page_number, header, pairs))
+    except Exception:
+        return None
+    return blocks or None
+
+
+class PathStats:
+    """How many documents took each input path and how long each path took"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths: Dict[str, Dict[str, float]] = {}
+
+    def record(self, path: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._paths.setdefault(path, {"documents": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["documents"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                path: {**stats, "mean_seconds": stats["total_seconds"] / stats["documents"]}
+                for path, stats in self._paths.items()
+            }
+
+
+# Text layer vs rendered OCR, for /ingest/stats
+path_stats = PathStats()
@@ -1,37 +1,117 @@
 import os
-import boto3
-import io
-from pdf2image import convert_from_bytes
+import tempfile
+from pathlib import Path
+from app.backends import BackendPool
+from app.documents import is_pdf
+from app.lazy import ensure_loaded, lazy_import
+from app.metrics import stage
 
+# Loaded on first use, see app.lazy
+boto3 = lazy_import("boto3")
+pdf2image = lazy_import("pdf2image")
+
+# Textract AnalyzeDocument accepts at most 10 MB of raw image bytes
+TEXTRACT_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+
+def create_textract_client():
+    """
+    Build a Textract client with a connection pool sized for concurrent calls
+    Created once at app startup and shared across requests
+    """
+    ensure_loaded(boto3)
+    from botocore.config import Config
 
-def analyze_1040(document_bytes):
-    """Call AWS Textract to analyze a 1040 form"""
     region = os.getenv("AWS_REGION", "us-east-1")
-    
-    client = boto3.client(
+    config = Config(
+        max_pool_connections=int(os.getenv("TEXTRACT_MAX_POOL_CONNECTIONS", "16")),
+        connect_timeout=float(os.getenv("TEXTRACT_CONNECT_TIMEOUT_SECONDS", "5")),
+        read_timeout=float(os.getenv("TEXTRACT_READ_TIMEOUT_SECONDS", "60")),
+        # The textract BackendPool retries throttling itself, so its limiter sees every throttle
+        # Every caller goes through one, see create_textract_pool
+        retries={"max_attempts": int(os.getenv("TEXTRACT_MAX_ATTEMPTS", "1")), "mode": "standard"},
+    )
+    return boto3.client(
         "textract",
         region_name=region,
         aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
         aws_session_token=os.getenv("AWS_SESSION_TOKEN"),
+        config=config,
     )
-    
+
+
+def create_textract_pool() -> BackendPool:
+    """
+    Concurrency limit, timeouts, circuit breaker and the one retry layer for Textract calls
+    Used by the API and the batch CLI alike, botocore does not retry on its own
+    """
+    return BackendPool.from_env("textract", default_concurrency=8, default_timeout=60.0,
+                                default_attempts=3, default_deadline=120.0)
+
+
+def render_page(document_bytes, page_number, dpi=None):
+    """
+    Rasterise one PDF page for Textract, None if it cannot be rendered
+    poppler writes the JPEG (or PNG) file itself, so the page is never held as
+    a decoded bitmap and re-encoded. DPI and format are configurable, JPEG
+    quality steps down until the image fits Textract's synchronous size limit
+    dpi overrides RENDER_DPI, the VLM renders at its own resolution
+    """
+    dpi = dpi or int(os.getenv("RENDER_DPI", "200"))
+    image_format = os.getenv("RENDER_FORMAT", "JPEG").upper()
+    quality = int(os.getenv("RENDER_JPEG_QUALITY", "95"))
+    max_bytes = int(os.getenv("TEXTRACT_MAX_IMAGE_BYTES", str(TEXTRACT_MAX_IMAGE_BYTES)))
+    try:
+        ensure_loaded(pdf2image)
+        with tempfile.TemporaryDirectory() as output_folder:
+            def render(fmt, jpegopt=None):
+                paths = pdf2image.convert_from_bytes(
+                    document_bytes, dpi=dpi, first_page=page_number, last_page=page_number, fmt=fmt,
+                    jpegopt=jpegopt, output_folder=output_folder, output_file="page", single_file=True,
+                    paths_only=True,
+                )
+                return Path(paths[0]).read_bytes() if paths else None
+
+            if image_format == "PNG":
+                image = render("png")
+                if image is None or len(image) <= max_bytes:
+                    return image
+                # Too big as PNG, fall through to JPEG
+            while True:
+                # Re-rendering is rare, a page over 10MB as JPEG at 95 is unusual
+                image = render("jpeg", {"quality": quality})
+                if image is None or len(image) <= max_bytes or quality <= 50:
+                    return image
+                quality -= 15
+    except:
+        pass
+    return None
+
+
+def analyze_1040(document_bytes, client=None):
+    """Call AWS Textract to analyze a 1040 form"""
+    return analyze_page(document_bytes, 1, client)
+
+
+def analyze_page(document_bytes, page_number, client=None):
+    """Call AWS Textract on a single page, rendering it only now if the document is a PDF"""
+    # Fall back to a one-off client when no shared one is passed in
+    if client is None:
+        client = create_textract_client()
+
     # Try to detect if it's a PDF and convert to image
     processed_bytes = document_bytes
-    if document_bytes.startswith(b'%PDF'):
-        # Convert PDF first page to image
-        try:
-            images = convert_from_bytes(document_bytes, first_page=1, last_page=1)
-            if images:
-                # Convert to JPEG bytes
-                img_byte_arr = io.BytesIO()
-                images[0].save(img_byte_arr, format='JPEG', quality=95)
-                processed_bytes = img_byte_arr.getvalue()
-        except:
-            pass
-
-    response = client.analyze_document(
-        Document={"Bytes": processed_bytes}, FeatureTypes=["FORMS"]
-    )
+    if is_pdf(document_bytes):
+        with stage("render"):
+            processed_bytes = render_page(document_bytes, page_number) or document_bytes
+    if isinstance(processed_bytes, memoryview):
+        # botocore only takes bytes or a file for blobs, copy the unrendered document once here
+        processed_bytes = bytes(processed_bytes)
+
+    with stage("textract"):
+        response = client.analyze_document(
+            Document={"Bytes": processed_bytes}, FeatureTypes=["FORMS"]
+        )
 
     return response
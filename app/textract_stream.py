@@ -0,0 +1,40 @@
+"""
+Streaming reader for stored analyze_document responses
+
+Blocks are read one at a time with ijson and trimmed as they arrive: block
+types parse_blocks never looks at (PAGE, SELECTION_ELEMENT, TABLE, ...) are
+dropped, and the blocks kept lose their polygons and every other key the
+pipeline does not read. Only the trimmed list is ever in memory, never the
+parsed response, and it feeds the same parse_blocks path as live OCR and replay.
+"""
+from typing import BinaryIO, Iterator, List
+
+import ijson
+
+# Block types parse_blocks reads
+KEPT_BLOCK_TYPES = frozenset(("LINE", "WORD", "KEY_VALUE_SET"))
+# Block keys parse_blocks reads (pages, key/values, confidence, provenance), plus the bounding box
+PIPELINE_BLOCK_KEYS = ("BlockType", "Id", "Text", "Page", "EntityTypes", "Relationships", "Confidence", "Source")
+
+
+def iter_blocks(fp: BinaryIO) -> Iterator[dict]:
+    """Yield blocks one by one from a stored or streamed analyze_document response"""
+    # Floats instead of the default Decimal, as json.load gives for confidences and boxes
+    return ijson.items(fp, "Blocks.item", use_float=True)
+
+
+def compact_block(block: dict) -> dict:
+    """A Textract block trimmed to what parse_blocks reads, the polygon and the rest are dropped"""
+    compact = {key: block[key] for key in PIPELINE_BLOCK_KEYS if key in block}
+    box = block.get("Geometry", {}).get("BoundingBox")
+    if box is not None:
+        compact["Geometry"] = {"BoundingBox": box}
+    return compact
+
+
+def stream_blocks(fp: BinaryIO) -> List[dict]:
+    """
+    The blocks of a stored or streamed analyze_document response, compacted as they are read
+    Feeds the same parse_blocks path as PDFs and replay, the full response is never held
+    """
+    return [compact_block(block) for block in iter_blocks(fp) if block.get("BlockType") in KEPT_BLOCK_TYPES]
@@ -0,0 +1,90 @@
+"""
+Uploaded documents without extra copies, and upload size limits
+
+Starlette spools multipart uploads to a temporary file as they stream in (in
+memory up to 1MB, on disk past that). upload_view maps that file rather than
+reading it into a new bytes object, and the memoryview it returns is what the
+pipeline passes around (see app.documents).
+
+UploadLimitMiddleware enforces a size limit on every upload route: MAX_UPLOAD_BYTES
+on the single-document ones, MAX_BATCH_UPLOAD_BYTES on a whole batch request
+(whose files are also checked one by one against MAX_UPLOAD_BYTES). A
+Content-Length over the limit is rejected before any of the body is read, and a
+chunked body is cut off as soon as it goes past the limit.
+"""
+import io
+import os
+from typing import Callable, Mapping
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from app.documents import map_file
+
+DEFAULT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+DEFAULT_MAX_BATCH_UPLOAD_BYTES = 1024 * 1024 * 1024
+
+
+def max_upload_bytes() -> int:
+    """Largest accepted upload, 0 disables the limit"""
+    return int(os.getenv("MAX_UPLOAD_BYTES", str(DEFAULT_MAX_UPLOAD_BYTES)))
+
+
+def max_batch_upload_bytes() -> int:
+    """Largest accepted batch request, all files together, 0 disables the limit"""
+    return int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(DEFAULT_MAX_BATCH_UPLOAD_BYTES)))
+
+
+def too_large_detail(limit: int) -> str:
+    return f"Upload is larger than the {limit} byte limit"
+
+
+async def upload_view(upload: UploadFile) -> memoryview:
+    """The uploaded bytes, shared with the spooled file instead of copied out of it"""
+    spool = upload.file
+    in_memory = getattr(spool, "_file", None)
+    if isinstance(in_memory, io.BytesIO):
+        # Not rolled over to disk: small, and getvalue hands out the buffer without copying
+        return memoryview(in_memory.getvalue())
+    try:
+        return map_file(spool)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # No real file underneath
+        await upload.seek(0)
+        return memoryview(await upload.read())
+
+
+class UploadLimitMiddleware:
+    """Reject request bodies over their path's limit (413), before they are spooled"""
+
+    def __init__(self, app, limits: Mapping[str, Callable[[], int]]):
+        self.app = app
+        # path -> current limit in bytes, read per request so the environment can change it
+        self.limits = dict(limits)
+
+    async def __call__(self, scope, receive, send):
+        limit_for = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        limit = limit_for() if limit_for is not None else 0
+        if not limit:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({"detail": too_large_detail(limit)}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside form parsing, FastAPI passes HTTPExceptions through as they are
+                    raise HTTPException(status_code=413, detail=too_large_detail(limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
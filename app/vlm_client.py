@@ -0,0 +1,515 @@
+"""
+Client layer in front of the VLM fallback
+
+The VLM is the slowest and most expensive call the service makes, so everything
+here is about making fewer and smaller calls:
+
+- the document goes as one first-page image, rendered at VLM_RENDER_DPI and
+  shrunk to VLM_MAX_IMAGE_SIDE (app.vlm_helper.page_image)
+- replies are cached by image hash plus prompt hash (the prompt hash also covers
+  the endpoint, model and response format), so re-parsing a document after a
+  PARSER_VERSION bump or a replay does not pay for the same question twice
+- with VLM_BATCH_MAX_DOCUMENTS above 1, fallback calls arriving within
+  VLM_BATCH_WAIT_MS of each other go out as one request with an image per
+  document, as long as the wait plus the recent latency of batched calls stays
+  inside VLM_LATENCY_SLO_SECONDS. Batches are capped at VLM_MAX_CONCURRENCY,
+  since every document in one holds a VLM pool slot while it waits
+- a sliding one-minute window caps tokens (VLM_TOKENS_PER_MINUTE) and spend
+  (VLM_COST_PER_MINUTE). A call that would go over fails fast with
+  VlmBudgetExceededError, which callers treat like an open circuit breaker
+- replies are validated here. JSON in a code fence or with text around it and
+  "85,000.00" strings are read as they are, a line that is not a number is left
+  out, and a reply that is no JSON object at all raises VlmReplyError. The
+  backend pool does not retry that, the same question gets the same answer
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from app.backends import BackendUnavailableError, is_overload
+from app.cache import MemoryTier
+from app.documents import Document
+from app.vlm_helper import (ALL_LINES, batch_prompt, chat_payload, document_key, narrow_prompt, page_image,
+                            post_chat, response_format, vlm_base_url)
+
+# Token estimate for an image PIL could not read, what a full page costs at high detail
+FULL_PAGE_IMAGE_TOKENS = 765
+# Reply tokens allowed per requested line and per document, also sent as max_tokens
+COMPLETION_TOKENS_PER_LINE = 16
+COMPLETION_TOKENS_PER_DOCUMENT = 16
+# Cached replies are a few dozen bytes, this only bounds a misbehaving server
+CACHE_ENTRY_BYTES = 1024
+# VLM pool size when VLM_MAX_CONCURRENCY is unset, also the largest batch then
+DEFAULT_CONCURRENCY = 4
+
+# "85,000.00", "-$1,200", "9631": amounts the prompt asks not to quote but models sometimes do
+money_regex = re.compile(r"^-?\$?(\d{1,3}(,\d{3})+|\d+)(\.\d+)?$")
+
+
+class VlmReplyError(ValueError):
+    """The VLM answered with something that cannot be read, asking again would not help"""
+
+
+class VlmBudgetExceededError(BackendUnavailableError):
+    """Raised without calling the VLM when the call would go over the per-minute budget"""
+
+
+def is_vlm_failure(exc: BaseException) -> bool:
+    """
+    Whether a fallback call failed because of the VLM itself (overload, an HTTP error
+    status, a reply that cannot be read), which counts against the route it took.
+    Configuration errors, unreadable images and bugs on this side do not
+    """
+    if isinstance(exc, VlmReplyError) or is_overload(exc):
+        return True
+    # httpx HTTPStatusError carries the response object, no httpx import needed
+    return getattr(getattr(exc, "response", None), "status_code", None) is not None
+
+
+def line_value(value: Any) -> Optional[float]:
+    """A reply value as a float, None for anything that is not a finite number"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str) and money_regex.match(value.strip()):
+        number = float(value.strip().replace("$", "").replace(",", ""))
+    else:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def reply_object(content: Any) -> Dict[str, Any]:
+    """The JSON object in a reply, allowing for a ```json fence or text around it"""
+    if not isinstance(content, str):
+        raise VlmReplyError("VLM reply has no text content")
+    text = content.strip()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        start, end = text.find("{"), text.rfind("}")
+        try:
+            data = json.loads(text[start:end + 1]) if 0 <= start < end else None
+        except ValueError:
+            data = None
+    if not isinstance(data, dict):
+        raise VlmReplyError(f"VLM reply is not a JSON object: {text[:80]!r}")
+    return data
+
+
+def document_lines(data: Any, fields: Sequence[str]) -> Dict[str, float]:
+    """Requested lines from one document's reply object, lines that are not numbers are left out"""
+    if not isinstance(data, dict):
+        raise VlmReplyError("VLM reply has no object for this document")
+    if "error" in data:
+        raise VlmReplyError(f"VLM could not read the page: {data['error']}")
+    lines = {}
+    for name in fields:
+        value = line_value(data.get(name))
+        if value is not None:
+            lines[name] = value
+    return lines
+
+
+def parse_reply(body: Dict[str, Any], documents: Sequence[Sequence[str]]) -> List[Any]:
+    """
+    Lines per document from a chat completions body, or a VlmReplyError for a document
+    whose part of the reply is unusable, so one bad page does not fail its whole batch
+    """
+    try:
+        content = body["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        raise VlmReplyError("VLM response has no message content") from None
+    data = reply_object(content)
+    if len(documents) == 1:
+        parts = [data]
+    else:
+        parts = [data.get(document_key(n)) for n in range(1, len(documents) + 1)]
+    results: List[Any] = []
+    for part, fields in zip(parts, documents):
+        try:
+            results.append(document_lines(part, fields))
+        except VlmReplyError as e:
+            results.append(e)
+    return results
+
+
+def image_tokens(size: Optional[Tuple[int, int]]) -> int:
+    """
+    Input tokens for one high-detail image: fitted into 2048x2048, shorter side down
+    to 768, then 170 per 512px tile plus 85
+    """
+    if size is None:
+        return FULL_PAGE_IMAGE_TOKENS
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+def prompt_tokens(prompt: str) -> int:
+    """Roughly 4 characters per token"""
+    return len(prompt) // 4 + 1
+
+
+def completion_tokens(documents: Sequence[Sequence[str]]) -> int:
+    return sum(COMPLETION_TOKENS_PER_DOCUMENT + COMPLETION_TOKENS_PER_LINE * len(fields) for fields in documents)
+
+
+@dataclass(slots=True)
+class Spend:
+    """One call's share of the budget window"""
+    at: float
+    tokens: float
+    cost: float
+    # False once it has left the window
+    live: bool = True
+
+
+class TokenBudget:
+    """
+    Tokens and spend of VLM calls over a sliding minute, 0 means no limit
+    Calls reserve their estimate up front and settle to the reported usage after,
+    so a burst of concurrent calls cannot all slip in under the limit at once
+    """
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, tokens_per_minute: int = 0, cost_per_minute: float = 0.0, input_cost_per_1k: float = 0.0,
+                 output_cost_per_1k: float = 0.0, clock: Callable[[], float] = time.monotonic):
+        self.tokens_per_minute = tokens_per_minute
+        self.cost_per_minute = cost_per_minute
+        self.input_cost_per_1k = input_cost_per_1k
+        self.output_cost_per_1k = output_cost_per_1k
+        self.clock = clock
+        self.rejections = 0
+        self._tokens = 0.0
+        self._cost = 0.0
+        # Oldest first
+        self._spends: Deque[Spend] = deque()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "TokenBudget":
+        """Read VLM_TOKENS_PER_MINUTE, VLM_COST_PER_MINUTE, VLM_INPUT_COST_PER_1K_TOKENS, VLM_OUTPUT_COST_PER_1K_TOKENS"""
+        return cls(
+            tokens_per_minute=int(os.getenv("VLM_TOKENS_PER_MINUTE", "0")),
+            cost_per_minute=float(os.getenv("VLM_COST_PER_MINUTE", "0")),
+            input_cost_per_1k=float(os.getenv("VLM_INPUT_COST_PER_1K_TOKENS", "0")),
+            output_cost_per_1k=float(os.getenv("VLM_OUTPUT_COST_PER_1K_TOKENS", "0")),
+        )
+
+    def cost(self, input_tokens: float, output_tokens: float) -> float:
+        return (input_tokens * self.input_cost_per_1k + output_tokens * self.output_cost_per_1k) / 1000
+
+    def _expire(self, now: float) -> None:
+        while self._spends and now - self._spends[0].at >= self.WINDOW_SECONDS:
+            spend = self._spends.popleft()
+            spend.live = False
+            self._tokens -= spend.tokens
+            self._cost -= spend.cost
+
+    def reserve(self, input_tokens: float, output_tokens: float) -> Spend:
+        """Take the estimate out of the budget, VlmBudgetExceededError if it does not fit"""
+        tokens, cost = input_tokens + output_tokens, self.cost(input_tokens, output_tokens)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if ((self.tokens_per_minute and self._tokens + tokens > self.tokens_per_minute)
+                    or (self.cost_per_minute and self._cost + cost > self.cost_per_minute)):
+                self.rejections += 1
+                raise VlmBudgetExceededError(f"VLM budget used up: {self._tokens:.0f} tokens and "
+                                             f"{self._cost:.4f} spent in the last minute")
+            spend = Spend(now, tokens, cost)
+            self._spends.append(spend)
+            self._tokens += tokens
+            self._cost += cost
+        return spend
+
+    def settle(self, spend: Spend, input_tokens: float, output_tokens: float) -> None:
+        """Replace a reservation with what the call actually used"""
+        tokens, cost = input_tokens + output_tokens, self.cost(input_tokens, output_tokens)
+        with self._lock:
+            if spend.live:
+                self._tokens += tokens - spend.tokens
+                self._cost += cost - spend.cost
+            spend.tokens, spend.cost = tokens, cost
+
+    def release(self, spend: Spend) -> None:
+        """A call that failed before the server did any work, it costs nothing"""
+        self.settle(spend, 0, 0)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            self._expire(self.clock())
+            return {"budget_tokens": round(self._tokens), "budget_cost": round(self._cost, 6),
+                    "budget_rejections": self.rejections}
+
+
+@dataclass(slots=True)
+class VlmRequest:
+    """One document's question, ready to send"""
+    image: Document
+    fields: Tuple[str, ...]
+    prompt: str
+    cropped: bool = False
+    # (width, height), None when PIL could not read the image
+    size: Optional[Tuple[int, int]] = None
+
+
+class _Batch:
+    __slots__ = ("requests", "results", "done")
+
+    def __init__(self):
+        self.requests: List[VlmRequest] = []
+        self.results: Optional[List[Any]] = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Packs requests that arrive close together into one call
+    The first request of a batch waits up to wait_seconds for up to max_documents - 1
+    more, then sends them all, the others wait for its result. Nothing is batched (or
+    waits) while the wait plus the recent latency of batches that size would break
+    latency_slo_seconds. Latency samples go stale after SAMPLE_TTL_SECONDS, so one
+    slow spell does not turn batching off for good
+
+    Requests are submitted from backend pool threads and each one holds its pool
+    slot while it waits, so max_documents must not exceed the pool's concurrency:
+    a larger batch could never fill, and its leader would sit out the whole wait
+    on slots no other document can use. VlmClient.from_env enforces this
+    """
+
+    EWMA_WEIGHT = 0.2
+    SAMPLE_TTL_SECONDS = 60.0
+
+    def __init__(self, send: Callable[[List[VlmRequest]], List[Any]], max_documents: int = 1,
+                 wait_seconds: float = 0.05, latency_slo_seconds: float = 0.0):
+        self.send = send
+        self.max_documents = max_documents
+        self.wait_seconds = wait_seconds
+        self.latency_slo_seconds = latency_slo_seconds
+        self.batches = 0
+        self.batched_documents = 0
+        self.slo_bypasses = 0
+        self._open: Optional[_Batch] = None
+        # Documents per call -> (EWMA seconds, last sample at)
+        self._latency: Dict[int, Tuple[float, float]] = {}
+        self._cond = threading.Condition()
+
+    def expected_seconds(self, documents: int) -> Optional[float]:
+        """Recent latency of calls with this many documents (or the closest fewer), None if unknown"""
+        now = time.monotonic()
+        known = [(size, seconds) for size, (seconds, at) in self._latency.items()
+                 if size <= documents and now - at < self.SAMPLE_TTL_SECONDS]
+        return max(known)[1] if known else None
+
+    def _within_slo(self) -> bool:
+        if not self.latency_slo_seconds:
+            return True
+        expected = self.expected_seconds(self.max_documents)
+        return expected is None or self.wait_seconds + expected <= self.latency_slo_seconds
+
+    def submit(self, request: VlmRequest) -> Dict[str, Any]:
+        """The request's lines, raising whatever its call raised"""
+        batch = None
+        if self.max_documents > 1:
+            with self._cond:
+                if not self._within_slo():
+                    self.slo_bypasses += 1
+                else:
+                    batch = self._open
+                    leader = batch is None
+                    if leader:
+                        batch = self._open = _Batch()
+                    index = len(batch.requests)
+                    batch.requests.append(request)
+                    if len(batch.requests) >= self.max_documents:
+                        self._open = None
+                        self._cond.notify_all()
+        if batch is None:
+            return self._unwrap(self._send([request])[0])
+
+        if leader:
+            deadline = time.monotonic() + self.wait_seconds
+            with self._cond:
+                while self._open is batch and (remaining := deadline - time.monotonic()) > 0:
+                    self._cond.wait(remaining)
+                if self._open is batch:
+                    self._open = None
+            try:
+                batch.results = self._send(batch.requests)
+            except Exception as e:
+                batch.results = [e] * len(batch.requests)
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.results is None:
+            raise RuntimeError("VLM batch was abandoned before it was sent")
+        return self._unwrap(batch.results[index])
+
+    def _send(self, requests: List[VlmRequest]) -> List[Any]:
+        start = time.monotonic()
+        results = self.send(requests)
+        now = time.monotonic()
+        with self._cond:
+            previous = self._latency.get(len(requests))
+            seconds = now - start
+            if previous is not None and now - previous[1] < self.SAMPLE_TTL_SECONDS:
+                seconds = previous[0] + self.EWMA_WEIGHT * (seconds - previous[0])
+            self._latency[len(requests)] = (seconds, now)
+            if len(requests) > 1:
+                self.batches += 1
+                self.batched_documents += len(requests)
+        return results
+
+    @staticmethod
+    def _unwrap(result: Any) -> Dict[str, Any]:
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            return {"batches": self.batches, "batched_documents": self.batched_documents,
+                    "batch_slo_bypasses": self.slo_bypasses}
+
+
+class VlmClient:
+    """Response cache, budget and batching in front of the chat completions call"""
+
+    def __init__(self, cache: Optional[MemoryTier] = None, budget: Optional[TokenBudget] = None,
+                 max_batch_documents: int = 1, batch_wait_seconds: float = 0.05, latency_slo_seconds: float = 0.0,
+                 post: Callable[[Dict[str, Any]], Dict[str, Any]] = post_chat):
+        self.cache = cache
+        self.budget = budget or TokenBudget()
+        self.batcher = MicroBatcher(self._call, max_batch_documents, batch_wait_seconds, latency_slo_seconds)
+        self.post = post
+        self.calls = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.reply_errors = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "VlmClient":
+        """
+        Read VLM_CACHE_*, VLM_BATCH_*, VLM_LATENCY_SLO_SECONDS and the budget variables
+        VLM_BATCH_MAX_DOCUMENTS is capped at VLM_MAX_CONCURRENCY, the VLM pool's size
+        """
+        entries = int(os.getenv("VLM_CACHE_MAX_ENTRIES", "1024"))
+        cache = None
+        if entries > 0:
+            cache = MemoryTier(entries, entries * CACHE_ENTRY_BYTES, float(os.getenv("VLM_CACHE_TTL_SECONDS", "86400")))
+        return cls(
+            cache=cache,
+            budget=TokenBudget.from_env(),
+            max_batch_documents=min(int(os.getenv("VLM_BATCH_MAX_DOCUMENTS", "1")),
+                                    int(os.getenv("VLM_MAX_CONCURRENCY", str(DEFAULT_CONCURRENCY)))),
+            batch_wait_seconds=float(os.getenv("VLM_BATCH_WAIT_MS", "50")) / 1000,
+            latency_slo_seconds=float(os.getenv("VLM_LATENCY_SLO_SECONDS", "20")),
+        )
+
+    def extract(self, document_bytes: Document, fields: Sequence[str] = ALL_LINES,
+                region: Optional[Tuple[float, float, float, float]] = None) -> Dict[str, Any]:
+        """
+        {line: value} for the requested lines plus "usage", see extract_fields_with_vlm
+        A cached reply reports zero usage, answering it cost no tokens
+        """
+        # Fail before rendering anything when there is nowhere to send it
+        vlm_base_url()
+        fields = tuple(fields)
+        image, size = page_image(document_bytes, region)
+        prompt = narrow_prompt(fields, cropped=region is not None)
+        key = self.cache_key(image, prompt, fields) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            with self._lock:
+                if cached is not None:
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+            if cached is not None:
+                return {**json.loads(cached), "usage": 0}
+
+        result = self.batcher.submit(VlmRequest(image, fields, prompt, region is not None, size))
+        # A reply missing lines may read better next time, only complete ones are kept
+        if key is not None and all(name in result for name in fields):
+            self.cache.set(key, json.dumps(result).encode())
+        return result
+
+    @staticmethod
+    def cache_key(image: Document, prompt: str, fields: Tuple[str, ...]) -> str:
+        """Image hash plus a hash of everything else that shapes the reply"""
+        question = json.dumps([os.getenv("VLM_BASE_URL"), os.getenv("VLM_MODEL", "gpt-4o"),
+                               response_format([fields]), prompt])
+        return f"{hashlib.sha256(image).hexdigest()}:{hashlib.sha256(question.encode()).hexdigest()}"
+
+    def _call(self, requests: List[VlmRequest]) -> List[Any]:
+        """One chat completions call for these requests, their lines (with "usage") or a VlmReplyError each"""
+        documents = [request.fields for request in requests]
+        if len(requests) == 1:
+            prompt = requests[0].prompt
+        else:
+            prompt = batch_prompt([(request.fields, request.cropped) for request in requests])
+        max_tokens = completion_tokens(documents)
+        spend = self.budget.reserve(prompt_tokens(prompt) + sum(image_tokens(request.size) for request in requests),
+                                    max_tokens)
+        with self._lock:
+            self.calls += 1
+        try:
+            body = self.post(chat_payload(prompt, [request.image for request in requests], documents, max_tokens))
+        except BaseException:
+            # Mostly throttling and refused connections, which are not billed
+            self.budget.release(spend)
+            raise
+        usage = body.get("usage") or {}
+        if "prompt_tokens" in usage:
+            self.budget.settle(spend, usage["prompt_tokens"], usage.get("completion_tokens", 0))
+        total = usage.get("total_tokens")
+
+        try:
+            results = parse_reply(body, documents)
+        except VlmReplyError:
+            with self._lock:
+                self.reply_errors += 1
+            raise
+        for result in results:
+            if isinstance(result, VlmReplyError):
+                with self._lock:
+                    self.reply_errors += 1
+            else:
+                # Split evenly across a batch, the router compares routes per document
+                result["usage"] = total // len(requests) if total is not None else None
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = {"calls": self.calls, "cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                     "cache_entries": len(self.cache) if self.cache is not None else 0,
+                     "reply_errors": self.reply_errors}
+        return {**stats, **self.batcher.stats(), **self.budget.stats()}
+
+
+_client: Optional[VlmClient] = None
+_client_lock = threading.Lock()
+
+
+def get_vlm_client() -> VlmClient:
+    """Process-wide client, built from the environment on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = VlmClient.from_env()
+    return _client
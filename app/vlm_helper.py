@@ -1,4 +1,15 @@
-from typing import Dict, Any
+import base64
+import io
+import json
+import math
+import os
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+from app.documents import Document, document_stream, is_pdf
+from app.lazy import ensure_loaded, lazy_import
+from app.textract_helper import render_page
+
+httpx = lazy_import("httpx")
 
 # Prompt for VLM to extract lines 9 to 14 from Form 1040
 # Generated with help of OpenAI's ChatGPT
@@ -24,25 +35,208 @@ Example output:
  "line_12": 12550.0, "line_13": 0.0, "line_14": 12550.0}
 """
 
-def extract_fields_with_vlm(document_bytes: bytes) -> Dict[str, Any]:
-    """
-    VLM fallback
-    Sample code below to call OpenAI's GPT-4o-vision model
-    In production, would send document_bytes along with prompt
-    Can modify prompt to alter lines extracted or even files extracted into document_bytes
-    Response is JSON returned as a dict
-    """
-    
-    # client = openai.Client()
-    # response = client.chat.completions.create(
-    #     model="gpt-4o-vision-preview",
-    #     messages=[
-    #         {"role": "system", "content": "You are a helpful assistant."},
-    #         {"role": "user", "content": PROMPT_1040_LINES_9_TO_14,
-    #          "attachments": [{"type": "file", "file": document_bytes}]}
-    #     ]
-    # )
-    # content = response.choices[0].message.content
-    # return json.loads(content)
-    
-    raise RuntimeError("VLM not configured. Mock extract_fields_with_vlm in tests.")
+# The keys line and example of PROMPT_1040_LINES_9_TO_14, rewritten for narrowed prompts
+ALL_LINES = ("line_9", "line_10", "line_11", "line_12", "line_13", "line_14")
+PROMPT_KEYS_LINE = "line_9, line_10, line_11, line_12, line_13, line_14."
+PROMPT_EXAMPLE_MARKER = "Example output:\n"
+# Batched prompts list each document's keys under this line
+BATCH_DOCUMENTS_HEADER = "Each value is a JSON object for that document's image, with keys:"
+
+
+def narrow_prompt(fields: Sequence[str], cropped: bool = False) -> str:
+    """
+    PROMPT_1040_LINES_9_TO_14 restricted to the given lines
+    Clarifications and the example only mention those lines, so the model is not
+    asked (and does not spend tokens) on lines Textract already read
+    """
+    if tuple(fields) == ALL_LINES and not cropped:
+        return PROMPT_1040_LINES_9_TO_14
+    head, example = PROMPT_1040_LINES_9_TO_14.split(PROMPT_EXAMPLE_MARKER)
+    lines = []
+    for line in head.splitlines():
+        if line.strip() == PROMPT_KEYS_LINE:
+            line = ", ".join(fields) + "."
+        elif line.startswith("- line_") and line[2:].split(" ")[0] not in fields:
+            continue
+        elif cropped and line.startswith("You are extracting"):
+            line += "\nThe image is a cropped band of the first page containing those lines."
+        lines.append(line)
+    example_values = json.loads(example)
+    narrowed_example = json.dumps({name: example_values[name] for name in fields})
+    return "\n".join(lines) + "\n" + PROMPT_EXAMPLE_MARKER + narrowed_example + "\n"
+
+
+def batch_prompt(documents: Sequence[Tuple[Sequence[str], bool]]) -> str:
+    """
+    One prompt for several documents, one image each and in the same order
+    documents is (fields, cropped) per image, the reply is {"document_<n>": {line: value}}
+    """
+    fields = tuple(name for name in ALL_LINES if any(name in wanted for wanted, _ in documents))
+    single = narrow_prompt(fields, cropped=any(cropped for _, cropped in documents))
+    head, example = single.split(PROMPT_EXAMPLE_MARKER)
+    names = [document_key(n) for n in range(1, len(documents) + 1)]
+    lines = []
+    for line in head.splitlines():
+        if line.startswith("You are extracting"):
+            line = (f"You are extracting numeric values from {len(documents)} IRS Form 1040 first pages, "
+                    "one image per document, in the order of the documents below.")
+        elif line.startswith("The image is a cropped band"):
+            line = "Some images are cropped bands of the first page containing the lines asked for."
+        elif line.strip() == ", ".join(fields) + ".":
+            line = ", ".join(names) + ".\n" + BATCH_DOCUMENTS_HEADER + "\n" + "\n".join(
+                f"{name}: {', '.join(wanted)}." for name, (wanted, _) in zip(names, documents))
+        elif "return: {\"error\"" in line:
+            line = '- If a page is not a 1040 or fields are unreadable, use {"error": "unreadable"} for that document.'
+        lines.append(line)
+    example_values = json.loads(example)
+    batch_example = json.dumps({name: {field: example_values[field] for field in wanted}
+                                for name, (wanted, _) in zip(names, documents)})
+    return "\n".join(lines) + "\n" + PROMPT_EXAMPLE_MARKER + batch_example + "\n"
+
+
+def document_key(number: int) -> str:
+    return f"document_{number}"
+
+
+def lines_schema(fields: Sequence[str]) -> Dict[str, Any]:
+    """JSON schema of one document's reply, null for a line the model could not read"""
+    return {"type": "object", "properties": {name: {"type": ["number", "null"]} for name in fields},
+            "required": list(fields), "additionalProperties": False}
+
+
+def response_format(documents: Sequence[Sequence[str]]) -> Dict[str, Any]:
+    """
+    response_format for a request on these documents' fields (one entry per image)
+    VLM_RESPONSE_FORMAT=json_schema has the server enforce the reply's shape (strict
+    structured outputs), the default json_object works with any OpenAI-compatible server
+    """
+    if os.getenv("VLM_RESPONSE_FORMAT", "json_object").lower() != "json_schema":
+        return {"type": "json_object"}
+    if len(documents) == 1:
+        schema = lines_schema(documents[0])
+    else:
+        names = [document_key(n) for n in range(1, len(documents) + 1)]
+        schema = {"type": "object", "properties": {name: lines_schema(fields) for name, fields in zip(names, documents)},
+                  "required": names, "additionalProperties": False}
+    return {"type": "json_schema", "json_schema": {"name": "form_1040_lines", "strict": True, "schema": schema}}
+
+
+def fit_image(image_bytes: Document, region: Optional[Tuple[float, float, float, float]] = None,
+              max_side: int = 0, quality: int = 85) -> Tuple[Document, Optional[Tuple[int, int]]]:
+    """
+    Crop to region and shrink so the longer side is at most max_side (0 keeps the size)
+    Decodes once and re-encodes as JPEG only when something changed. Returns the image
+    and its (width, height), None for bytes PIL cannot read, which are sent as they are
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        image = Image.open(document_stream(image_bytes))
+    except UnidentifiedImageError:
+        if region is not None:
+            raise
+        return image_bytes, None
+    if max_side:
+        crop_width, crop_height = image.width, image.height
+        if region is not None:
+            crop_width, crop_height = crop_width * region[2], crop_height * region[3]
+        scale = max_side / max(crop_width, crop_height)
+        if scale < 1:
+            # JPEGs decode straight at 1/2, 1/4 or 1/8 size when that is still big enough,
+            # a few times faster than decoding everything and resizing it all (no-op for PNG)
+            image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    changed = False
+    if region is not None:
+        left, top, width, height = region
+        image = image.crop((int(left * image.width), int(top * image.height),
+                            int((left + width) * image.width), int((top + height) * image.height)))
+        changed = True
+    if max_side and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.LANCZOS, reducing_gap=3.0)
+        changed = True
+    if not changed:
+        return image_bytes, image.size
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=quality)
+    return output.getvalue(), image.size
+
+
+def page_image(document_bytes: Document, region: Optional[Tuple[float, float, float, float]] = None
+               ) -> Tuple[Document, Optional[Tuple[int, int]]]:
+    """
+    First page as an image for the VLM, cropped to region when one is given, and its size
+    PDFs are rendered at VLM_RENDER_DPI rather than Textract's RENDER_DPI, and every
+    image is shrunk to VLM_MAX_IMAGE_SIDE: servers scale a high-detail page down to
+    about 768x1000 before the model sees it, so more pixels only cost upload and
+    encode time. See benchmarks/bench_vlm.py for bytes and tokens per setting
+    """
+    image_bytes = document_bytes
+    if is_pdf(document_bytes):
+        image_bytes = render_page(document_bytes, 1, dpi=int(os.getenv("VLM_RENDER_DPI", "150")))
+        if image_bytes is None:
+            raise RuntimeError("Could not render the first page for the VLM")
+    return fit_image(image_bytes, region, max_side=int(os.getenv("VLM_MAX_IMAGE_SIDE", "1024")),
+                     quality=int(os.getenv("VLM_JPEG_QUALITY", "85")))
+
+
+def image_media_type(image_bytes: Document) -> str:
+    if bytes(image_bytes[:4]) == b"\x89PNG":
+        return "image/png"
+    return "image/jpeg"
+
+
+def vlm_base_url() -> str:
+    base_url = os.getenv("VLM_BASE_URL")
+    if not base_url:
+        raise RuntimeError("VLM not configured. Set VLM_BASE_URL, or mock extract_fields_with_vlm in tests.")
+    return base_url
+
+
+def chat_payload(prompt: str, images: Sequence[Document], documents: Sequence[Sequence[str]],
+                 max_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """Chat completions request: the prompt, then each image in order"""
+    content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+    for image_bytes in images:
+        image_url = f"data:{image_media_type(image_bytes)};base64,{base64.b64encode(image_bytes).decode()}"
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+    payload = {
+        "model": os.getenv("VLM_MODEL", "gpt-4o"),
+        "temperature": 0,
+        "response_format": response_format(documents),
+        "messages": [{"role": "user", "content": content}],
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    return payload
+
+
+def post_chat(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """POST to VLM_BASE_URL/chat/completions and return the response body"""
+    base_url = vlm_base_url()
+    ensure_loaded(httpx)
+    api_key = os.getenv("VLM_API_KEY")
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    try:
+        response = httpx.post(f"{base_url.rstrip('/')}/chat/completions", json=payload, headers=headers,
+                              timeout=float(os.getenv("VLM_HTTP_TIMEOUT_SECONDS", "60")))
+    except httpx.TransportError as e:
+        # Connection refused, reset or timed out: the pool treats these as overload
+        raise ConnectionError(f"VLM request failed: {e}") from e
+    # 429 and 5xx come out as HTTPStatusError, which the pool retries
+    response.raise_for_status()
+    return response.json()
+
+
+def extract_fields_with_vlm(document_bytes: Document, fields: Sequence[str] = ALL_LINES,
+                            region: Optional[Tuple[float, float, float, float]] = None) -> Dict[str, Any]:
+    """
+    VLM fallback against an OpenAI-compatible chat completions API (VLM_BASE_URL, VLM_MODEL, VLM_API_KEY)
+    Sends the first page, or just region of it, with a prompt narrowed to fields, through the
+    shared VlmClient (response cache, per-minute budget, optional batching, see app.vlm_client)
+    Returns {line: value} for the requested lines plus "usage" (total tokens, when the server reports it)
+    """
+    from app.vlm_client import get_vlm_client
+
+    return get_vlm_client().extract(document_bytes, fields, region)
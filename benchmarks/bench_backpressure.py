@@ -0,0 +1,87 @@
+"""
+Throttled Textract under load: fixed concurrency vs the adaptive limiter
+
+Runs CALLS concurrent analyze_1040 calls through a BackendPool of 32 workers
+against a local Textract stand-in that serves CAPACITY calls at once and
+throttles the rest (tests/textract_stub.py). Compares the old behaviour (no
+retries), fixed concurrency with jittered retries, and the AIMD limiter with
+the same retries: success rate, throttled calls sent to the backend, latency.
+
+Run with: python -m benchmarks.bench_backpressure [--calls 400] [--capacity 4] [--latency-ms 20]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import Dict
+
+from app.backends import AdaptiveLimiter, BackendPool, CircuitBreaker
+from app.textract_helper import analyze_1040
+from benchmarks.suite import FIXTURES
+from tests.textract_stub import OverloadedTextract
+
+WORKERS = 32
+
+
+def make_pool(mode: str) -> BackendPool:
+    limiter = AdaptiveLimiter(WORKERS, min_limit=WORKERS if mode != "adaptive" else 1)
+    return BackendPool("textract", max_concurrency=WORKERS, timeout_seconds=10.0, limiter=limiter,
+                       # Throttling never opens the breaker, keep it out of the comparison either way
+                       breaker=CircuitBreaker(failure_threshold=10 ** 9),
+                       max_attempts=1 if mode == "no_retries" else 20, deadline_seconds=30.0,
+                       retry_base_seconds=0.01, retry_max_seconds=0.5)
+
+
+def run_mode(mode: str, calls: int, capacity: int, latency_seconds: float) -> Dict:
+    with open(FIXTURES / "2024_samuel_singletary.json") as f:
+        textract = OverloadedTextract(json.load(f), capacity=capacity, latency_seconds=latency_seconds)
+    pool = make_pool(mode)
+    latencies = []
+
+    async def one() -> bool:
+        start = time.perf_counter()
+        try:
+            await pool.run(analyze_1040, b"doc", textract)
+            return True
+        except Exception:
+            return False
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def burst():
+        return await asyncio.gather(*[one() for _ in range(calls)])
+
+    start = time.perf_counter()
+    outcomes = asyncio.run(burst())
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    latencies.sort()
+    return {
+        "success_rate": round(sum(outcomes) / calls, 3),
+        "backend_calls": textract.calls,
+        "throttled": textract.throttled,
+        "final_limit": round(pool.limiter.limit, 2),
+        "p50_ms": round(statistics.median(latencies) * 1e3, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1e3, 1),
+        "elapsed_seconds": round(elapsed, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fixed vs adaptive concurrency against a throttling backend")
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--capacity", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    results = {mode: run_mode(mode, args.calls, args.capacity, args.latency_ms / 1e3)
+               for mode in ("no_retries", "fixed_with_retries", "adaptive")}
+    for mode, result in results.items():
+        print(f"{mode}: {result['success_rate']:.0%} succeeded, {result['throttled']} throttled of "
+              f"{result['backend_calls']} backend calls, p95 {result['p95_ms']}ms")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Per-document vs columnar normalisation and cross-checks over a back-catalogue sized batch
+
+Compares, for --rows synthetic returns:
+- parse_money per value vs normalize_money per column
+- Form1040DynamicFields validators per row vs run_cross_checks over the table
+- match_1040_fields per document vs ResultTable.from_key_values (fixture key/values repeated)
+
+Run with: python -m benchmarks.bench_columnar [--rows 200000]
+"""
+import argparse
+import json
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+from app.columnar import LINE_COLUMNS, ResultTable, normalize_money, run_cross_checks
+from app.models import Form1040DynamicFields
+from app.pipeline import match_1040_fields, parse_money, textract_to_dict
+from benchmarks.suite import FIXTURES
+
+
+def money_text(rng: random.Random, value: float) -> str:
+    text = f"{abs(value):,.0f}."
+    return f"({text})" if value < 0 else text
+
+
+def synthetic_records(rows: int, seed: int = 0) -> List[Dict]:
+    """Batch-output-like records, about 5% of them with totals that do not add up"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(rows):
+        line_9 = float(rng.randint(20_000, 500_000))
+        line_10 = float(rng.randint(0, 20_000))
+        line_11 = line_9 - line_10 + (rng.choice((1_000.0, -250.0)) if rng.random() < 0.05 else 0.0)
+        line_12 = float(rng.choice((14_600, 21_900, 29_200)))
+        line_13 = float(rng.randint(0, 5_000))
+        records.append({"path": f"doc_{i}.pdf", "success": True, "fields": {
+            "line_9": line_9, "line_10": line_10, "line_11": line_11,
+            "line_12": line_12, "line_13": line_13, "line_14": line_12 + line_13,
+        }})
+    return records
+
+
+def timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def scalar_checks(records: List[Dict]) -> List[bool]:
+    valid = []
+    for record in records:
+        dyn = Form1040DynamicFields(fields=dict(record["fields"]))
+        valid.append(Form1040DynamicFields.validate_line_11_totals(dyn)
+                     and Form1040DynamicFields.validate_line_14_totals(dyn))
+    return valid
+
+
+def report(name: str, scalar_seconds: float, columnar_seconds: float) -> None:
+    print(f"{name}: {scalar_seconds * 1e3:.1f}ms per-document, {columnar_seconds * 1e3:.1f}ms columnar "
+          f"({scalar_seconds / columnar_seconds:.1f}x)")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args(argv)
+    rng = random.Random(1)
+
+    records = synthetic_records(args.rows)
+    strings = [money_text(rng, record["fields"][line]) for record in records for line in LINE_COLUMNS[:2]]
+    report(f"normalise {len(strings)} money strings",
+           timed(lambda: [parse_money(text) for text in strings]),
+           timed(lambda: normalize_money(strings)))
+
+    table = ResultTable.from_records(records)
+    scalar_valid: List[bool] = []
+    checks = {}
+    report(f"cross-check {args.rows} returns",
+           timed(lambda: scalar_valid.extend(scalar_checks(records))),
+           timed(lambda: checks.setdefault("results", run_cross_checks(table))))
+    assert checks["results"].valid.tolist() == scalar_valid
+    reasons_seconds = timed(lambda: checks["results"].failure_reasons())
+    print(f"failure reasons for {int((~checks['results'].valid).sum())} failing rows: {reasons_seconds * 1e3:.1f}ms")
+
+    key_values: List[Tuple[str, Dict[str, str]]] = []
+    for path in sorted(FIXTURES.glob("*.json")):
+        with open(path) as f:
+            key_values.append((path.stem, textract_to_dict(json.load(f)["Blocks"])))
+    key_values = (key_values * (args.rows // 10 // len(key_values) + 1))[:args.rows // 10]
+    report(f"match fields for {len(key_values)} documents",
+           timed(lambda: [match_1040_fields(textract_dict) for _, textract_dict in key_values]),
+           timed(lambda: ResultTable.from_key_values(key_values)))
+
+
+if __name__ == "__main__":
+    main()
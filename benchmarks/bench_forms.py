@@ -0,0 +1,148 @@
+"""
+Per-form extraction cost for every form in the registry
+
+For each registered form: what compiling its rule table costs the first page
+that needs it, what dispatching a page on its key fingerprint costs, and what
+extracting (rule matching, defaults, cross-checks) costs per page. Also checks
+that every sample page is dispatched to its own form. Pages come from
+SAMPLE_PAGES, a 1040 fixture for the 1040, and are synthesized from the rule
+table for forms added since, so a new form shows up here without extra work.
+
+Run with: python -m benchmarks.bench_forms [--repeats 2000]
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Dict
+
+from app.forms import FORMS, FormRegistry
+from app.pages import FORM_1040
+from app.pipeline import extract_forms, textract_to_dict
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+
+# Key/values as Textract reads them off each form (lowercased keys)
+SAMPLE_PAGES: Dict[str, Dict[str, str]] = {
+    "schedule_1": {
+        "1 taxable refunds, credits, or offsets of state and local income taxes 1": "1,200.",
+        "3 business income or (loss). attach schedule c 3": "16,000.",
+        "7 unemployment compensation 7": "",
+        "8 a net operating loss 8a": "",
+        "z other income. list type and amount: 8z": "4,800.",
+        "9 total other income. add lines 8a through 8z 9": "4,800.",
+        "10 combine lines 1 through 7 and 9. this is your additional income. enter here and on "
+        "form 1040, 1040-sr, or 1040-nr, line 8 10": "22,000.",
+        "11 educator expenses 11": "300.",
+        "15 deductible part of self-employment tax. attach schedule se 15": "1,131.",
+        "17 self-employed health insurance deduction 17": "6,200.",
+        "21 student loan interest deduction 21": "2,000.",
+        "26 add lines 11 through 23 and 25. these are your adjustments to income. enter here and on "
+        "form 1040, 1040-sr, or 1040-nr, line 10 26": "9,631.",
+    },
+    "schedule_a": {
+        "1 medical and dental expenses (see instructions) 1": "22,000.",
+        "2 enter amount from form 1040 or 1040-sr, line 11 2": "270,669.",
+        "3 multiply line 2 by 7.5% (0.075) 3": "20,300.",
+        "4 subtract line 3 from line 1. if line 3 is more than line 1, enter -0- 4": "1,700.",
+        "5 a state and local income taxes or general sales taxes 5a": "14,000.",
+        "b state and local real estate taxes (see instructions) 5b": "6,000.",
+        "d add lines 5a through 5c 5d": "20,000.",
+        "e enter the smaller of line 5d or $10,000 ($5,000 if married filing separately) 5e": "10,000.",
+        "7 add lines 5e and 6 7": "10,000.",
+        "8 a home mortgage interest and points reported to you on form 1098 8a": "11,500.",
+        "e add lines 8a through 8c 8e": "11,500.",
+        "9 investment interest. attach form 4952 if required. see instructions 9": "",
+        "10 add lines 8e and 9 10": "11,500.",
+        "11 gifts by cash or check. if you made any gift of $250 or more, see instructions 11": "6,300.",
+        "14 add lines 11 through 13 14": "6,300.",
+        "17 add the amounts in the far right column for lines 4 through 16. also, enter this amount "
+        "on form 1040 or 1040-sr, line 12 17": "29,500.",
+    },
+    "schedule_b": {
+        "wells fargo bank": "1,500.",
+        "marcus/goldman sachs": "8,800.",
+        "2 add the amounts on line 1 2": "10,300.",
+        "3 excludable interest on series ee and i u.s. savings bonds issued after 1989. attach form 8815 3": "",
+        "4 subtract line 3 from line 2. enter the result here and on form 1040 or 1040-sr, line 2b 4": "10,300.",
+        "fidelity investments": "8,000.",
+        "6 add the amounts on line 5. enter the total here and on form 1040 or 1040-sr, line 3b 6": "8,000.",
+    },
+    "form_w-2": {
+        "b employer identification number (ein)": "12-3456789",
+        "1 wages, tips, other compensation": "190,000.00",
+        "2 federal income tax withheld": "35,000.00",
+        "3 social security wages": "168,600.00",
+        "4 social security tax withheld": "10,453.20",
+        "5 medicare wages and tips": "190,000.00",
+        "6 medicare tax withheld": "2,755.00",
+        "16 state wages, tips, etc.": "190,000.00",
+        "17 state income tax": "9,500.00",
+    },
+}
+
+
+def synthetic_page(form_type: str) -> Dict[str, str]:
+    """One "<n> <tokens> <n>" key per rule, for forms without a sample page"""
+    return {f"{rule.line} {' '.join(rule.token_sets[0])} {rule.line}": "1,000."
+            for rule in FORMS.get(form_type).rules}
+
+
+def sample_pages() -> Dict[str, Dict[str, str]]:
+    with open(FIXTURES / "2024_samuel_singletary.json") as f:
+        pages = {FORM_1040: textract_to_dict(json.load(f)["Blocks"])}
+    for form_type in FORMS.specs:
+        pages.setdefault(form_type, SAMPLE_PAGES.get(form_type) or synthetic_page(form_type))
+    return pages
+
+
+def per_call_seconds(fn, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def compile_seconds(form_type: str, repeats: int) -> float:
+    """First-use cost, on a fresh registry each time"""
+    spec = FORMS.get(form_type)
+    total = 0.0
+    for _ in range(repeats):
+        registry = FormRegistry()
+        registry.register(spec)
+        start = time.perf_counter()
+        registry.compiled(form_type)
+        total += time.perf_counter() - start
+    return total / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-form compile, dispatch and extraction cost")
+    parser.add_argument("--repeats", type=int, default=2000)
+    args = parser.parse_args()
+
+    results = {}
+    for form_type, page in sample_pages().items():
+        dispatched = FORMS.fingerprint(page)
+        forms = extract_forms({1: page}, {1: form_type})[form_type]
+        results[form_type] = {
+            "keys": len(page),
+            "dispatched_to": dispatched,
+            "fields": len([name for name in forms if name != "is_valid"]),
+            "is_valid": forms.get("is_valid"),
+            "compile_us": round(compile_seconds(form_type, max(args.repeats // 10, 1)) * 1e6, 1),
+            "fingerprint_us": round(per_call_seconds(lambda: FORMS.fingerprint(page), args.repeats) * 1e6, 2),
+            "extract_us": round(per_call_seconds(lambda: extract_forms({1: page}, {1: form_type}),
+                                                 args.repeats) * 1e6, 2),
+        }
+
+    print(f"{'form':>12} {'keys':>5} {'fields':>7} {'dispatch':>12} {'compile us':>11} "
+          f"{'fingerprint us':>15} {'extract us':>11}")
+    for form_type, result in results.items():
+        print(f"{form_type:>12} {result['keys']:>5} {result['fields']:>7} {str(result['dispatched_to']):>12} "
+              f"{result['compile_us']:>11} {result['fingerprint_us']:>15} {result['extract_us']:>11}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Overhead of stage timing and counters on the parse hot path
+
+Measures the cost of one stage() block with and without a tracked request,
+and end-to-end /parse-1040 latency (stub Textract) with metrics on vs off
+
+Run with: python -m benchmarks.bench_metrics
+"""
+import json
+
+from app import metrics
+from benchmarks.suite import FIXTURES, time_call, time_end_to_end
+
+FIXTURE = FIXTURES / "2024_samuel_singletary.json"
+
+
+def empty_stage() -> None:
+    with metrics.stage("bench"):
+        pass
+
+
+def main() -> None:
+    with open(FIXTURE) as f:
+        blocks = json.load(f)["Blocks"]
+
+    bare = time_call(lambda: None, 0.5)["median_seconds"]
+    untracked = time_call(empty_stage, 0.5)["median_seconds"]
+    metrics.start_request()
+    tracked = time_call(empty_stage, 0.5)["median_seconds"]
+    print(f"stage() overhead: {(untracked - bare) * 1e6:.2f}us untracked, {(tracked - bare) * 1e6:.2f}us in a request")
+
+    # Alternate on/off runs so drift on a shared machine hits both equally
+    on, off = [], []
+    for _ in range(5):
+        metrics.set_enabled(True)
+        on.append(time_end_to_end(blocks, 0.5)["median_seconds"])
+        metrics.set_enabled(False)
+        off.append(time_end_to_end(blocks, 0.5)["median_seconds"])
+    metrics.set_enabled(True)
+    on_seconds, off_seconds = min(on), min(off)
+    print(f"end-to-end median: {off_seconds * 1e3:.3f}ms metrics off, {on_seconds * 1e3:.3f}ms metrics on "
+          f"({(on_seconds / off_seconds - 1) * 100:+.2f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for key matching in parse_1040
+Compares the per-rule is_line_match chain against the compiled rule table
+as the number of rules grows, over the keys of every fixture document
+
+Run with: python -m benchmarks.bench_rules
+"""
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from app.pipeline import is_line_match, textract_to_dict
+from app.rules import FORM_1040_RULES, CompiledRules, FieldRule
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+RULE_COUNTS = (6, 25, 50, 100, 150)
+REPEATS = 50
+
+
+def synthetic_rules(count: int) -> Tuple[FieldRule, ...]:
+    """Real 1040 rules padded with made-up lines up to the requested count"""
+    extra = tuple(
+        FieldRule(f"line_{n}", n, token_sets=((f"token{n}", "amount"),), phrases=(f"{n} see line",))
+        for n in range(100, 100 + count - len(FORM_1040_RULES))
+    )
+    return FORM_1040_RULES + extra
+
+
+def chain_match(rules: Tuple[FieldRule, ...], key_text: str) -> List[FieldRule]:
+    """Baseline that runs every rule through is_line_match, like the old if-chain"""
+    matched = []
+    for rule in rules:
+        if (any(is_line_match(key_text, rule.line, *token_set) for token_set in rule.token_sets)
+                or any(phrase in key_text for phrase in rule.phrases)):
+            matched.append(rule)
+    return matched
+
+
+def time_per_document(match, documents: List[Dict[str, str]]) -> float:
+    """Mean seconds to classify every key of one document"""
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        for textract_dict in documents:
+            for key_text in textract_dict:
+                match(key_text)
+    return (time.perf_counter() - start) / (REPEATS * len(documents))
+
+
+def main() -> None:
+    documents = []
+    for path in sorted(FIXTURES.glob("*.json")):
+        with open(path) as f:
+            documents.append(textract_to_dict(json.load(f).get("Blocks", [])))
+
+    print(f"{'rules':>6} {'chain (us/doc)':>16} {'compiled (us/doc)':>18} {'speedup':>8}")
+    for count in RULE_COUNTS:
+        rules = synthetic_rules(count)
+        compiled = CompiledRules(rules)
+        chain_seconds = time_per_document(lambda key: chain_match(rules, key), documents)
+        compiled_seconds = time_per_document(compiled.match, documents)
+        print(f"{count:>6} {chain_seconds * 1e6:>16.1f} {compiled_seconds * 1e6:>18.1f} "
+              f"{chain_seconds / compiled_seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Per-response cost of building and serialising a parse result
+
+Before: a pydantic ParseResponse built from the fields dict, then FastAPI's
+jsonable_encoder and JSONResponse.render, which is what returning it from an
+endpoint did. After: a ParseResult built from the same fields (typed lines with
+provenance) and encode_result. Checks the bytes are identical first. Runs on
+every fixture's 1040 fields, and on a multi-page return carrying every
+registered form in "forms".
+
+Run with: python -m benchmarks.bench_serialization [--repeats 5000]
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.models import ParseResponse
+from app.pipeline import build_response, extract_forms, fields_from_blocks
+from app.results import Source, encode_result
+from benchmarks.bench_forms import sample_pages
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+
+
+def legacy_bytes(fields: Dict[str, Any], forms: Optional[Dict[str, Dict[str, Any]]]) -> bytes:
+    """What returning ParseResponse from an endpoint produced"""
+    response = ParseResponse(success=True, fields=fields, forms=forms)
+    return JSONResponse(jsonable_encoder(response)).body
+
+
+def cases() -> Dict[str, tuple]:
+    """name -> (dyn, forms) ready for build_response"""
+    built = {}
+    for path in sorted(FIXTURES.glob("*.json")):
+        with open(path) as f:
+            dyn, forms = fields_from_blocks(json.load(f)["Blocks"])
+        dyn.fields["source"] = Source.TEXTRACT
+        built[path.stem] = (dyn, forms)
+    pages = sample_pages()
+    page_forms = dict(enumerate(pages, start=1))
+    multi_page = extract_forms({n: pages[form_type] for n, form_type in page_forms.items()}, page_forms)
+    dyn, _ = built["2024_samuel_singletary"]
+    built["multi_page_all_forms"] = (dyn, multi_page)
+    return built
+
+
+def per_call_seconds(fn, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Parse result serialisation cost, pydantic vs typed + orjson")
+    parser.add_argument("--repeats", type=int, default=5000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, (dyn, forms) in cases().items():
+        result = build_response(dyn, forms)
+        fields = result.fields
+        expected = legacy_bytes(fields, result.forms)
+        assert encode_result(result) == expected, name
+
+        before = per_call_seconds(lambda: legacy_bytes(fields, result.forms), args.repeats)
+        after = per_call_seconds(lambda: encode_result(build_response(dyn, forms)), args.repeats)
+        results[name] = {"bytes": len(expected), "before_us": round(before * 1e6, 1),
+                         "after_us": round(after * 1e6, 1), "speedup": round(before / after, 1)}
+
+    print(f"{'response':>26} {'bytes':>6} {'before us':>10} {'after us':>9} {'speedup':>8}")
+    for name, result in results.items():
+        print(f"{name:>26} {result['bytes']:>6} {result['before_us']:>10} {result['after_us']:>9} "
+              f"{result['speedup']:>7}x")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Textract-only success rate with and without geometry-aware matching
+
+Each fixture with geometry is degraded the ways Textract output goes wrong in
+practice: one line's key/value pair missing, no FORMS key/values at all, and
+the printed line number missing too on a page scanned slightly lower. A document
+counts as a Textract-only success when it needs no VLM call (every required line
+present, every total check passing). Also times the spatial pass itself.
+
+Run with: python -m benchmarks.bench_spatial
+"""
+import copy
+import json
+from typing import Callable, Dict, List
+
+from app.pipeline import build_block_index, child_text_retriever, form_1040_dict, match_1040_fields
+from app.routing import fields_to_ask
+from app.rules import COMPILED_1040_RULES
+from app.spatial import AnchorTemplates, extract_lines, fill_from_geometry
+from benchmarks.suite import FIXTURES, time_call
+
+LINES = range(9, 15)
+
+
+def drop_line_keys(blocks: List[dict], line: int) -> List[dict]:
+    """Blocks without the key/value pair(s) Textract found for one 1040 line"""
+    idx = build_block_index(blocks)
+    dropped = set()
+    for block in blocks:
+        if block.get("BlockType") == "KEY_VALUE_SET" and "KEY" in block.get("EntityTypes", []):
+            rules = COMPILED_1040_RULES.match(child_text_retriever(idx, block))
+            if any(rule.line == line for rule in rules):
+                dropped.add(block["Id"])
+                for relationship in block.get("Relationships", []):
+                    if relationship["Type"] == "VALUE":
+                        dropped.update(relationship["Ids"])
+    return [block for block in blocks if block["Id"] not in dropped]
+
+
+def drop_forms(blocks: List[dict]) -> List[dict]:
+    """Blocks as if AnalyzeDocument returned no FORMS output"""
+    return [block for block in blocks if block.get("BlockType") != "KEY_VALUE_SET"]
+
+
+def drop_line_number(blocks: List[dict], line: int) -> List[dict]:
+    """Blocks without the line number printed left of the amount box"""
+    return [block for block in blocks if not (block.get("BlockType") == "LINE" and block.get("Text") == str(line)
+                                              and block["Geometry"]["BoundingBox"]["Left"] > 0.5)]
+
+
+def shift(blocks: List[dict], dy: float) -> List[dict]:
+    """Every box moved dy down the page, a scan fed in slightly lower"""
+    shifted = copy.deepcopy(blocks)
+    for block in shifted:
+        box = block.get("Geometry", {}).get("BoundingBox")
+        if box is not None:
+            box["Top"] += dy
+    return shifted
+
+
+def degraded_documents(blocks: List[dict]) -> Dict[str, List[dict]]:
+    documents = {"complete": blocks, "no_forms": drop_forms(blocks)}
+    for line in LINES:
+        documents[f"missing_kv_line_{line}"] = drop_line_keys(blocks, line)
+        documents[f"shifted_missing_kv_and_number_line_{line}"] = shift(
+            drop_line_number(drop_line_keys(blocks, line), line), 0.008)
+    return documents
+
+
+def textract_only(blocks: List[dict], spatial: bool) -> bool:
+    """True when the document would not need the VLM"""
+    textract_dict, _ = form_1040_dict(blocks)
+    dyn = match_1040_fields(textract_dict)
+    if spatial:
+        fill_from_geometry(dyn, blocks)
+    return not fields_to_ask(dyn)
+
+
+def success_rates(documents: Dict[str, List[dict]], check: Callable[[List[dict], bool], bool]) -> Dict[str, float]:
+    return {
+        mode: sum(check(blocks, mode == "spatial") for blocks in documents.values()) / len(documents)
+        for mode in ("text_only", "spatial")
+    }
+
+
+def main() -> None:
+    results = {}
+    for path in sorted(FIXTURES.glob("*.json")):
+        with open(path) as f:
+            blocks = json.load(f).get("Blocks", [])
+        if not any("Geometry" in block for block in blocks if block.get("BlockType") == "LINE"):
+            continue
+        documents = degraded_documents(blocks)
+        # Learn this revision's template from the clean page first, as production traffic would
+        extract_lines(blocks)
+        rates = success_rates(documents, textract_only)
+        templates = AnchorTemplates()
+        timing = time_call(lambda: extract_lines(documents["no_forms"], templates=templates), 0.5)
+        results[path.stem] = {"documents": len(documents), **rates,
+                              "spatial_median_ms": round(timing["median_seconds"] * 1e3, 3)}
+        print(f"{path.stem}: {len(documents)} variants, Textract-only success "
+              f"{rates['text_only']:.0%} text-only -> {rates['spatial']:.0%} with geometry, "
+              f"spatial pass {timing['median_seconds'] * 1e3:.2f}ms")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
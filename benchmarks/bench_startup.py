@@ -0,0 +1,92 @@
+"""
+Cold-start cost of the service: import time, time to first response, memory
+
+Every measurement runs in a fresh interpreter so nothing is already imported.
+Reports the median time to import app.main, the time from interpreter start to
+the first / response for each BACKEND_INIT mode (through the lifespan, with a
+local dummy AWS config so no network is touched), the peak RSS after that
+response and which heavy backends were actually executed by then. With
+--max-import-seconds the run fails (exit 1) when importing app.main is slower.
+
+Run with: python -m benchmarks.bench_startup [--runs 5] [--max-import-seconds 0.6]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Submodules that only exist in sys.modules once the lazy parent really executed
+HEAVY_MARKERS = {"boto3": "botocore.client", "pypdf": "pypdf._reader", "pdf2image": "PIL.Image", "httpx": "httpx._client"}
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+print(json.dumps({"import_seconds": elapsed, "loaded": [name for name, marker in MARKERS.items() if marker in sys.modules]}))
+"""
+
+FIRST_RESPONSE_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+from fastapi.testclient import TestClient
+import app.main
+with TestClient(app.main.app) as client:
+    client.get("/")
+    elapsed = time.perf_counter() - start
+    loaded = [name for name, marker in MARKERS.items() if marker in sys.modules]
+print(json.dumps({"first_response_seconds": elapsed, "loaded_at_first_response": loaded,
+                  "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+def run_probe(probe: str, env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    code = f"MARKERS = {HEAVY_MARKERS!r}\n{probe}"
+    full_env = {**os.environ, "AWS_REGION": "us-east-1", "AWS_ACCESS_KEY_ID": "bench",
+                "AWS_SECRET_ACCESS_KEY": "bench", **(env or {})}
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=full_env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def median_of(runs: List[Dict[str, Any]], key: str) -> float:
+    return statistics.median(run[key] for run in runs)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure service cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-seconds", type=float, default=None,
+                        help="fail when the median import of app.main takes longer")
+    args = parser.parse_args(argv)
+
+    imports = [run_probe(IMPORT_PROBE) for _ in range(args.runs)]
+    results: Dict[str, Any] = {
+        "import_app_main_median_seconds": round(median_of(imports, "import_seconds"), 4),
+        "loaded_at_import": imports[0]["loaded"],
+        "modes": {},
+    }
+    for mode in ("startup", "background", "lazy"):
+        runs = [run_probe(FIRST_RESPONSE_PROBE, {"BACKEND_INIT": mode}) for _ in range(args.runs)]
+        results["modes"][mode] = {
+            "first_response_median_seconds": round(median_of(runs, "first_response_seconds"), 4),
+            "max_rss_mb": round(median_of(runs, "max_rss_mb"), 1),
+            "loaded_at_first_response": runs[0]["loaded_at_first_response"],
+        }
+    print(json.dumps(results, indent=2))
+
+    limit = args.max_import_seconds
+    if limit is not None and results["import_app_main_median_seconds"] > limit:
+        print(f"import app.main took {results['import_app_main_median_seconds']:.3f}s, limit {limit:.3f}s",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
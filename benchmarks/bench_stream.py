@@ -0,0 +1,55 @@
+"""
+Peak memory and parse time of json.load + parse_blocks versus the streaming
+stream_blocks + parse_blocks path the batch CLI uses on stored Textract responses
+
+Run with: python -m benchmarks.bench_stream
+"""
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+from app.pipeline import parse_blocks
+from app.textract_stream import stream_blocks
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+REPEATS = 10
+
+
+def full_parse(path: Path) -> dict:
+    with open(path) as f:
+        return parse_blocks(json.load(f).get("Blocks", [])).model_dump()
+
+
+def streaming_parse(path: Path) -> dict:
+    with open(path, "rb") as f:
+        return parse_blocks(stream_blocks(f)).model_dump()
+
+
+def measure(parse, path: Path):
+    """Return (best seconds, peak traced bytes) for one parse of path"""
+    # Best of several runs, this is noisy on shared machines
+    seconds = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        parse(path)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    parse(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main() -> None:
+    print(f"{'fixture':<40} {'mode':<10} {'ms':>8} {'peak MiB':>9}")
+    for path in sorted(FIXTURES.glob("*.json")):
+        assert full_parse(path) == streaming_parse(path)
+        for mode, parse in (("full", full_parse), ("streaming", streaming_parse)):
+            seconds, peak = measure(parse, path)
+            print(f"{path.name:<40} {mode:<10} {seconds * 1e3:>8.2f} {peak / 2**20:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Peak memory per request for concurrent large uploads
+
+Drives the ASGI app directly with CONCURRENCY multipart uploads of a SIZE_MB
+PDF at once, each body streamed in 64KB chunks so the client side holds no
+copies, with Textract mocked and poppler's output stubbed (it runs out of
+process anyway). A thread samples the process's anonymous RSS (heap, not the
+mapped upload files) every millisecond; the peak above the idle baseline,
+divided by the number of requests, is the per-request cost. --copying runs the
+same load with uploads read into bytes, as /parse-1040 used to.
+
+Linux only (reads /proc/self/status).
+Run with: python -m benchmarks.bench_upload_memory [--size-mb 16] [--concurrency 8] [--copying]
+"""
+import argparse
+import asyncio
+import io
+import json
+import threading
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, List
+from unittest.mock import MagicMock, patch
+
+CHUNK_BYTES = 64 * 1024
+BOUNDARY = b"bench-upload-boundary"
+FIXTURE = Path(__file__).resolve().parent.parent / "tests" / "fixtures" / "2024_samuel_singletary.json"
+MARKER = b"UPLOAD-0000"
+
+
+def anon_rss_bytes() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("RssAnon not reported, Linux only")
+
+
+class PeakSampler:
+    """Highest anonymous RSS seen while running, sampled in a background thread"""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, anon_rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "PeakSampler":
+        self.peak = anon_rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, anon_rss_bytes())
+
+
+def padded_pdf(size: int) -> bytes:
+    """A one-page PDF of about size bytes, the bulk an embedded file that starts with MARKER"""
+    import pypdf
+
+    writer = pypdf.PdfWriter()
+    writer.add_blank_page(612, 792)
+    writer.add_attachment("scan.bin", MARKER + b"\0" * max(size - len(MARKER), 0))
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def multipart_parts(document: bytes, request_number: int) -> List[memoryview]:
+    """Body pieces for one upload, sharing document except for a unique marker"""
+    head = (b"--" + BOUNDARY + b"\r\nContent-Disposition: form-data; name=\"file\"; filename=\"scan.pdf\"\r\n"
+            b"Content-Type: application/pdf\r\n\r\n")
+    tail = b"\r\n--" + BOUNDARY + b"--\r\n"
+    at = document.index(MARKER)
+    view = memoryview(document)
+    # Identical uploads would be coalesced onto one parse
+    marker = b"UPLOAD-%04d" % request_number
+    return [memoryview(head), view[:at], memoryview(marker), view[at + len(marker):], memoryview(tail)]
+
+
+async def post(app, parts: List[memoryview]) -> Dict:
+    async def chunks() -> AsyncIterator[bytes]:
+        for part in parts:
+            for start in range(0, len(part), CHUNK_BYTES):
+                yield bytes(part[start:start + CHUNK_BYTES])
+
+    body = chunks()
+    messages: List[Dict] = []
+
+    async def receive():
+        try:
+            chunk = await body.__anext__()
+            return {"type": "http.request", "body": chunk, "more_body": True}
+        except StopAsyncIteration:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/parse-1040", "raw_path": b"/parse-1040", "query_string": b"",
+        "root_path": "", "client": ("127.0.0.1", 1234), "server": ("testserver", 80),
+        # Chunked, no Content-Length
+        "headers": [(b"content-type", b"multipart/form-data; boundary=" + BOUNDARY)],
+    }
+    await app(scope, receive, send)
+    status = next(message["status"] for message in messages if message["type"] == "http.response.start")
+    body_bytes = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return {"status": status, "body": json.loads(body_bytes)}
+
+
+def profile(size_mb: float, concurrency: int, copying: bool = False) -> Dict:
+    import app.main
+    from app.main import app as asgi_app
+
+    size = int(size_mb * 1024 * 1024)
+    document = padded_pdf(size)
+    mock_textract = MagicMock()
+    mock_textract.analyze_document.return_value = json.loads(FIXTURE.read_text())
+
+    async def read_copy(upload):
+        return await upload.read()
+
+    async def run() -> List[Dict]:
+        return await asyncio.gather(*[post(asgi_app, multipart_parts(document, i)) for i in range(concurrency)])
+
+    with patch("app.textract_helper.boto3.client", return_value=mock_textract), \
+            patch("app.textract_helper.render_page", return_value=b"\xff\xd8 stub jpeg"), \
+            patch.object(app.main, "upload_view", read_copy if copying else app.main.upload_view):
+        # Warm up imports, pools and the job engine outside the measurement
+        asyncio.run(post(asgi_app, multipart_parts(padded_pdf(2 * CHUNK_BYTES), concurrency)))
+        baseline = anon_rss_bytes()
+        with PeakSampler() as sampler:
+            responses = asyncio.run(run())
+
+    peak_growth = sampler.peak - baseline
+    return {
+        "upload_bytes": len(document),
+        "concurrency": concurrency,
+        "copying": copying,
+        "statuses": sorted({response["status"] for response in responses}),
+        "all_parsed": all(response["body"].get("success") for response in responses),
+        "peak_anon_growth_mb": round(peak_growth / 2**20, 1),
+        "per_request_peak_mb": round(peak_growth / concurrency / 2**20, 2),
+        "per_request_fraction_of_upload": round(peak_growth / concurrency / len(document), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Peak memory per request under concurrent uploads")
+    parser.add_argument("--size-mb", type=float, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--copying", action="store_true", help="read uploads into bytes, the old behaviour")
+    args = parser.parse_args()
+    print(json.dumps(profile(args.size_mb, args.concurrency, args.copying)))
+
+
+if __name__ == "__main__":
+    main()
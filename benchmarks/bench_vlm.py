@@ -0,0 +1,123 @@
+"""
+VLM fallback cost: image size per render setting, then calls, bytes, tokens and wall time
+
+Images: a synthetic letter page (rows of form labels and amounts) at several
+DPIs, each shrunk to several VLM_MAX_IMAGE_SIDE values. Shows JPEG bytes, the
+high-detail token estimate and the preparation time; past ~1024px on the long
+side the bytes keep growing while the tokens do not. No poppler is needed, the
+pages are drawn at each DPI instead of rendered from a PDF.
+
+Calls: DOCUMENTS distinct pages each asked about twice (a re-parse) by
+CONCURRENCY threads against the stub VLM server (tests/vlm_stub.py). Before: the
+whole 200 DPI page per call, no cache, no batching. After: VlmClient defaults
+(1024px, response cache) with batches of up to --batch documents.
+
+Run with: python -m benchmarks.bench_vlm [--documents 16] [--concurrency 8] [--batch 4] [--latency-ms 200]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from PIL import Image, ImageDraw
+
+from app.cache import MemoryTier
+from app.vlm_client import TokenBudget, VlmClient, image_tokens
+from app.vlm_helper import page_image
+from tests.vlm_stub import StubVlmServer
+
+DPIS = (100, 150, 200, 300)
+MAX_SIDES = (0, 1536, 1024, 768)
+
+
+def synthetic_page(dpi: int, seed: int = 0) -> bytes:
+    """A letter page of labelled rows with amounts, as a JPEG like render_page writes"""
+    rng = random.Random(seed)
+    width, height = int(8.5 * dpi), int(11 * dpi)
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    row_height = height // 40
+    for row in range(2, 38):
+        y = row * row_height
+        draw.line((0, y, width, y), fill=160)
+        draw.text((int(0.3 * dpi), y + row_height // 4), f"{row} Line label for row {row} " + "." * 40, fill=0)
+        draw.rectangle((int(6.8 * dpi), y + 2, int(8.2 * dpi), y + row_height - 2), outline=90)
+        draw.text((int(7.0 * dpi), y + row_height // 4), f"{rng.randint(0, 999999):,}.", fill=0)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def image_table() -> Dict[str, Dict]:
+    results = {}
+    for dpi in DPIS:
+        page = synthetic_page(dpi)
+        for max_side in MAX_SIDES:
+            os.environ["VLM_MAX_IMAGE_SIDE"] = str(max_side)
+            start = time.perf_counter()
+            image, size = page_image(page)
+            seconds = time.perf_counter() - start
+            results[f"{dpi}dpi/{max_side or 'full'}"] = {
+                "size": f"{size[0]}x{size[1]}", "bytes": len(image), "tokens": image_tokens(size),
+                "prepare_ms": round(seconds * 1000, 1)}
+    os.environ.pop("VLM_MAX_IMAGE_SIDE", None)
+    return results
+
+
+def run_calls(mode: str, documents: int, concurrency: int, batch: int, latency_seconds: float) -> Dict:
+    pages = [synthetic_page(200, seed) for seed in range(documents)]
+    if mode == "before":
+        os.environ["VLM_MAX_IMAGE_SIDE"] = "0"
+        client = VlmClient(cache=None, budget=TokenBudget())
+    else:
+        os.environ.pop("VLM_MAX_IMAGE_SIDE", None)
+        client = VlmClient(cache=MemoryTier(1024, 1024 * 1024, 0), budget=TokenBudget(),
+                           max_batch_documents=batch, batch_wait_seconds=0.05, latency_slo_seconds=20.0)
+    with StubVlmServer(latency_seconds=latency_seconds) as stub:
+        os.environ["VLM_BASE_URL"] = stub.base_url
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            # Every document twice, the second pass is a re-parse
+            list(executor.map(lambda page: client.extract(page), pages + pages))
+        seconds = time.perf_counter() - start
+    os.environ.pop("VLM_MAX_IMAGE_SIDE", None)
+    stats = client.stats()
+    return {"calls": len(stub.requests), "request_bytes": sum(len(json.dumps(body)) for body in stub.requests),
+            "tokens": stats["budget_tokens"], "cache_hits": stats["cache_hits"], "batches": stats["batches"],
+            "seconds": round(seconds, 2)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="VLM image sizes, and calls before/after the client layer")
+    parser.add_argument("--documents", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    args = parser.parse_args()
+    saved_base_url = os.environ.get("VLM_BASE_URL")
+
+    images = image_table()
+    print(f"{'page':>15} {'size':>10} {'bytes':>9} {'tokens':>7} {'prep ms':>8}")
+    for name, result in images.items():
+        print(f"{name:>15} {result['size']:>10} {result['bytes']:>9} {result['tokens']:>7} {result['prepare_ms']:>8}")
+
+    calls = {mode: run_calls(mode, args.documents, args.concurrency, args.batch, args.latency_ms / 1000)
+             for mode in ("before", "after")}
+    if saved_base_url is None:
+        os.environ.pop("VLM_BASE_URL", None)
+    else:
+        os.environ["VLM_BASE_URL"] = saved_base_url
+    print(f"\n{'mode':>7} {'calls':>6} {'request bytes':>14} {'tokens':>8} {'cache hits':>11} {'batches':>8} "
+          f"{'seconds':>8}")
+    for mode, result in calls.items():
+        print(f"{mode:>7} {result['calls']:>6} {result['request_bytes']:>14} {result['tokens']:>8} "
+              f"{result['cache_hits']:>11} {result['batches']:>8} {result['seconds']:>8}")
+    print(json.dumps({"images": images, "calls": calls}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Load test for /parse-1040 on a single worker against a local stub Textract
+Shows throughput scaling with the number of concurrent uploads
+
+Run with: python -m benchmarks.load_test [--latency 0.25] [--requests 64]
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import httpx
+
+from app.backends import BackendPool
+from app.main import app
+from tests.textract_stub import OverloadedTextract
+
+FIXTURE = Path(__file__).resolve().parent.parent / "tests" / "fixtures" / "2024_samuel_singletary.json"
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16, 32)
+
+
+async def run_level(http: httpx.AsyncClient, total: int, concurrency: int) -> float:
+    """Send total uploads with at most concurrency in flight, return requests per second"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            response = await http.post(
+                "/parse-1040", files={"file": (f"doc_{i}.pdf", f"doc {i}".encode(), "application/pdf")}
+            )
+            assert response.json()["success"], response.text
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(total)])
+    return total / (time.perf_counter() - start)
+
+
+async def main(latency: float, total: int, pool_size: int) -> None:
+    with open(FIXTURE) as f:
+        app.state.textract_client = OverloadedTextract(json.load(f), latency_seconds=latency)
+    app.state.textract_pool = BackendPool("textract", max_concurrency=pool_size, timeout_seconds=30)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as http:
+        print(f"stub latency {latency}s, {total} requests, textract pool size {pool_size}")
+        print(f"{'concurrency':>12} {'req/s':>8} {'ideal req/s':>12}")
+        for concurrency in CONCURRENCY_LEVELS:
+            throughput = await run_level(http, total, concurrency)
+            ideal = min(concurrency, pool_size) / latency
+            print(f"{concurrency:>12} {throughput:>8.1f} {ideal:>12.1f}")
+    app.state.textract_pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.25, help="stub Textract latency in seconds")
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--pool-size", type=int, default=16, help="Textract pool concurrency limit")
+    args = parser.parse_args()
+    asyncio.run(main(args.latency, args.requests, args.pool_size))
@@ -0,0 +1,231 @@
+"""
+Per-stage benchmark suite for the parse pipeline with regression thresholds
+
+Times build_block_index, textract_to_dict, the field matching loop, parse_money,
+the Form1040DynamicFields validators and end-to-end /parse-1040 latency (stub OCR)
+on every fixture plus synthetic documents scaled to 10x and 100x blocks and to
+many pages. Results are written as JSON; with --baseline the run fails (exit 1)
+when any stage's median is more than --threshold slower than the stored baseline.
+
+Run with: python -m benchmarks.suite [--output results.json]
+                                     [--baseline benchmarks/baseline.json] [--threshold 0.5]
+                                     [--save-baseline benchmarks/baseline.json] [--quick]
+"""
+import argparse
+import asyncio
+import copy
+import json
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from app.models import Form1040DynamicFields
+from app.pipeline import build_block_index, match_1040_fields, parse_money, textract_to_dict
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures"
+# Base document for the scaled variants
+SCALE_FIXTURE = "2024_samuel_singletary.json"
+SCALE_FACTORS = (10, 100)
+PAGE_COUNT = 20
+
+# Stage medians below this are all timer noise, never flag them
+MIN_COMPARABLE_SECONDS = 2e-6
+
+
+def scale_blocks(blocks: List[dict], factor: int) -> List[dict]:
+    """factor copies of blocks with unique Ids, relationships remapped to match"""
+    scaled: List[dict] = []
+    for copy_number in range(factor):
+        suffix = f"-{copy_number}" if copy_number else ""
+        for block in blocks:
+            block = copy.deepcopy(block)
+            block["Id"] = f"{block['Id']}{suffix}"
+            for relationship in block.get("Relationships", []):
+                relationship["Ids"] = [f"{block_id}{suffix}" for block_id in relationship["Ids"]]
+            scaled.append(block)
+    return scaled
+
+
+def paginate_blocks(blocks: List[dict], pages: int) -> List[dict]:
+    """The same page repeated pages times, tagged the way multi-page Textract output is"""
+    paged = scale_blocks(blocks, pages)
+    per_page = len(blocks)
+    for i, block in enumerate(paged):
+        block["Page"] = i // per_page + 1
+    return paged
+
+
+def load_documents(quick: bool = False) -> Dict[str, List[dict]]:
+    """{document name: blocks} for every fixture and the synthetic variants"""
+    documents: Dict[str, List[dict]] = {}
+    for path in sorted(FIXTURES.glob("*.json")):
+        with open(path) as f:
+            documents[path.stem] = json.load(f).get("Blocks", [])
+    base = documents[Path(SCALE_FIXTURE).stem]
+    for factor in SCALE_FACTORS[:1] if quick else SCALE_FACTORS:
+        documents[f"scaled_{factor}x"] = scale_blocks(base, factor)
+    documents[f"pages_{PAGE_COUNT}"] = paginate_blocks(base, PAGE_COUNT)
+    return documents
+
+
+def time_call(fn: Callable[[], Any], min_seconds: float) -> Dict[str, float]:
+    """
+    Run fn repeatedly for at least min_seconds in batches sized to ~1ms,
+    returning per-call median and min over the batches
+    """
+    batch = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= 1e-3 or batch >= 1 << 20:
+            break
+        batch *= 2
+
+    samples = [elapsed / batch]
+    deadline = time.perf_counter() + min_seconds
+    while time.perf_counter() < deadline or len(samples) < 5:
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        samples.append((time.perf_counter() - start) / batch)
+    return {"median_seconds": statistics.median(samples), "min_seconds": min(samples),
+            "samples": len(samples), "calls_per_sample": batch}
+
+
+def stage_functions(blocks: List[dict]) -> Dict[str, Callable[[], Any]]:
+    """Zero-argument callables for each pure stage, inputs prepared up front"""
+    textract_dict = textract_to_dict(blocks)
+    values = list(textract_dict.values())
+    dyn = match_1040_fields(textract_dict)
+
+    def parse_all_money() -> None:
+        for value_text in values:
+            parse_money(value_text)
+
+    def validators() -> None:
+        Form1040DynamicFields.validate_line_11_totals(dyn)
+        Form1040DynamicFields.validate_line_14_totals(dyn)
+
+    return {
+        "build_block_index": lambda: build_block_index(blocks),
+        "textract_to_dict": lambda: textract_to_dict(blocks),
+        "match_fields": lambda: match_1040_fields(textract_dict),
+        "parse_money": parse_all_money,
+        "validators": validators,
+    }
+
+
+def time_end_to_end(blocks: List[dict], min_seconds: float) -> Dict[str, float]:
+    """Upload latency through FastAPI with Textract stubbed out and caching off"""
+    import app.main as main
+    from app.backends import BackendPool
+    from tests.textract_stub import OverloadedTextract
+
+    saved_state = {name: getattr(main.app.state, name, None)
+                   for name in ("textract_client", "textract_pool", "vlm_pool")}
+    saved_cache, saved_recorder = main.result_cache, main.response_recorder
+    main.result_cache = main.response_recorder = None
+    # No latency, so end-to-end timing is all parser and framework
+    main.app.state.textract_client = OverloadedTextract({"Blocks": blocks})
+    main.app.state.textract_pool = BackendPool("textract", max_concurrency=1, timeout_seconds=60)
+
+    async def run() -> Dict[str, float]:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as http:
+            samples: List[float] = []
+            deadline = time.perf_counter() + min_seconds
+            while time.perf_counter() < deadline or len(samples) < 5:
+                start = time.perf_counter()
+                response = await http.post(
+                    "/parse-1040", files={"file": ("bench.pdf", b"not a real pdf", "application/pdf")}
+                )
+                samples.append(time.perf_counter() - start)
+                response.raise_for_status()
+        return {"median_seconds": statistics.median(samples), "min_seconds": min(samples),
+                "samples": len(samples), "calls_per_sample": 1}
+
+    try:
+        return asyncio.run(run())
+    finally:
+        main.app.state.textract_pool.shutdown()
+        for name, value in saved_state.items():
+            setattr(main.app.state, name, value)
+        main.result_cache, main.response_recorder = saved_cache, saved_recorder
+
+
+def run_suite(min_seconds: float = 0.2, quick: bool = False) -> Dict[str, Any]:
+    """Time every stage on every document, keyed "<stage>/<document>" """
+    results: Dict[str, Dict[str, float]] = {}
+    for name, blocks in load_documents(quick).items():
+        for stage, fn in stage_functions(blocks).items():
+            results[f"{stage}/{name}"] = {"blocks": len(blocks), **time_call(fn, min_seconds)}
+        results[f"end_to_end/{name}"] = {"blocks": len(blocks), **time_end_to_end(blocks, min_seconds)}
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "min_seconds_per_stage": min_seconds,
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any],
+                        threshold: float) -> List[Dict[str, Any]]:
+    """Stages whose median grew by more than threshold (0.5 = 50%) over the baseline"""
+    regressions = []
+    for key, current in results["results"].items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None:
+            continue
+        before, after = previous["median_seconds"], current["median_seconds"]
+        if max(before, after) < MIN_COMPARABLE_SECONDS:
+            continue
+        ratio = after / before if before else float("inf")
+        if ratio > 1 + threshold:
+            regressions.append({"stage": key, "baseline_seconds": before,
+                                "current_seconds": after, "ratio": round(ratio, 2)})
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Per-stage parser benchmarks")
+    parser.add_argument("--output", type=Path, default=None, help="write results JSON here (default stdout)")
+    parser.add_argument("--baseline", type=Path, default=None, help="fail on regressions against this baseline")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed slowdown, 0.5 = 50%%")
+    parser.add_argument("--save-baseline", type=Path, default=None, help="store these results as the new baseline")
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="time spent per stage and document")
+    parser.add_argument("--quick", action="store_true", help="skip the 100x document")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.min_seconds, args.quick)
+    regressions: List[Dict[str, Any]] = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        results["regressions"] = regressions
+
+    payload = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(payload + "\n")
+    else:
+        print(payload)
+    if args.save_baseline is not None:
+        args.save_baseline.write_text(payload + "\n")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression['stage']}: {regression['baseline_seconds'] * 1e6:.1f}us -> "
+              f"{regression['current_seconds'] * 1e6:.1f}us ({regression['ratio']}x)", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
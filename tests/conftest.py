@@ -0,0 +1,10 @@
+import json
+from pathlib import Path
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def load_fixture(filename):
+    """Load a test fixture from the fixtures directory"""
+    with open(FIXTURES / filename, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,292 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from app.backends import AdaptiveLimiter, BackendPool, BackendTimeoutError, CircuitBreaker, is_overload
+from app.main import app
+from app.textract_helper import analyze_1040
+from app.vlm_helper import extract_fields_with_vlm
+from tests.conftest import load_fixture
+from tests.textract_stub import OverloadedTextract
+from tests.vlm_stub import StubVlmServer
+
+
+def fast_pool(name="textract", max_concurrency=16, **kwargs):
+    """A pool that retries quickly, so overload tests run in well under a second"""
+    options = dict(max_attempts=8, deadline_seconds=5.0, retry_base_seconds=0.005, retry_max_seconds=0.05)
+    options.update(kwargs)
+    return BackendPool(name, max_concurrency=max_concurrency, timeout_seconds=5.0, **options)
+
+
+async def post_concurrently(count):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        return await asyncio.gather(*[
+            http.post("/parse-1040", files={"file": (f"doc_{i}.pdf", f"backend doc {i}".encode(), "application/pdf")})
+            for i in range(count)
+        ])
+
+
+class TestAdaptiveLimiter:
+    """AIMD limit arithmetic and slot handling"""
+
+    def test_one_decrease_per_window(self):
+        """A burst of throttles from calls started before the decrease halves the limit once"""
+        limiter = AdaptiveLimiter(initial=16, min_limit=2)
+        started = time.monotonic()
+        for _ in range(5):
+            limiter.on_overload(started)
+        assert limiter.limit == 8
+
+        limiter.on_overload(time.monotonic())
+        assert limiter.limit == 4
+
+    def test_additive_increase_only_when_used(self):
+        limiter = AdaptiveLimiter(initial=4, max_limit=8)
+        limiter.limit = 4.0
+        limiter.in_flight = 0
+        limiter.on_success(time.monotonic(), 0.01)
+        assert limiter.limit == 4
+
+        limiter.in_flight = 4
+        for _ in range(4):
+            limiter.on_success(time.monotonic(), 0.01)
+        assert 4.9 < limiter.limit < 5.0
+
+    def test_slow_calls_count_as_overload(self):
+        limiter = AdaptiveLimiter(initial=8, latency_threshold=0.5)
+        limiter.on_success(time.monotonic(), 2.0)
+        assert limiter.limit == 4
+
+    def test_waiters_get_freed_slots(self):
+        async def scenario():
+            limiter = AdaptiveLimiter(initial=1)
+            await limiter.acquire()
+            waiter = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0.01)
+            assert not waiter.done() and limiter.queued == 1
+            limiter.release()
+            await asyncio.wait_for(waiter, 1)
+            with pytest.raises(asyncio.TimeoutError):
+                await limiter.acquire(timeout=0.01)
+            return limiter
+
+        limiter = asyncio.run(scenario())
+        assert limiter.in_flight == 1 and limiter.queued == 0
+
+
+class TestCircuitBreaker:
+    """Closed -> open -> half open -> closed"""
+
+    def test_opens_then_probes(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.05)
+        for _ in range(3):
+            assert breaker.allow()
+            breaker.record_failure()
+        assert not breaker.allow()
+        assert breaker.stats()["breaker_state"] == 2
+
+        time.sleep(0.06)
+        assert breaker.allow()
+        # Only one probe at a time
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.allow() and breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        assert breaker.allow()
+        breaker.record_failure()
+        assert not breaker.available()
+        assert breaker.opens == 2
+
+
+class TestBackendPoolUnderOverload:
+    """The pool against a local Textract that throttles past its capacity"""
+
+    def test_backs_off_to_backend_capacity(self):
+        """Every call succeeds and the limit comes down towards what the backend serves"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), capacity=4, latency_seconds=0.02)
+        pool = fast_pool(max_concurrency=16)
+
+        async def burst():
+            return await asyncio.gather(*[pool.run(analyze_1040, b"doc", textract) for _ in range(48)])
+
+        try:
+            responses = asyncio.run(burst())
+        finally:
+            pool.shutdown()
+
+        assert all(response["Blocks"] for response in responses)
+        assert pool.limiter.limit < 16
+        stats = pool.stats()
+        assert stats["overloads"] == textract.throttled > 0
+        assert stats["retries"] >= textract.throttled
+        assert stats["breaker_state"] == 0
+
+    def test_retries_stop_at_deadline(self):
+        """A backend that never recovers fails the call within the deadline, not after every attempt"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'))
+        textract.outage = True
+        pool = fast_pool(max_attempts=1000, deadline_seconds=0.2, retry_base_seconds=0.01, retry_max_seconds=0.02,
+                         breaker=CircuitBreaker(failure_threshold=10000))
+
+        start = time.perf_counter()
+        with pytest.raises(Exception) as excinfo:
+            asyncio.run(pool.run(analyze_1040, b"doc", textract))
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+
+        assert is_overload(excinfo.value)
+        assert elapsed < 0.4
+        assert 1 < textract.calls < 1000
+
+    def test_queue_wait_counts_against_the_deadline(self):
+        """A call that queued for a slot gets only what is left of its deadline, not a fresh timeout"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), latency_seconds=0.3)
+        pool = fast_pool(max_concurrency=1, max_attempts=1, deadline_seconds=0.4)
+
+        async def saturated():
+            return await asyncio.gather(*[pool.run(analyze_1040, b"doc", textract) for _ in range(2)],
+                                        return_exceptions=True)
+
+        start = time.perf_counter()
+        first, second = asyncio.run(saturated())
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+
+        assert first["Blocks"]
+        assert isinstance(second, BackendTimeoutError)
+        assert elapsed < 0.5
+
+    def test_breaker_fails_fast_during_outage(self):
+        """Once open, calls are rejected without reaching the backend"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'))
+        textract.outage = True
+        pool = fast_pool(max_attempts=1, breaker=CircuitBreaker(failure_threshold=3, reset_seconds=60))
+
+        async def calls():
+            outcomes = []
+            for _ in range(6):
+                try:
+                    await pool.run(analyze_1040, b"doc", textract)
+                except Exception as e:
+                    outcomes.append(type(e).__name__)
+            return outcomes
+
+        outcomes = asyncio.run(calls())
+        pool.shutdown()
+
+        assert outcomes == ["ClientError"] * 3 + ["BackendUnavailableError"] * 3
+        assert textract.calls == 3
+        assert pool.stats()["rejections"] == 3
+
+    def test_timeouts_shrink_the_limit(self):
+        """A call slower than the timeout is overload, its slot stays taken until the thread finishes"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), latency_seconds=0.2)
+        pool = BackendPool("textract", max_concurrency=4, timeout_seconds=0.02)
+
+        with pytest.raises(BackendTimeoutError):
+            asyncio.run(pool.run(analyze_1040, b"doc", textract))
+        assert pool.limiter.limit == 2
+        assert pool.limiter.in_flight == 1
+        pool.shutdown()
+
+    def test_vlm_throttling_is_retried(self, monkeypatch):
+        """429s from the VLM server are overload too, retried until the server has room"""
+        with StubVlmServer(capacity=1, latency_seconds=0.05) as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            pool = fast_pool("vlm", max_concurrency=4)
+
+            async def burst():
+                return await asyncio.gather(*[pool.run(extract_fields_with_vlm, b"image", ("line_9",))
+                                              for _ in range(4)])
+
+            results = asyncio.run(burst())
+            pool.shutdown()
+
+        assert [result["line_9"] for result in results] == [280300.0] * 4
+        assert stub.rejected > 0
+        assert pool.stats()["overloads"] == stub.rejected
+
+
+class TestFailover:
+    """An unhealthy backend is routed around"""
+
+    def setup_method(self):
+        self.saved_state = {name: getattr(app.state, name, None)
+                            for name in ("textract_client", "textract_pool", "vlm_pool")}
+
+    def teardown_method(self):
+        for name in ("textract_pool", "vlm_pool"):
+            if getattr(app.state, name, None) is not None:
+                getattr(app.state, name).shutdown()
+        for name, value in self.saved_state.items():
+            setattr(app.state, name, value)
+
+    def test_one_retry_layer(self, monkeypatch):
+        """The pool retries a throttled document, the job engine does not retry it again on top"""
+        monkeypatch.setenv("TEXTRACT_FAILOVER_TO_VLM", "false")
+        monkeypatch.setattr(app.state, "job_engine", None, raising=False)
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'))
+        textract.outage = True
+        app.state.textract_client = textract
+        app.state.textract_pool = fast_pool(max_attempts=3, breaker=CircuitBreaker(failure_threshold=100))
+
+        (response,) = asyncio.run(post_concurrently(1))
+
+        assert response.json()["success"] is False
+        assert "ServiceUnavailableException" in response.json()["error"]
+        assert textract.calls == 3
+
+    @patch('app.main.extract_fields_with_vlm')
+    def test_textract_outage_goes_to_vlm(self, mock_vlm):
+        """Textract's outage opens its breaker, the same attempt then goes to the VLM for the whole page"""
+        textract = OverloadedTextract(load_fixture('2024_samuel_singletary.json'))
+        textract.outage = True
+        app.state.textract_client = textract
+        app.state.textract_pool = fast_pool(max_attempts=1, breaker=CircuitBreaker(failure_threshold=1,
+                                                                                   reset_seconds=60))
+        app.state.vlm_pool = fast_pool("vlm", max_attempts=1)
+        mock_vlm.return_value = {"line_9": 280300.0, "line_10": 9631.0, "line_11": 270669.0,
+                                 "line_12": 27800.0, "line_13": 0.0, "line_14": 27800.0, "usage": None}
+
+        (response,) = asyncio.run(post_concurrently(1))
+
+        assert response.json()["success"] is True
+        assert response.json()["fields"]["source"] == "vlm"
+        assert textract.calls == 1
+        mock_vlm.assert_called_once()
+
+    @patch('app.main.extract_fields_with_vlm')
+    def test_vlm_outage_keeps_textract_result(self, mock_vlm):
+        """With the VLM's breaker open, Textract's reading is returned without a VLM call"""
+        app.state.textract_client = OverloadedTextract(load_fixture('sample_1040_invalid.json'))
+        app.state.textract_pool = fast_pool(max_attempts=1)
+        app.state.vlm_pool = fast_pool("vlm", breaker=CircuitBreaker(failure_threshold=1, reset_seconds=60))
+        app.state.vlm_pool.breaker.record_failure()
+
+        (response,) = asyncio.run(post_concurrently(1))
+
+        assert response.json()["fields"]["source"] == "textract"
+        mock_vlm.assert_not_called()
+
+    def test_limiter_state_in_metrics(self):
+        app.state.textract_pool = fast_pool(max_concurrency=6)
+        app.state.vlm_pool = fast_pool("vlm", max_concurrency=2)
+
+        async def scrape():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return (await http.get("/metrics")).text, (await http.get("/backends/stats")).json()
+
+        body, stats = asyncio.run(scrape())
+
+        assert "backend_textract_limit 6" in body
+        assert "backend_vlm_breaker_state 0" in body
+        assert stats["vlm"]["limit"] == 2
@@ -0,0 +1,172 @@
+import json
+import shutil
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+from fastapi.testclient import TestClient
+
+import pytest
+
+from app.batch import completed_paths, iter_input_paths, parse_path, parse_stored_response, run_batch
+from app.main import app
+from app.pipeline import build_block_index, child_text_retriever
+from app.replay import replay_path
+from tests.conftest import FIXTURES, load_fixture
+from tests.textract_stub import client_error
+
+client = TestClient(app)
+
+
+def read_ndjson(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def without_line(response, line_number):
+    """Response with the key/value pair of one line dropped, as if Textract missed it"""
+    index = build_block_index(response["Blocks"])
+    dropped = {block["Id"] for block in response["Blocks"]
+               if "KEY" in block.get("EntityTypes", [])
+               and child_text_retriever(index, block).startswith(f"{line_number} ")}
+    return {**response, "Blocks": [block for block in response["Blocks"] if block["Id"] not in dropped]}
+
+
+class TestBatchCli:
+    """Tests for the offline batch driver"""
+
+    def test_parses_stored_responses(self, tmp_path):
+        """Every stored Textract response becomes one NDJSON line"""
+        input_dir = tmp_path / "in"
+        (input_dir / "nested").mkdir(parents=True)
+        shutil.copy(FIXTURES / "2024_samuel_singletary.json", input_dir / "a.json")
+        shutil.copy(FIXTURES / "2024_peter_and_paula_professor.json", input_dir / "nested" / "b.json")
+        (input_dir / "notes.txt").write_text("ignored")
+        output = tmp_path / "out.ndjson"
+
+        counts = run_batch(input_dir, output, workers=2)
+
+        assert counts == {"processed": 2, "skipped": 0, "failed": 0}
+        records = {Path(r["path"]).name: r for r in read_ndjson(output)}
+        assert records["a.json"]["fields"]["line_11"] == 270669.0
+        assert records["b.json"]["success"] is True
+
+    @pytest.mark.parametrize("fixture", ["2024_samuel_singletary.json", "2024_peter_and_paula_professor.json"])
+    def test_stored_response_matches_replay(self, tmp_path, fixture):
+        """Batch and replay run the same pipeline: pages, forms and the geometry fill for missed lines"""
+        for line_number in (None, 9, 10, 11):
+            response = load_fixture(fixture)
+            if line_number is not None:
+                response = without_line(response, line_number)
+            path = tmp_path / f"{line_number}.json"
+            path.write_text(json.dumps(response))
+
+            batch_result = parse_stored_response(path).model_dump()
+
+            assert batch_result == replay_path(path).model_dump()
+            assert batch_result["success"] is True
+
+    def test_resume_skips_completed_paths(self, tmp_path):
+        """A re-run only processes inputs missing from the output file"""
+        input_dir = tmp_path / "in"
+        input_dir.mkdir()
+        shutil.copy(FIXTURES / "2024_samuel_singletary.json", input_dir / "a.json")
+        shutil.copy(FIXTURES / "2024_peter_and_paula_professor.json", input_dir / "b.json")
+        output = tmp_path / "out.ndjson"
+        first_path = str(next(iter_input_paths(input_dir)))
+        output.write_text(json.dumps({"path": first_path, "success": True}) + "\n")
+
+        counts = run_batch(input_dir, output, workers=1)
+
+        assert counts == {"processed": 1, "skipped": 1, "failed": 0}
+        assert len(read_ndjson(output)) == 2
+
+    def test_partial_last_line_is_truncated(self, tmp_path):
+        """A line cut off by a crash is dropped so that document is redone"""
+        output = tmp_path / "out.ndjson"
+        output.write_text('{"path": "a.json", "success": true}\n{"path": "b.js')
+
+        assert completed_paths(output) == {"a.json"}
+        assert output.read_text() == '{"path": "a.json", "success": true}\n'
+
+    def test_bad_input_is_reported_not_raised(self, tmp_path):
+        """A corrupt file fails its own line and the run carries on"""
+        input_dir = tmp_path / "in"
+        input_dir.mkdir()
+        (input_dir / "broken.json").write_text("{not json")
+        output = tmp_path / "out.ndjson"
+
+        counts = run_batch(input_dir, output, workers=1)
+
+        assert counts == {"processed": 1, "skipped": 0, "failed": 1}
+        assert read_ndjson(output)[0]["success"] is False
+
+
+    @patch('app.textract_helper.boto3.client')
+    def test_throttled_ocr_is_retried(self, mock_boto_client, tmp_path, monkeypatch):
+        """The CLI calls Textract without the API, its pool still retries a throttled page"""
+        monkeypatch.setattr("app.batch._textract_client", None)
+        monkeypatch.setattr("app.batch._textract_pool", None)
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.side_effect = [client_error("ThrottlingException"),
+                                                      load_fixture('2024_samuel_singletary.json')]
+        (tmp_path / "scan.pdf").write_bytes(b"scanned return")
+
+        result = parse_path(tmp_path / "scan.pdf")
+
+        assert result.success is True
+        assert result.fields["line_11"] == 270669.0
+        assert mock_textract.analyze_document.call_count == 2
+
+
+class TestBatchEndpoint:
+    """Tests for POST /parse-1040/batch"""
+
+    @patch('app.textract_helper.boto3.client')
+    def test_streams_one_line_per_upload(self, mock_boto_client):
+        """Uploads are parsed and streamed back as NDJSON"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        response = client.post(
+            "/parse-1040/batch",
+            files=[
+                ("files", ("first.pdf", BytesIO(b"first"), "application/pdf")),
+                ("files", ("second.pdf", BytesIO(b"second"), "application/pdf")),
+                ("files", ("notes.txt", BytesIO(b"text"), "text/plain")),
+            ]
+        )
+
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        records = {r["name"]: r for r in map(json.loads, response.text.splitlines())}
+        assert records["first.pdf"]["fields"]["line_11"] == 270669.0
+        assert records["second.pdf"]["success"] is True
+        assert records["notes.txt"]["error"] == "Only PDF files are supported"
+
+    def test_manifest_paths_stay_under_batch_root(self, tmp_path, monkeypatch):
+        """Manifest entries resolve under BATCH_ROOT and cannot escape it"""
+        shutil.copy(FIXTURES / "2024_samuel_singletary.json", tmp_path / "a.json")
+        monkeypatch.setenv("BATCH_ROOT", str(tmp_path))
+        manifest = json.dumps(["a.json", "../etc/passwd.json"]).encode()
+
+        response = client.post(
+            "/parse-1040/batch",
+            files={"manifest": ("manifest.json", BytesIO(manifest), "application/json")}
+        )
+
+        records = {r["name"]: r for r in map(json.loads, response.text.splitlines())}
+        assert records["a.json"]["fields"]["line_9"] == 280300.0
+        assert records["../etc/passwd.json"]["error"] == "Path is outside BATCH_ROOT"
+
+    def test_manifest_needs_batch_root(self, monkeypatch):
+        """Without BATCH_ROOT manifest paths are refused"""
+        monkeypatch.delenv("BATCH_ROOT", raising=False)
+        response = client.post(
+            "/parse-1040/batch",
+            files={"manifest": ("manifest.json", BytesIO(b'["a.json"]'), "application/json")}
+        )
+        record = json.loads(response.text)
+        assert record["success"] is False
+        assert "BATCH_ROOT" in record["error"]
@@ -0,0 +1,39 @@
+
+from app.pipeline import fields_from_blocks
+from benchmarks.suite import compare_to_baseline, paginate_blocks, scale_blocks
+from tests.conftest import load_fixture
+
+
+def suite_results(**medians):
+    return {"results": {key: {"median_seconds": value} for key, value in medians.items()}}
+
+
+class TestBenchmarkSuite:
+    """Tests for the synthetic documents and baseline comparison of the benchmark suite"""
+
+    def test_scaled_documents_parse_like_the_original(self):
+        """Scaled and paginated copies keep relationships intact"""
+        blocks = load_fixture('2024_samuel_singletary.json')['Blocks']
+        original, _ = fields_from_blocks(blocks)
+        scaled = scale_blocks(blocks, 10)
+
+        assert len(scaled) == 10 * len(blocks)
+        assert len({block["Id"] for block in scaled}) == len(scaled)
+        assert fields_from_blocks(scaled)[0].fields == original.fields
+        assert fields_from_blocks(paginate_blocks(blocks, 3))[0].fields["line_11"] == 270669.0
+
+    def test_only_slowdowns_past_threshold_are_regressions(self):
+        """A stage fails only when its median grows by more than the threshold"""
+        baseline = suite_results(**{"a/doc": 1e-3, "b/doc": 1e-3, "c/doc": 1e-3})
+        current = suite_results(**{"a/doc": 1.4e-3, "b/doc": 1.6e-3, "c/doc": 0.5e-3, "new/doc": 1.0})
+
+        regressions = compare_to_baseline(current, baseline, threshold=0.5)
+
+        assert [r["stage"] for r in regressions] == ["b/doc"]
+        assert regressions[0]["ratio"] == 1.6
+
+    def test_timer_noise_is_ignored(self):
+        """Sub-microsecond stages are too noisy to compare"""
+        regressions = compare_to_baseline(suite_results(**{"a/doc": 1.5e-6}),
+                                          suite_results(**{"a/doc": 1e-7}), threshold=0.5)
+        assert regressions == []
@@ -0,0 +1,131 @@
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+from fastapi.testclient import TestClient
+
+from app.cache import ResultCache, MemoryTier, document_hash
+from app.main import app
+from tests.conftest import load_fixture
+
+client = TestClient(app)
+
+
+class TestResultCache:
+    """Tests for the content-addressed result cache"""
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        """Oldest untouched entry is evicted once the tier is full"""
+        tier = MemoryTier(max_entries=2, max_bytes=1024, ttl_seconds=0)
+        tier.set("a", b"1")
+        tier.set("b", b"2")
+        tier.get("a")
+        tier.set("c", b"3")
+        assert tier.get("b") is None
+        assert tier.get("a") == b"1"
+        assert tier.evictions == 1
+
+    def test_memory_tier_expires_entries(self):
+        """Entries older than the TTL are dropped on read"""
+        tier = MemoryTier(max_entries=2, max_bytes=1024, ttl_seconds=10)
+        with patch("app.cache.time.monotonic", return_value=100.0):
+            tier.set("a", b"1")
+        with patch("app.cache.time.monotonic", return_value=111.0):
+            assert tier.get("a") is None
+        assert tier.expirations == 1
+
+    def test_fields_keyed_by_parser_version(self):
+        """A new parser version misses on fields but still hits on blocks"""
+        cache = ResultCache()
+        doc_hash = document_hash(b"doc")
+        cache.set_blocks(doc_hash, [{"Id": "1"}], textract_seconds=2.0)
+        cache.set_result(doc_hash, "1", {"fields": {"line_9": 1.0}}, textract_seconds=2.0)
+
+        assert cache.get_result(doc_hash, "1") == {"fields": {"line_9": 1.0}}
+        assert cache.get_result(doc_hash, "2") is None
+        assert cache.get_blocks(doc_hash) == [{"Id": "1"}]
+
+        stats = cache.stats()
+        assert stats["fields_memory_hits"] == 1
+        assert stats["fields_misses"] == 1
+        assert stats["blocks_memory_hits"] == 1
+        assert stats["textract_calls_saved"] == 2
+        assert stats["textract_seconds_saved"] == 4.0
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        """Entries written to SQLite are visible to a fresh cache instance"""
+        db_path = str(tmp_path / "cache.db")
+        ResultCache(db_path=db_path).set_blocks("abc", [{"Id": "1"}], textract_seconds=1.0)
+
+        restarted = ResultCache(db_path=db_path)
+        assert restarted.get_blocks("abc") == [{"Id": "1"}]
+        assert restarted.stats()["blocks_disk_hits"] == 1
+        # Promoted into memory on the first disk hit
+        assert restarted.get_blocks("abc") == [{"Id": "1"}]
+        assert restarted.stats()["blocks_memory_hits"] == 1
+
+    @patch('app.textract_helper.boto3.client')
+    def test_repeat_upload_skips_textract(self, mock_boto_client):
+        """Second upload of the same bytes is served without calling Textract"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        with patch("app.main.result_cache", ResultCache()):
+            responses = [
+                client.post(
+                    "/parse-1040",
+                    files={"file": ("test_1040.pdf", BytesIO(b"same pdf content"), "application/pdf")}
+                )
+                for _ in range(2)
+            ]
+            stats = client.get("/cache/stats").json()
+
+        assert responses[0].json() == responses[1].json()
+        assert responses[1].json()['fields']['line_11'] == 270669.0
+        mock_textract.analyze_document.assert_called_once()
+        assert stats["enabled"] is True
+        assert stats["fields_memory_hits"] == 1
+
+    @patch('app.textract_helper.boto3.client')
+    def test_parser_version_bump_rederives_from_blocks(self, mock_boto_client):
+        """Changing the parser version reuses cached blocks instead of Textract"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        cache = ResultCache()
+        with patch("app.main.result_cache", cache):
+            client.post(
+                "/parse-1040",
+                files={"file": ("test_1040.pdf", BytesIO(b"same pdf content"), "application/pdf")}
+            )
+            with patch("app.main.PARSER_VERSION", "next"):
+                response = client.post(
+                    "/parse-1040",
+                    files={"file": ("test_1040.pdf", BytesIO(b"same pdf content"), "application/pdf")}
+                )
+
+        assert response.json()['fields']['line_9'] == 280300.0
+        mock_textract.analyze_document.assert_called_once()
+        assert cache.stats()["blocks_memory_hits"] == 1
+
+    @patch('app.textract_helper.boto3.client')
+    def test_result_from_previous_parser_version_is_not_served(self, mock_boto_client):
+        """Fields cached before the current parser version are re-derived, not returned"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        cache = ResultCache()
+        doc_hash = document_hash(b"same pdf content")
+        stale = {"success": True, "fields": {"line_9": 1.0}, "error": None}
+        cache.set_result(doc_hash, "1", stale, 0.5)
+        with patch("app.main.result_cache", cache):
+            response = client.post(
+                "/parse-1040",
+                files={"file": ("test_1040.pdf", BytesIO(b"same pdf content"), "application/pdf")}
+            )
+
+        assert response.json()['fields']['line_9'] == 280300.0
+        mock_textract.analyze_document.assert_called_once()
+        assert cache.get_result(doc_hash, "1") == stale
@@ -0,0 +1,109 @@
+import json
+import math
+
+import numpy as np
+
+from app.columnar import ResultTable, main, normalize_money, run_cross_checks
+from app.models import Form1040DynamicFields
+from app.pipeline import match_1040_fields, parse_money, textract_to_dict
+from app.rules import CrossCheck
+from tests.conftest import FIXTURES, load_fixture
+
+
+def record(path, **fields):
+    return {"path": path, "success": True, "error": None, "fields": fields}
+
+
+class TestNormalizeMoney:
+    """Bulk money string normalisation"""
+
+    def test_matches_parse_money(self):
+        values = ["1,234.", "$12", "", None, "abc", "-", "1.2.3", "USD 1 234", "-42.5", "9,631.", "1e5", ".5", "1-2"]
+        expected = [parse_money(value) for value in values]
+        for value, got, want in zip(values, normalize_money(values).tolist(), expected):
+            assert (math.isnan(got) and want is None) or got == want, value
+
+    def test_parentheses_are_negative(self):
+        assert normalize_money(["(5,000.)", "( 7 )", "(12)"]).tolist() == [-5000.0, -7.0, -12.0]
+
+    def test_empty(self):
+        assert normalize_money([]).shape == (0,)
+
+
+class TestResultTable:
+    """Building columns from batch output and raw key/values"""
+
+    def test_key_values_match_single_document_path(self):
+        """Same lines as match_1040_fields for every fixture"""
+        rows = [(path.stem, textract_to_dict(load_fixture(path.name)["Blocks"])) for path in sorted(FIXTURES.glob("*.json"))]
+        table = ResultTable.from_key_values(rows)
+
+        for i, (_, textract_dict) in enumerate(rows):
+            fields = match_1040_fields(textract_dict).fields
+            for line, column in table.columns.items():
+                assert (fields[line] == column[i]) if line in fields else np.isnan(column[i])
+
+    def test_records_with_strings_and_failures(self):
+        table = ResultTable.from_records([
+            record("a.pdf", line_9=100.0, line_10="(20.)", line_11="120"),
+            {"path": "b.pdf", "success": False, "error": "Textract error: boom", "fields": None},
+        ])
+        assert table.columns["line_10"][0] == -20.0
+        assert np.isnan(table.columns["line_9"][1])
+        assert table.success.tolist() == [True, False]
+
+
+class TestCrossChecks:
+    """Vectorised cross-checks and their failure reasons"""
+
+    def test_agrees_with_scalar_validators(self):
+        records = [
+            record("ok.pdf", line_9=100.0, line_10=20.0, line_11=80.0, line_12=10.0, line_13=5.0, line_14=15.0),
+            record("blank_12_13.pdf", line_9=100.0, line_10=20.0, line_11=80.0, line_14=0.0),
+            record("bad_11.pdf", line_9=100.0, line_10=20.0, line_11=90.0, line_14=0.0),
+            record("no_10.pdf", line_9=100.0, line_11=80.0, line_14=0.0),
+            record("no_14.pdf", line_9=100.0, line_10=20.0, line_11=80.0, line_12=10.0),
+        ]
+        results = run_cross_checks(ResultTable.from_records(records))
+
+        for i, rec in enumerate(records):
+            dyn = Form1040DynamicFields(fields=rec["fields"])
+            expected = (Form1040DynamicFields.validate_line_11_totals(dyn)
+                        and Form1040DynamicFields.validate_line_14_totals(dyn))
+            assert results.valid[i] == expected, rec["path"]
+
+    def test_failure_reasons(self):
+        table = ResultTable.from_records([
+            record("ok.pdf", line_9=100.0, line_10=20.0, line_11=80.0, line_14=0.0),
+            record("bad.pdf", line_9=100.0, line_10=20.0, line_11=90.0),
+            {"path": "failed.pdf", "success": False, "error": "Could not parse all required fields", "fields": None},
+        ])
+        reasons = run_cross_checks(table).failure_reasons()
+
+        assert reasons == {
+            1: ["line_11_totals: line_11 = line_9 - line_10 is off by 10.00", "line_14_totals: missing line_14"],
+            2: ["not parsed: Could not parse all required fields"],
+        }
+
+    def test_new_rule(self):
+        """Checks are data, a new rule needs no new code"""
+        check = CrossCheck("line_11_floor", "line_11", (("line_9", 1), ("line_10", -1), ("line_13", 1)),
+                           blank_as_zero=("line_13",))
+        table = ResultTable.from_records([record("a.pdf", line_9=100.0, line_10=20.0, line_11=80.0)])
+        results = run_cross_checks(table, (check,))
+        assert results.valid.tolist() == [True]
+        assert check.describe() == "line_11 = line_9 - line_10 + line_13"
+
+    def test_cli_report(self, tmp_path, capsys):
+        results_path = tmp_path / "results.ndjson"
+        report_path = tmp_path / "failures.ndjson"
+        with open(results_path, "w") as f:
+            f.write(json.dumps(record("ok.pdf", line_9=100.0, line_10=20.0, line_11=80.0, line_14=0.0)) + "\n")
+            f.write(json.dumps(record("bad.pdf", line_9=100.0, line_10=20.0, line_11=90.0, line_14=0.0)) + "\n")
+
+        main([str(results_path), "--report", str(report_path)])
+
+        summary = json.loads(capsys.readouterr().out)
+        assert summary == {"rows": 2, "parsed": 2, "valid": 1, "failed_line_11_totals": 1, "failed_line_14_totals": 0}
+        (line,) = report_path.read_text().splitlines()
+        assert json.loads(line)["path"] == "bad.pdf"
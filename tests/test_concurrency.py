@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import httpx
+
+from app.backends import BackendPool
+from app.main import app
+from tests.conftest import load_fixture
+from tests.textract_stub import OverloadedTextract
+
+
+async def post_concurrently(count, identical=False):
+    """Fire count uploads at once against the app in-process"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        return await asyncio.gather(*[
+            http.post("/parse-1040", files={
+                "file": (f"doc_{i}.pdf", b"same doc" if identical else f"doc {i}".encode(), "application/pdf")
+            })
+            for i in range(count)
+        ])
+
+
+class TestConcurrentParsing:
+    """Textract calls must not block the event loop"""
+
+    def setup_method(self):
+        self.saved_state = {name: getattr(app.state, name, None)
+                            for name in ("textract_client", "textract_pool")}
+
+    def teardown_method(self):
+        if app.state.textract_pool is not None:
+            app.state.textract_pool.shutdown()
+        for name, value in self.saved_state.items():
+            setattr(app.state, name, value)
+
+    def test_concurrent_uploads_overlap(self):
+        """Eight uploads with 0.3s of Textract latency each finish in well under 8 x 0.3s"""
+        app.state.textract_client = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), latency_seconds=0.3)
+        app.state.textract_pool = BackendPool("textract", max_concurrency=8, timeout_seconds=5)
+
+        start = time.perf_counter()
+        responses = asyncio.run(post_concurrently(8))
+        elapsed = time.perf_counter() - start
+
+        assert all(r.json()['fields']['line_11'] == 270669.0 for r in responses)
+        assert elapsed < 1.2
+
+    def test_identical_uploads_share_one_textract_call(self):
+        """Concurrent uploads of the same bytes are answered from a single OCR call"""
+        stub = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), latency_seconds=0.2)
+        app.state.textract_client = stub
+        app.state.textract_pool = BackendPool("textract", max_concurrency=8, timeout_seconds=5)
+
+        responses = asyncio.run(post_concurrently(6, identical=True))
+
+        assert stub.calls == 1
+        assert all(r.json() == responses[0].json() for r in responses)
+        assert responses[0].json()['fields']['line_11'] == 270669.0
+
+    def test_timeout_returns_textract_error(self):
+        """A Textract call slower than the pool timeout fails that request only"""
+        app.state.textract_client = OverloadedTextract(load_fixture('2024_samuel_singletary.json'), latency_seconds=0.5)
+        app.state.textract_pool = BackendPool("textract", max_concurrency=2, timeout_seconds=0.05)
+
+        (response,) = asyncio.run(post_concurrently(1))
+
+        data = response.json()
+        assert data['success'] is False
+        assert 'timed out' in data['error']
@@ -1,21 +1,13 @@
-import json
 from unittest.mock import patch, MagicMock
 from fastapi.testclient import TestClient
-from pathlib import Path
 from io import BytesIO
 
 from app.main import app
+from tests.conftest import load_fixture
 
 client = TestClient(app)
 
 
-def load_fixture(filename):
-    """Load a test fixture from the fixtures directory"""
-    fixture_path = Path(__file__).parent / "fixtures" / filename
-    with open(fixture_path, 'r') as f:
-        return json.load(f)
-
-
 class TestParse1040:
     """End-to-end tests for the 1040 parser"""
     
@@ -0,0 +1,102 @@
+
+from app.forms import FORMS, FormRegistry
+from app.models import Form1040DynamicFields
+from app.pipeline import extract_forms, form_1040_dict, textract_to_dict
+from app.rules import FORM_1040_CROSS_CHECKS
+from benchmarks.bench_forms import SAMPLE_PAGES
+from tests.conftest import load_fixture
+
+
+def key_value_page(page_number, header, key_values):
+    """Textract blocks for one page: a header LINE and a KEY_VALUE_SET per key/value"""
+    blocks = [{"BlockType": "LINE", "Id": f"p{page_number}-header", "Text": header, "Page": page_number}]
+    for i, (key_text, value_text) in enumerate(key_values.items()):
+        prefix = f"p{page_number}-{i}"
+        blocks += [
+            {"BlockType": "KEY_VALUE_SET", "Id": f"{prefix}-key", "EntityTypes": ["KEY"], "Page": page_number,
+             "Relationships": [{"Type": "CHILD", "Ids": [f"{prefix}-key-word"]},
+                               {"Type": "VALUE", "Ids": [f"{prefix}-value"]}]},
+            {"BlockType": "KEY_VALUE_SET", "Id": f"{prefix}-value", "EntityTypes": ["VALUE"], "Page": page_number,
+             "Relationships": [{"Type": "CHILD", "Ids": [f"{prefix}-value-word"]}] if value_text else []},
+            {"BlockType": "WORD", "Id": f"{prefix}-key-word", "Text": key_text, "Page": page_number},
+            {"BlockType": "WORD", "Id": f"{prefix}-value-word", "Text": value_text, "Page": page_number},
+        ]
+    return blocks
+
+
+class TestFormRegistry:
+    """Per-form rule tables, compiled on first use"""
+
+    def test_tables_compile_on_first_use(self):
+        registry = FormRegistry()
+        registry.register(FORMS.get("schedule_a"))
+        assert registry.compiled_forms() == ()
+
+        compiled = registry.compiled("schedule_a")
+        assert registry.compiled_forms() == ("schedule_a",)
+        assert registry.compiled("schedule_a") is compiled
+
+    def test_every_requested_form_is_registered(self):
+        for form_type in ("1040", "schedule_1", "schedule_a", "schedule_b", "form_w-2"):
+            spec = FORMS.get(form_type)
+            assert spec.rules and spec.cross_checks and spec.fingerprint
+
+    def test_1040_validators_run_the_declared_checks(self):
+        """validate_line_11/14_totals keep their semantics, blank 12 and 13 count as 0"""
+        cases = [
+            {"line_9": 100.0, "line_10": 10.0, "line_11": 90.0, "line_14": 0.0},
+            {"line_9": 100.0, "line_10": 10.0, "line_11": 91.0, "line_12": 5.0, "line_14": 5.0},
+            {"line_9": 100.0, "line_11": 90.0, "line_12": 5.0, "line_13": 1.0, "line_14": 6.0},
+            {"line_12": 5.0},
+        ]
+        expected = [(True, True), (False, True), (False, True), (False, False)]
+        for fields, (line_11_ok, line_14_ok) in zip(cases, expected):
+            dyn = Form1040DynamicFields(fields=fields)
+            assert Form1040DynamicFields.validate_line_11_totals(dyn) is line_11_ok
+            assert Form1040DynamicFields.validate_line_14_totals(dyn) is line_14_ok
+            assert [check.passes(fields) for check in FORM_1040_CROSS_CHECKS] == [line_11_ok, line_14_ok]
+
+
+class TestDispatch:
+    """Pages go to the right extractor by their keys when the header does not say"""
+
+    def test_fingerprint_picks_each_form(self):
+        pages = dict(SAMPLE_PAGES, **{"1040": textract_to_dict(load_fixture('2024_samuel_singletary.json')['Blocks'])})
+        for form_type, page in pages.items():
+            assert FORMS.fingerprint(page) == form_type
+
+    def test_fingerprint_needs_enough_evidence(self):
+        assert FORMS.fingerprint({}) is None
+        assert FORMS.fingerprint({"2 federal income tax withheld": "35,000.00"}) is None
+        assert FORMS.fingerprint({"wells fargo bank": "1,500."}) is None
+
+    def test_unlabelled_pages_are_extracted_by_their_form(self):
+        """A schedule page whose header was not read still gets its rules, defaults and checks"""
+        blocks = (load_fixture('2024_samuel_singletary.json')['Blocks']
+                  + key_value_page(2, "", SAMPLE_PAGES["schedule_a"])
+                  + key_value_page(3, "Form W-2 Wage and Tax Statement 2024", SAMPLE_PAGES["form_w-2"]))
+
+        _, forms = form_1040_dict(blocks)
+
+        schedule_a = forms["schedule_a"]
+        assert schedule_a["line_5a"] == 14000.0 and schedule_a["line_8a"] == 11500.0
+        assert schedule_a["line_17"] == 29500.0
+        # Blank and missing lines fall back to the declared defaults
+        assert schedule_a["line_9"] == 0.0 and schedule_a["line_13"] == 0.0
+        assert schedule_a["is_valid"] is True
+
+        w2 = forms["form_w-2"]
+        assert w2["box_1"] == 190000.0 and w2["box_4"] == 10453.2
+        assert w2["is_valid"] is True
+        assert not any(name.startswith("line_") for name in w2)
+
+    def test_failed_cross_check_marks_the_form_invalid(self):
+        page = dict(SAMPLE_PAGES["schedule_b"])
+        page["4 subtract line 3 from line 2. enter the result here and on form 1040 or 1040-sr, line 2b 4"] = "9,000."
+        forms = extract_forms({1: page}, {1: "schedule_b"})
+        assert forms["schedule_b"]["line_3"] == 0.0
+        assert forms["schedule_b"]["is_valid"] is False
+
+    def test_unregistered_forms_keep_generic_lines(self):
+        forms = extract_forms({1: {"7 gross income. add lines 5 and 6 7": "16,000."}}, {1: "schedule_c"})
+        assert forms == {"schedule_c": {"line_7": 16000.0}}
@@ -0,0 +1,453 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.jobs import CANCELLED, FAILED, SUCCEEDED, JobEngine
+from app.main import app
+from app.models import ParseResponse
+from tests.conftest import load_fixture
+
+
+class ThrottlingError(Exception):
+    """Shaped like botocore's ClientError for a throttled call"""
+
+    def __init__(self):
+        super().__init__("Rate exceeded")
+        self.response = {"Error": {"Code": "ThrottlingException"}}
+
+
+def ok(document_bytes):
+    return ParseResponse(success=True, fields={"doc": document_bytes.decode()})
+
+
+class TestJobEngine:
+    """Tests for queueing, priorities, failures and dedup"""
+
+    def test_higher_priority_runs_first(self):
+        """With one worker, queued jobs run by priority, then in submission order"""
+        order = []
+
+        async def parse(document_bytes):
+            order.append(document_bytes)
+            await asyncio.sleep(0)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse, workers=1)
+            jobs = [engine.submit(doc, priority)[0] for doc, priority in
+                    ((b"low", 0), (b"high", 5), (b"low2", 0), (b"urgent", 9))]
+            for job in jobs:
+                await engine.wait(job)
+
+        asyncio.run(scenario())
+        # Workers only start once the submitting coroutine yields, so all four are queued
+        assert order == [b"urgent", b"high", b"low", b"low2"]
+
+    def test_backend_errors_are_not_retried(self):
+        """The backend pools already retried, a throttled parse fails the job on its one run"""
+        calls = []
+
+        async def parse(document_bytes):
+            calls.append(document_bytes)
+            raise ThrottlingError()
+
+        async def scenario():
+            engine = JobEngine(parse)
+            job, _ = engine.submit(b"doc")
+            await engine.wait(job)
+            return job
+
+        job = asyncio.run(scenario())
+        assert job.status == FAILED
+        assert calls == [b"doc"]
+        assert job.error == "ThrottlingError: Rate exceeded"
+
+    def test_failed_result_is_kept(self):
+        """A parse that returns an error finishes the job as failed with that error"""
+        async def parse(document_bytes):
+            return ParseResponse(success=False, error="Textract error: Rate exceeded")
+
+        async def scenario():
+            engine = JobEngine(parse)
+            job, _ = engine.submit(b"doc")
+            await engine.wait(job)
+            return job
+
+        job = asyncio.run(scenario())
+        assert job.status == FAILED
+        assert job.error == "Textract error: Rate exceeded"
+
+    def test_other_errors_fail_the_job(self):
+        """A bad document fails straight away"""
+        async def parse(document_bytes):
+            raise ValueError("corrupt")
+
+        async def scenario():
+            engine = JobEngine(parse)
+            job, _ = engine.submit(b"doc")
+            await engine.wait(job)
+            return job
+
+        job = asyncio.run(scenario())
+        assert job.status == FAILED
+        assert job.error == "ValueError: corrupt"
+
+    def test_cancelled_worker_fails_the_job(self):
+        """A worker cancelled mid-parse marks the job failed and releases its waiters"""
+        async def parse(document_bytes):
+            await asyncio.sleep(10)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse)
+            job, _ = engine.submit(b"doc")
+            caller = asyncio.ensure_future(engine.run(b"doc"))
+            await asyncio.sleep(0.01)
+            for task in list(engine._worker_tasks):
+                task.cancel()
+            result = await asyncio.wait_for(caller, timeout=1)
+            return engine, job, result
+
+        engine, job, result = asyncio.run(scenario())
+        assert result.success is False
+        assert job.status == FAILED
+        assert "cancelled" in job.error
+        assert engine.counters["failed"] == 1
+        assert engine.stats()["workers"] == 0
+
+    def test_identical_inflight_documents_share_a_job(self):
+        """Resubmitting a queued document returns the same job, once finished it runs again"""
+        calls = []
+
+        async def parse(document_bytes):
+            calls.append(document_bytes)
+            await asyncio.sleep(0.01)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse)
+            first, _ = engine.submit(b"doc")
+            second, deduplicated = engine.submit(b"doc")
+            assert second is first and deduplicated
+            await engine.wait(first)
+            third, deduplicated = engine.submit(b"doc")
+            assert third is not first and not deduplicated
+            await engine.wait(third)
+            return engine
+
+        engine = asyncio.run(scenario())
+        assert calls == [b"doc", b"doc"]
+        assert engine.counters["deduplicated"] == 1
+
+    def test_workers_run_concurrently_and_exit_when_idle(self):
+        """Jobs overlap up to the worker count and no worker task outlives the queue"""
+        async def parse(document_bytes):
+            await asyncio.sleep(0.1)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse, workers=4)
+            start = time.perf_counter()
+            jobs = [engine.submit(f"doc {i}".encode())[0] for i in range(4)]
+            for job in jobs:
+                await engine.wait(job)
+            elapsed = time.perf_counter() - start
+            await asyncio.sleep(0)
+            return engine, elapsed
+
+        engine, elapsed = asyncio.run(scenario())
+        assert elapsed < 0.3
+        assert engine.stats()["workers"] == 0
+
+    def test_finished_jobs_are_evicted(self):
+        """Only the newest max_retained jobs are kept"""
+        async def parse(document_bytes):
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse, max_retained=2)
+            jobs = [engine.submit(f"doc {i}".encode())[0] for i in range(3)]
+            for job in jobs:
+                await engine.wait(job)
+            return engine, jobs
+
+        engine, jobs = asyncio.run(scenario())
+        assert engine.get(jobs[0].id) is None
+        assert engine.get(jobs[2].id).status == SUCCEEDED
+
+
+class TestCoalescing:
+    """Tests for single-flight of identical synchronous requests"""
+
+    def test_concurrent_identical_requests_share_one_parse(self):
+        """Every caller gets the same response from a single parse"""
+        calls = []
+
+        async def parse(document_bytes):
+            calls.append(document_bytes)
+            await asyncio.sleep(0.05)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse)
+            results = await asyncio.gather(*[engine.run(b"doc") for _ in range(5)], engine.run(b"other"))
+            return engine, results
+
+        engine, results = asyncio.run(scenario())
+        assert calls == [b"doc", b"other"]
+        assert all(result is results[0] for result in results[:5])
+        assert engine.counters["coalesced"] == 4
+
+    def test_errors_reach_every_caller_and_are_not_cached(self):
+        """A failed parse is returned to all coalesced callers, the next request runs again"""
+        calls = []
+
+        async def parse(document_bytes):
+            calls.append(document_bytes)
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def scenario():
+            engine = JobEngine(parse)
+            first = await asyncio.gather(engine.run(b"doc"), engine.run(b"doc"))
+            second = await engine.run(b"doc")
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        assert [r.error for r in first] == ["ValueError: boom", "ValueError: boom"]
+        assert second.error == "ValueError: boom"
+        assert len(calls) == 2
+
+    def test_cancelled_caller_does_not_cancel_the_others(self):
+        """One caller going away leaves the shared parse running for the rest"""
+        started = []
+
+        async def parse(document_bytes):
+            started.append(document_bytes)
+            await asyncio.sleep(0.05)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse)
+            leaving = asyncio.ensure_future(engine.run(b"doc"))
+            staying = asyncio.ensure_future(engine.run(b"doc"))
+            await asyncio.sleep(0.01)
+            leaving.cancel()
+            return await staying, leaving
+
+        result, leaving = asyncio.run(scenario())
+        assert result.success is True
+        assert leaving.cancelled()
+        assert started == [b"doc"]
+
+    def test_job_nobody_waits_for_is_dropped_before_it_starts(self):
+        """When every caller of a queued job is cancelled the job never runs"""
+        started = []
+
+        async def parse(document_bytes):
+            started.append(document_bytes)
+            await asyncio.sleep(0.05)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse, workers=1)
+            busy = asyncio.ensure_future(engine.run(b"busy"))
+            abandoned = [asyncio.ensure_future(engine.run(b"doc")) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            for task in abandoned:
+                task.cancel()
+            await busy
+            await asyncio.sleep(0.01)
+            return engine
+
+        engine = asyncio.run(scenario())
+        assert started == [b"busy"]
+        assert engine.counters["cancelled"] == 1
+        assert [job.status for job in engine.jobs.values()] == [SUCCEEDED, CANCELLED]
+
+    def test_sync_request_joins_queued_job_at_higher_priority(self):
+        """A waiting client bumps a queued background job ahead of the rest"""
+        order = []
+
+        async def parse(document_bytes):
+            order.append(document_bytes)
+            await asyncio.sleep(0)
+            return ok(document_bytes)
+
+        async def scenario():
+            engine = JobEngine(parse, workers=1)
+            engine.submit(b"background 1")
+            job, _ = engine.submit(b"doc")
+            engine.submit(b"background 2")
+            result = await engine.run(b"doc", priority=10)
+            return engine, job, result
+
+        engine, job, result = asyncio.run(scenario())
+        assert order[0] == b"doc"
+        assert result is job.result
+        assert engine.counters["coalesced"] == 1
+
+
+class CallbackRecorder(BaseHTTPRequestHandler):
+    """Collects webhook POST bodies"""
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        CallbackRecorder.received.append(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestJobApi:
+    """Tests for the submit/poll endpoints"""
+
+    def poll(self, client, job_id):
+        for _ in range(100):
+            job = client.get(f"/parse-1040/jobs/{job_id}").json()
+            if job["status"] in (SUCCEEDED, FAILED):
+                return job
+            time.sleep(0.02)
+        raise AssertionError("job did not finish")
+
+    @patch('app.textract_helper.boto3.client')
+    def test_submit_and_poll(self, mock_boto_client):
+        """A submitted job can be polled until it has the parse result"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        with TestClient(app) as client:
+            submitted = client.post(
+                "/parse-1040/jobs",
+                files={"file": ("test_1040.pdf", BytesIO(b"job pdf content"), "application/pdf")},
+                data={"priority": "3"},
+            )
+            assert submitted.status_code == 202
+            job = self.poll(client, submitted.json()["job_id"])
+
+        assert job["priority"] == 3
+        assert job["result"]["fields"]["line_11"] == 270669.0
+
+    def test_unknown_job_is_404(self):
+        """Polling a job id that does not exist is a 404"""
+        with TestClient(app) as client:
+            assert client.get("/parse-1040/jobs/nope").status_code == 404
+
+    def test_rejects_non_pdf(self):
+        """Only PDFs can be queued"""
+        with TestClient(app) as client:
+            response = client.post(
+                "/parse-1040/jobs",
+                files={"file": ("notes.txt", BytesIO(b"text"), "text/plain")},
+            )
+        assert response.status_code == 400
+
+    @patch('app.textract_helper.boto3.client')
+    def test_webhook_receives_finished_job(self, mock_boto_client, monkeypatch):
+        """callback_url gets the finished job posted to it"""
+        monkeypatch.setenv("JOB_CALLBACK_ALLOWED_HOSTS", "127.0.0.1")
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_peter_and_paula_professor.json')
+
+        server = HTTPServer(("127.0.0.1", 0), CallbackRecorder)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        CallbackRecorder.received = []
+        try:
+            with TestClient(app) as client:
+                submitted = client.post(
+                    "/parse-1040/jobs",
+                    files={"file": ("test_1040.pdf", BytesIO(b"webhook pdf content"), "application/pdf")},
+                    data={"callback_url": f"http://127.0.0.1:{server.server_port}/done"},
+                )
+                job_id = submitted.json()["job_id"]
+                self.poll(client, job_id)
+                for _ in range(100):
+                    if CallbackRecorder.received:
+                        break
+                    time.sleep(0.02)
+        finally:
+            server.shutdown()
+
+        assert CallbackRecorder.received[0]["job_id"] == job_id
+        assert CallbackRecorder.received[0]["result"]["success"] is True
+
+    def test_callback_to_other_host_is_rejected(self, monkeypatch):
+        """Only allowlisted hosts receive the parsed return, anything else is refused up front"""
+        monkeypatch.setenv("JOB_CALLBACK_ALLOWED_HOSTS", "hooks.example.com")
+        with TestClient(app) as client:
+            for callback_url in ("http://169.254.169.254/latest/meta-data/", "http://localhost:8080/done",
+                                 "ftp://hooks.example.com/done"):
+                response = client.post(
+                    "/parse-1040/jobs",
+                    files={"file": ("test_1040.pdf", BytesIO(b"callback pdf content"), "application/pdf")},
+                    data={"callback_url": callback_url},
+                )
+                assert response.status_code == 400
+            assert client.app.state.job_engine.stats()["submitted"] == 0
+
+    def test_callbacks_refused_without_allowlist(self, monkeypatch):
+        monkeypatch.delenv("JOB_CALLBACK_ALLOWED_HOSTS", raising=False)
+        with TestClient(app) as client:
+            response = client.post(
+                "/parse-1040/jobs",
+                files={"file": ("test_1040.pdf", BytesIO(b"callback pdf content"), "application/pdf")},
+                data={"callback_url": "https://hooks.example.com/done"},
+            )
+        assert response.status_code == 400
+
+
+class TestCallbackAllowlist:
+    """JOB_CALLBACK_ALLOWED_HOSTS matching"""
+
+    def engine(self, *allowed):
+        return JobEngine(lambda document_bytes: None, callback_allowed_hosts=allowed)
+
+    def test_hosts(self):
+        engine = self.engine("hooks.example.com", "10.0.0.5:8080")
+        assert engine.callback_allowed("https://hooks.example.com/done")
+        assert engine.callback_allowed("http://HOOKS.example.com:9000/done")
+        assert engine.callback_allowed("http://10.0.0.5:8080/done")
+        assert not engine.callback_allowed("http://10.0.0.5:9090/done")
+        assert not engine.callback_allowed("https://hooks.example.com.evil.io/done")
+        assert not engine.callback_allowed("https://hooks.example.com@evil.io/done")
+
+    def test_prefixes(self):
+        engine = self.engine("https://internal.example.com/tax-hooks/")
+        assert engine.callback_allowed("https://internal.example.com/tax-hooks/job-done")
+        assert not engine.callback_allowed("http://internal.example.com/tax-hooks/job-done")
+        assert not engine.callback_allowed("https://internal.example.com/admin")
+        assert not engine.callback_allowed("https://internal.example.com.evil.io/tax-hooks/")
+
+    def test_prefix_ends_at_a_path_segment(self):
+        """A prefix allows its own path and the paths below it, not paths that only start with the same letters"""
+        engine = self.engine("https://hooks.example.com/tenant")
+        assert engine.callback_allowed("https://hooks.example.com/tenant")
+        assert engine.callback_allowed("https://hooks.example.com/tenant/job-done")
+        assert not engine.callback_allowed("https://hooks.example.com/tenant-evil/job-done")
+        assert not engine.callback_allowed("https://hooks.example.com/tenants")
+
+    def test_submit_and_delivery_check_the_allowlist(self):
+        """Direct submits are refused too, and a job queued before the list changed is not delivered"""
+        async def scenario():
+            engine = self.engine("hooks.example.com")
+            with pytest.raises(ValueError):
+                engine.submit(b"doc", callback_url="http://169.254.169.254/")
+            job, _ = engine.submit(b"doc", callback_url="https://hooks.example.com/done")
+            engine.callback_allowed_hosts = ()
+            await engine._send_callback(job, "https://hooks.example.com/done")
+            return job
+
+        job = asyncio.run(scenario())
+        assert job.callback_status == {"https://hooks.example.com/done": "error: not allowed"}
@@ -0,0 +1,121 @@
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.metrics import (DOCUMENTS, STAGE_SECONDS, VALIDATION_FAILURES, VLM_FALLBACKS, Counter, Histogram,
+                         RequestTimings, stage, start_request)
+from tests.conftest import load_fixture
+
+client = TestClient(app)
+
+
+class TestMetricTypes:
+    """Tests for the counter, histogram and stage timer primitives"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Each bucket counts every observation at or below its bound"""
+        histogram = Histogram("h", "help", buckets=(1.0, 2.0), label_names=("stage",))
+        for value in (0.5, 1.5, 1.5, 3.0):
+            histogram.observe(value, "a")
+        lines = histogram.render()
+
+        assert 'h_bucket{stage="a",le="1.0"} 1' in lines
+        assert 'h_bucket{stage="a",le="2.0"} 3' in lines
+        assert 'h_bucket{stage="a",le="+Inf"} 4' in lines
+        assert 'h_count{stage="a"} 4' in lines
+        assert 'h_sum{stage="a"} 6.5' in lines
+
+    def test_counter_renders_labels(self):
+        """Labelled counters render one sample per label set"""
+        counter = Counter("c_total", "help", label_names=("source",))
+        counter.inc("vlm")
+        counter.inc("vlm")
+        assert 'c_total{source="vlm"} 2' in counter.render()
+
+    def test_stage_times_into_current_request(self):
+        """Stages add up per request and show up in Server-Timing"""
+        timings = RequestTimings()
+        timings.add("textract", 0.25)
+        timings.add("textract", 0.25)
+        timings.add("key_matching", 0.001)
+        assert timings.server_timing() == "textract;dur=500.0, key_matching;dur=1.0"
+
+    def test_stage_without_request_still_observed(self):
+        """Batch and replay work is timed even with no request being tracked"""
+        before = STAGE_SECONDS.count("test_stage")
+        with stage("test_stage"):
+            pass
+        assert STAGE_SECONDS.count("test_stage") == before + 1
+
+    def test_stage_records_on_error(self):
+        """A stage that raises is still timed"""
+        timings = start_request()
+        try:
+            with stage("failing"):
+                raise ValueError
+        except ValueError:
+            pass
+        assert "failing" in timings.stages
+
+
+class TestMetricsEndpoint:
+    """Tests for /metrics and the Server-Timing header"""
+
+    @patch('app.textract_helper.boto3.client')
+    def test_upload_is_counted_and_timed(self, mock_boto_client, monkeypatch):
+        """A parse shows up in the source and validation counters and stage timings"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('sample_1040_invalid.json')
+        monkeypatch.setenv("SERVER_TIMING_ENABLED", "true")
+        # Keep the invalid totals as Textract read them, no VLM recheck
+        monkeypatch.setenv("VLM_RECHECK_INVALID", "false")
+        textract_before = DOCUMENTS.value("textract")
+        invalid_before = VALIDATION_FAILURES.value()
+
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"fake pdf content"), "application/pdf")}
+        )
+
+        stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+        assert stages == ["upload_read", "plan_pages", "text_layer", "textract", "ocr",
+                          "block_index", "key_matching", "spatial", "validation"]
+        assert DOCUMENTS.value("textract") == textract_before + 1
+        assert VALIDATION_FAILURES.value() == invalid_before + 1
+
+        body = client.get("/metrics").text
+        assert 'parse_stage_seconds_count{stage="textract"}' in body
+        assert "parse_request_seconds_bucket" in body
+        assert "parse_document_bytes_count" in body
+
+    @patch('app.main.extract_fields_with_vlm')
+    @patch('app.textract_helper.boto3.client')
+    def test_vlm_fallback_is_counted(self, mock_boto_client, mock_vlm):
+        """Falling back to the VLM increments the fallback counter"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = {"Blocks": []}
+        mock_vlm.return_value = {"line_9": 100.0, "line_10": 10.0, "line_11": 90.0, "line_14": 0.0}
+        before = VLM_FALLBACKS.value()
+
+        client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"fake pdf content"), "application/pdf")}
+        )
+
+        assert VLM_FALLBACKS.value() == before + 1
+        assert 'parse_stage_seconds_count{stage="vlm"}' in client.get("/metrics").text
+
+    @patch('app.textract_helper.boto3.client')
+    def test_server_timing_off_by_default(self, mock_boto_client, monkeypatch):
+        """No Server-Timing header unless it is switched on"""
+        mock_boto_client.return_value.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+        monkeypatch.delenv("SERVER_TIMING_ENABLED", raising=False)
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"fake pdf content"), "application/pdf")}
+        )
+        assert "server-timing" not in response.headers
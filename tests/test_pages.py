@@ -0,0 +1,76 @@
+import time
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.pages import classify_text, plan_pages
+from tests.conftest import load_fixture
+
+client = TestClient(app)
+
+EXAMPLE_PDF = Path(__file__).parent.parent / "example_documents" / "2024 Samuel Singletary.pdf"
+
+
+def schedule_1_response():
+    """Minimal Textract response for a Schedule 1 page with one key/value"""
+    return {"Blocks": [
+        {"BlockType": "LINE", "Id": "s1-line", "Text": "SCHEDULE 1 (Form 1040) 2024"},
+        {"BlockType": "KEY_VALUE_SET", "Id": "s1-key", "EntityTypes": ["KEY"],
+         "Relationships": [{"Type": "CHILD", "Ids": ["s1-word"]}, {"Type": "VALUE", "Ids": ["s1-value"]}]},
+        {"BlockType": "KEY_VALUE_SET", "Id": "s1-value", "EntityTypes": ["VALUE"],
+         "Relationships": [{"Type": "CHILD", "Ids": ["s1-amount"]}]},
+        {"BlockType": "WORD", "Id": "s1-word", "Text": "10 Combine lines 1 through 7 and 9 10"},
+        {"BlockType": "WORD", "Id": "s1-amount", "Text": "22,000."},
+    ]}
+
+
+class TestMultiPage:
+    """Tests for page classification and concurrent per-page OCR"""
+
+    def test_classify_text(self):
+        """Headers of common pages map to form types"""
+        assert classify_text("Form1040 2024U.S. Individual Income Tax Return") == "1040"
+        assert classify_text("Form 1040 (2024) Page 2\nTax and") == "1040"
+        assert classify_text("SCHEDULE 1 \n(Form 1040)\n2024") == "schedule_1"
+        assert classify_text("Schedule SE (Form 1040) 2024 Page 2") == "schedule_se"
+        assert classify_text("Form 8949\nDepartment of the Treasury") == "form_8949"
+        assert classify_text("") == "unknown"
+
+    def test_plan_pages_selects_relevant_forms(self):
+        """Only 1040 and the configured schedules are planned for OCR"""
+        planned = plan_pages(EXAMPLE_PDF.read_bytes())
+        assert planned == [(1, "1040"), (2, "1040"), (3, "schedule_1"), (4, "schedule_1"),
+                           (8, "schedule_a"), (9, "schedule_b")]
+
+    def test_single_page_documents_are_not_planned(self):
+        """Non-PDF uploads keep the single-call path"""
+        assert plan_pages(b"fake pdf content") is None
+
+    def test_pages_are_analyzed_concurrently_and_merged(self):
+        """Wall clock is close to one page, results are keyed by form and line"""
+        def fake_analyze_page(document_bytes, page_number, client=None):
+            time.sleep(0.3)
+            if page_number == 1:
+                return load_fixture('2024_samuel_singletary.json')
+            return schedule_1_response()
+
+        # Behave like a scanned return with no usable text layer
+        with patch("app.main.analyze_page", side_effect=fake_analyze_page), \
+                patch("app.main.text_layer_blocks", return_value=None):
+            start = time.perf_counter()
+            response = client.post(
+                "/parse-1040",
+                files={"file": ("return.pdf", BytesIO(EXAMPLE_PDF.read_bytes()), "application/pdf")}
+            )
+            elapsed_ocr = time.perf_counter() - start
+
+        data = response.json()
+        assert data['success'] is True
+        assert data['fields']['line_11'] == 270669.0
+        assert data['forms']['1040']['line_9'] == 280300.0
+        assert data['forms']['schedule_1']['line_10'] == 22000.0
+        # Six pages at 0.3s each would take 1.8s back to back
+        assert elapsed_ocr < 1.8
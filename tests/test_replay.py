@@ -0,0 +1,126 @@
+import gzip
+from io import BytesIO
+from unittest.mock import patch, MagicMock
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.replay import ResponseRecorder, load_response, replay_all, replay_path, replay_response
+from tests.conftest import FIXTURES, load_fixture
+
+client = TestClient(app)
+
+
+class TestReplay:
+    """Tests for replaying stored Textract responses"""
+
+    @patch('app.textract_helper.boto3.client')
+    def test_replay_matches_live_upload(self, mock_boto_client):
+        """Replaying a fixture gives exactly what the upload path returns"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_peter_and_paula_professor.json')
+
+        live = client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"fake pdf content"), "application/pdf")}
+        ).json()
+        replayed = replay_path(FIXTURES / "2024_peter_and_paula_professor.json")
+
+        assert replayed.model_dump() == live
+
+    def test_math_errors_survive_replay(self):
+        """Validation runs on replay exactly as it does live"""
+        response = replay_response(load_fixture('sample_1040_invalid.json'))
+        assert response.success is True
+        assert response.fields['is_valid'] is False
+
+    @patch('app.main.extract_fields_with_vlm')
+    def test_incomplete_response_fails_without_vlm(self, mock_vlm):
+        """Replay never calls the VLM, missing fields are reported as a failure"""
+        response = replay_response({"Blocks": []})
+        assert response.success is False
+        mock_vlm.assert_not_called()
+
+    def test_endpoint_accepts_plain_and_gzip(self):
+        """The replay endpoint takes .json and .json.gz uploads"""
+        raw = (FIXTURES / "2024_samuel_singletary.json").read_bytes()
+        for filename, payload in (("r.json", raw), ("r.json.gz", gzip.compress(raw))):
+            response = client.post(
+                "/parse-1040/replay",
+                files={"file": (filename, BytesIO(payload), "application/json")}
+            )
+            assert response.json()['fields']['line_11'] == 270669.0
+
+    def test_endpoint_rejects_invalid_json(self):
+        """Garbage uploads get an error response instead of a 500"""
+        response = client.post(
+            "/parse-1040/replay",
+            files={"file": ("r.json", BytesIO(b"{not json"), "application/json")}
+        )
+        assert response.json()['success'] is False
+        assert response.json()['error'].startswith("Invalid Textract response")
+
+
+    def test_gzip_bomb_is_rejected(self, monkeypatch):
+        """A small .json.gz that inflates past MAX_UPLOAD_BYTES is a 413, it is never fully decompressed"""
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", str(1024 * 1024))
+        bomb = gzip.compress(b'{"Blocks": [' + b" " * (64 * 1024 * 1024) + b"]}")
+        assert len(bomb) < 1024 * 1024
+        response = client.post(
+            "/parse-1040/replay",
+            files={"file": ("r.json.gz", BytesIO(bomb), "application/json")}
+        )
+        assert response.status_code == 413
+        assert "1048576 byte limit" in response.json()["detail"]
+
+    def test_oversized_upload_is_rejected(self, monkeypatch):
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        response = client.post(
+            "/parse-1040/replay",
+            files={"file": ("r.json", BytesIO(b'{"Blocks": []' + b" " * 5000 + b"}"), "application/json")}
+        )
+        assert response.status_code == 413
+
+    def test_truncated_gzip_is_invalid(self):
+        payload = gzip.compress((FIXTURES / "2024_samuel_singletary.json").read_bytes())[:-100]
+        response = client.post(
+            "/parse-1040/replay",
+            files={"file": ("r.json.gz", BytesIO(payload), "application/json")}
+        )
+        assert response.json()['success'] is False
+        assert response.json()['error'].startswith("Invalid Textract response")
+
+
+class TestRecorder:
+    """Tests for record mode"""
+
+    def test_recorded_response_round_trips(self, tmp_path):
+        """A recorded response is gzip on disk and replays to the same result"""
+        blocks = load_fixture('2024_samuel_singletary.json')['Blocks']
+        path = ResponseRecorder(str(tmp_path)).record("abcdef", blocks)
+
+        assert path == tmp_path / "ab" / "abcdef.json.gz"
+        assert path.read_bytes()[:2] == b"\x1f\x8b"
+        assert load_response(path)["Blocks"] == blocks
+        assert replay_path(path).fields["line_9"] == 280300.0
+
+    @patch('app.textract_helper.boto3.client')
+    def test_live_uploads_are_recorded(self, mock_boto_client, tmp_path):
+        """Every OCR'd upload lands in the record directory and replays identically"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        recorder = ResponseRecorder(str(tmp_path))
+        with patch("app.main.response_recorder", recorder):
+            live = client.post(
+                "/parse-1040",
+                files={"file": ("test_1040.pdf", BytesIO(b"recorded pdf"), "application/pdf")}
+            ).json()
+            stats = client.get("/replay/stats").json()
+
+        assert stats["recorded"] == 1
+        [(path, replayed)] = list(replay_all([tmp_path]))
+        assert path.name.endswith(".json.gz")
+        assert replayed.model_dump() == live
@@ -0,0 +1,99 @@
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from app import results
+from app.main import app
+from app.models import ParseResponse
+from app.pipeline import build_response, fields_from_blocks, parse_blocks
+from app.results import FormResult, ParseResult, Source, encode_result, form_result_type
+from app.routing import VlmRouter, merge_vlm_fields, plan_vlm
+from benchmarks.bench_serialization import cases
+from tests.conftest import load_fixture
+
+client = TestClient(app)
+
+
+def legacy_bytes(result):
+    """Bytes FastAPI wrote when endpoints returned a pydantic ParseResponse"""
+    return JSONResponse(jsonable_encoder(ParseResponse(**result.model_dump()))).body
+
+
+class TestByteCompatibility:
+    """The typed result encodes to exactly what clients already get"""
+
+    @pytest.mark.parametrize("name", sorted(cases()))
+    def test_parsed_documents(self, name):
+        dyn, forms = cases()[name]
+        result = build_response(dyn, forms)
+        assert encode_result(result) == legacy_bytes(result)
+
+    def test_errors_and_unicode(self):
+        for result in (ParseResult(success=False, error="Could not parse all required fields"),
+                       ParseResult(success=False, error='Textract error: "Bad" — página é\n\x01')):
+            assert encode_result(result) == legacy_bytes(result)
+
+    def test_stdlib_fallback_writes_the_same_bytes(self, monkeypatch):
+        result = parse_blocks(load_fixture('2024_peter_and_paula_professor.json')['Blocks'])
+        expected = encode_result(result)
+        monkeypatch.setattr(results, "orjson", None)
+        assert encode_result(result) == expected
+
+    @patch('app.textract_helper.boto3.client')
+    def test_endpoint_response(self, mock_boto_client):
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"results pdf"), "application/pdf")}
+        )
+
+        assert response.headers["content-type"] == "application/json"
+        assert response.content == legacy_bytes(ParseResult.from_dict(response.json()))
+        assert list(response.json()["fields"])[-2:] == ["source", "is_valid"]
+
+
+class TestTypedResult:
+    """Slotted per-form results with per-line provenance"""
+
+    def test_known_lines_are_slots(self):
+        result = parse_blocks(load_fixture('2024_samuel_singletary.json')['Blocks'])
+        form = result.form
+        assert type(form) is form_result_type("1040")
+        assert not hasattr(form, "__dict__")
+        assert form.line_11.value == 270669.0
+        assert form.source is Source.TEXTRACT and form.is_valid is True
+
+    def test_provenance_and_confidence(self):
+        """Key-matched lines carry Textract's confidence, defaults say so"""
+        blocks = load_fixture('2024_samuel_singletary.json')['Blocks']
+        form = parse_blocks(blocks).form
+        assert form.line_9.source is Source.TEXTRACT
+        assert 0 < form.line_9.confidence <= 100
+        assert form.line_13.source is Source.DEFAULT and form.line_13.confidence is None
+
+    def test_vlm_lines_are_marked(self):
+        blocks = [block for block in load_fixture('2024_samuel_singletary.json')["Blocks"]
+                  if block.get("Text") != "9,631."]
+        dyn, _ = fields_from_blocks(blocks)
+        plan = plan_vlm(dyn, blocks, VlmRouter(explore=0.0))
+        merge_vlm_fields(dyn, plan, {"line_10": 9631.0}, Source.TEXTRACT)
+
+        assert dyn.provenance["line_10"] == (Source.VLM, None)
+        assert dyn.provenance["line_9"][0] is Source.TEXTRACT
+        assert dyn.fields["source"] is Source.TEXTRACT_VLM
+
+    def test_unknown_lines_go_to_extra(self):
+        form = FormResult.from_fields("schedule_c", {"line_7": 16000.0})
+        assert form.extra["line_7"].value == 16000.0
+        assert form.to_fields() == {"line_7": 16000.0}
+
+    def test_cached_round_trip(self):
+        result = parse_blocks(load_fixture('2024_peter_and_paula_professor.json')['Blocks'])
+        assert ParseResult.from_dict(result.model_dump()).model_dump() == result.model_dump()
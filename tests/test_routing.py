@@ -0,0 +1,234 @@
+import io
+import random
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import routing
+from app.main import app
+from app.pipeline import fields_from_blocks, parse_blocks
+from app.routing import FULL_ROUTE, PARTIAL_ROUTE, VlmRouter, fields_to_ask, merge_vlm_fields, plan_vlm
+from app.vlm_helper import PROMPT_1040_LINES_9_TO_14, extract_fields_with_vlm, narrow_prompt
+from tests.conftest import load_fixture
+from tests.vlm_stub import StubVlmServer
+
+client = TestClient(app)
+
+
+def without_line_10(response):
+    """Textract response with the line 10 amount dropped, as if OCR missed it"""
+    blocks = [block for block in response["Blocks"] if block.get("Text") != "9,631."]
+    return {**response, "Blocks": blocks}
+
+
+def page_png(width=850, height=1100):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(output, format="PNG")
+    return output.getvalue()
+
+
+def fresh_router(**kwargs):
+    return VlmRouter(explore=0.0, rng=random.Random(0), **kwargs)
+
+
+class TestPlanning:
+    """Which lines the VLM is asked for, and where"""
+
+    def test_complete_valid_document_needs_no_vlm(self):
+        """Textract got everything and it adds up"""
+        blocks = load_fixture('2024_samuel_singletary.json')["Blocks"]
+        dyn, _ = fields_from_blocks(blocks)
+        assert plan_vlm(dyn, blocks, fresh_router()) is None
+
+    def test_missing_line_asks_only_for_that_line(self):
+        """A partial miss asks for the missing line, cropped to its rows"""
+        blocks = without_line_10(load_fixture('2024_samuel_singletary.json'))["Blocks"]
+        dyn, _ = fields_from_blocks(blocks)
+
+        plan = plan_vlm(dyn, blocks, fresh_router())
+
+        assert plan.fields == ("line_10",)
+        assert plan.route == PARTIAL_ROUTE
+        assert plan.route_key == "1040:2024:ocr"
+        left, top, width, height = plan.region
+        # Band around rows 9-11, well short of the whole page
+        assert (left, width) == (0.0, 1.0)
+        assert top < 0.83 < top + height and height < 0.2
+
+    def test_failed_check_asks_for_its_group(self):
+        """Invalid totals re-ask every line of the failed check"""
+        blocks = load_fixture('sample_1040_invalid.json')["Blocks"]
+        dyn, _ = fields_from_blocks(blocks)
+        assert set(fields_to_ask(dyn)) >= {"line_9", "line_10", "line_11"}
+        assert fields_to_ask(dyn, recheck_invalid=False) == ()
+
+    def test_nothing_read_goes_to_full_page(self):
+        """With no Textract lines at all there is nothing to narrow"""
+        dyn, _ = fields_from_blocks([])
+        plan = plan_vlm(dyn, [], fresh_router())
+        assert plan.route == FULL_ROUTE and plan.region is None
+        assert plan.fields == routing.VLM_FIELDS
+
+
+class TestMerge:
+    """Merging VLM answers into the Textract fields"""
+
+    def test_partial_merge_keeps_textract_lines(self):
+        """Only the missing line is taken from the VLM"""
+        blocks = without_line_10(load_fixture('2024_samuel_singletary.json'))["Blocks"]
+        dyn, _ = fields_from_blocks(blocks)
+        plan = plan_vlm(dyn, blocks, fresh_router())
+
+        # The VLM misreads line 9 too, but it was not asked for it
+        merge_vlm_fields(dyn, plan, {"line_9": 1.0, "line_10": 9631.0}, "textract")
+
+        assert dyn.fields["line_9"] == 280300.0
+        assert dyn.fields["line_10"] == 9631.0
+        assert dyn.fields["source"] == "textract+vlm"
+
+    def test_recheck_reverts_when_vlm_does_not_add_up(self):
+        """A failed check is only overwritten by values that pass it"""
+        blocks = load_fixture('sample_1040_invalid.json')["Blocks"]
+        dyn, _ = fields_from_blocks(blocks)
+        original = dict(dyn.fields)
+        plan = plan_vlm(dyn, blocks, fresh_router())
+
+        merge_vlm_fields(dyn, plan, {"line_9": 1.0, "line_10": 1.0, "line_11": 5.0}, "textract")
+
+        assert {name: dyn.fields[name] for name in ("line_9", "line_10", "line_11")} == \
+            {name: original[name] for name in ("line_9", "line_10", "line_11")}
+        assert dyn.fields["source"] == "textract"
+
+
+class TestVlmRouter:
+    """Route choice from recent outcomes"""
+
+    def test_starts_narrow(self):
+        assert fresh_router().choose("1040:2024:ocr") == PARTIAL_ROUTE
+
+    def test_unreliable_partial_gathers_full_samples(self):
+        """Once the narrowed route keeps failing, the whole page is tried"""
+        router = fresh_router(min_samples=3)
+        for _ in range(3):
+            router.record("k", PARTIAL_ROUTE, False, 100, 0.1)
+        assert router.choose("k") == FULL_ROUTE
+
+    def test_prefers_cheaper_route_at_equal_accuracy(self):
+        router = fresh_router(min_samples=3)
+        for _ in range(3):
+            router.record("k", PARTIAL_ROUTE, True, 300, 0.5)
+            router.record("k", FULL_ROUTE, True, 1200, 1.0)
+        assert router.choose("k") == PARTIAL_ROUTE
+
+    def test_prefers_accurate_route(self):
+        router = fresh_router(min_samples=3)
+        for success in (True, False, False):
+            router.record("k", PARTIAL_ROUTE, success, 300, 0.5)
+        for _ in range(3):
+            router.record("k", FULL_ROUTE, True, 1200, 1.0)
+        assert router.choose("k") == FULL_ROUTE
+
+    def test_routes_are_tracked_per_key(self):
+        router = fresh_router(min_samples=1)
+        router.record("1040:2023:ocr", PARTIAL_ROUTE, False, 300, 0.5)
+        assert router.choose("1040:2024:ocr") == PARTIAL_ROUTE
+        assert router.stats()["1040:2023:ocr"][PARTIAL_ROUTE]["success_rate"] == 0.0
+
+
+class TestNarrowPrompt:
+    """Prompts built from PROMPT_1040_LINES_9_TO_14"""
+
+    def test_all_lines_is_original_prompt(self):
+        assert narrow_prompt(routing.VLM_FIELDS) == PROMPT_1040_LINES_9_TO_14
+
+    def test_narrowed_prompt_only_mentions_requested_lines(self):
+        prompt = narrow_prompt(("line_10",), cropped=True)
+        assert "line_10." in prompt
+        assert "line_12" not in prompt and "line_14" not in prompt
+        assert prompt.splitlines()[-1] == '{"line_10": 5000.0}'
+        assert "cropped" in prompt
+        assert len(prompt) < len(PROMPT_1040_LINES_9_TO_14)
+
+
+class TestStubVlm:
+    """The real VLM client against the local stub server"""
+
+    def test_partial_request_is_narrow_and_cropped(self, monkeypatch):
+        """Only the requested line is asked for, on a cropped image"""
+        with StubVlmServer() as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            result = extract_fields_with_vlm(page_png(), ("line_10",), (0.0, 0.8, 1.0, 0.1))
+
+        assert result["line_10"] == 9631.0
+        assert "line_9" not in result
+        assert result["usage"] > 0
+        (request,) = stub.requests
+        image_url = request["messages"][0]["content"][1]["image_url"]["url"]
+        assert image_url.startswith("data:image/jpeg;base64,")
+
+    def test_partial_route_uses_fewer_tokens(self, monkeypatch):
+        with StubVlmServer() as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            full = extract_fields_with_vlm(page_png())
+            partial = extract_fields_with_vlm(page_png(), ("line_10",), (0.0, 0.8, 1.0, 0.1))
+        assert partial["usage"] < full["usage"]
+
+    def test_batch_pipeline_fills_missing_line(self, monkeypatch):
+        """parse_blocks asks the stub for line 10 only and keeps Textract's other lines"""
+        monkeypatch.setattr("app.pipeline.vlm_router", fresh_router())
+        blocks = without_line_10(load_fixture('2024_samuel_singletary.json'))["Blocks"]
+        with StubVlmServer(values={"line_9": 1.0, "line_10": 9631.0}) as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            result = parse_blocks(blocks, page_png(), extract_fields_with_vlm)
+
+        assert result.success is True
+        assert result.fields["line_9"] == 280300.0
+        assert result.fields["line_10"] == 9631.0
+        assert result.fields["source"] == "textract+vlm"
+        assert result.fields["is_valid"] is True
+
+    def test_unconfigured_vlm_raises(self, monkeypatch):
+        monkeypatch.delenv("VLM_BASE_URL", raising=False)
+        try:
+            extract_fields_with_vlm(page_png())
+        except RuntimeError as e:
+            assert "VLM_BASE_URL" in str(e)
+        else:
+            raise AssertionError("expected RuntimeError")
+
+
+class TestRoutingEndpoint:
+    """Per-field fallback through /parse-1040"""
+
+    @patch('app.main.extract_fields_with_vlm')
+    @patch('app.textract_helper.boto3.client')
+    def test_partial_miss_only_asks_for_missing_line(self, mock_boto_client, mock_vlm, monkeypatch):
+        """The VLM is called for line 10 alone and the outcome is recorded for routing"""
+        router = fresh_router()
+        monkeypatch.setattr("app.main.vlm_router", router)
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = without_line_10(load_fixture('2024_samuel_singletary.json'))
+        mock_vlm.return_value = {"line_10": 9631.0, "usage": 250}
+
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("partial_1040.pdf", BytesIO(b"partial miss content"), "application/pdf")}
+        )
+
+        data = response.json()
+        assert data["success"] is True
+        assert data["fields"]["line_10"] == 9631.0
+        assert data["fields"]["source"] == "textract+vlm"
+        _, fields, region = mock_vlm.call_args.args
+        assert fields == ("line_10",)
+        assert region is not None
+        stats = router.stats()["1040:2024:ocr"][PARTIAL_ROUTE]
+        assert stats["samples"] == 1 and stats["mean_tokens"] == 250
+
+    def test_routing_stats_endpoint(self):
+        response = client.get("/routing/stats")
+        assert response.status_code == 200
+        assert isinstance(response.json(), dict)
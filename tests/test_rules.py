@@ -0,0 +1,66 @@
+
+from app.pipeline import is_line_match, textract_to_dict
+from app.rules import COMPILED_1040_RULES, CompiledRules, FieldRule
+from tests.conftest import load_fixture
+
+
+def legacy_matches(key_text):
+    """The original parse_1040 if-chain conditions, in order"""
+    matched = []
+    if is_line_match(key_text, 9, "total", "income") or "9 add lines" in key_text:
+        matched.append("line_9")
+    if (is_line_match(key_text, 10, "adjustment")
+            or (key_text.endswith(' 10') and 'adjustment' in key_text)):
+        matched.append("line_10")
+    if (is_line_match(key_text, 11, "adjusted", "gross", "income")
+            or (is_line_match(key_text, 11) and 'subtract' in key_text)):
+        matched.append("line_11")
+    if is_line_match(key_text, 12, "deduction") and ("standard" in key_text or "itemized" in key_text):
+        matched.append("line_12")
+    if is_line_match(key_text, 13, "qualified", "deduction"):
+        matched.append("line_13")
+    if is_line_match(key_text, 14, "total", "deductions") or "14 add lines" in key_text:
+        matched.append("line_14")
+    return matched
+
+
+class TestCompiledRules:
+    """Tests for the precompiled field-rule engine"""
+
+    def test_matches_legacy_chain_on_fixtures(self):
+        """Every fixture key classifies exactly like the old if-chain"""
+        for fixture in ('2024_samuel_singletary.json', '2024_peter_and_paula_professor.json',
+                        'sample_1040_invalid.json'):
+            for key_text in textract_to_dict(load_fixture(fixture)['Blocks']):
+                compiled = [rule.field for rule in COMPILED_1040_RULES.match(key_text)]
+                assert compiled == legacy_matches(key_text), key_text
+
+    def test_matches_legacy_chain_on_edge_cases(self):
+        """Line numbers in the middle, substrings and phrases behave the same"""
+        keys = [
+            "see line 9 for total income",
+            "19 total income",
+            "9 add lines",
+            "total income 9",
+            "line 11 subtract",
+            "11subtract",
+            "12 itemized deduction",
+            "12 deduction",
+            "14 add lines 12 and 13 9 total income",
+            "",
+        ]
+        for key_text in keys:
+            compiled = [rule.field for rule in COMPILED_1040_RULES.match(key_text)]
+            assert compiled == legacy_matches(key_text), key_text
+
+    def test_table_order_wins(self):
+        """Rules are returned in table order regardless of how they matched"""
+        rules = CompiledRules((
+            FieldRule("first", 2, phrases=("shared",)),
+            FieldRule("second", 1, token_sets=(("shared",),)),
+        ))
+        assert [rule.field for rule in rules.match("1 shared")] == ["first", "second"]
+
+    def test_defaults_come_from_table(self):
+        """Only rules with a blank default are filled in after matching"""
+        assert COMPILED_1040_RULES.defaults == (("line_13", 0.0),)
@@ -0,0 +1,113 @@
+import math
+import random
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.pipeline import fields_from_blocks
+from app.spatial import AnchorTemplates, Box, SpatialIndex, extract_lines
+from benchmarks.bench_spatial import drop_forms, drop_line_keys, drop_line_number, shift
+from tests.conftest import load_fixture
+
+client = TestClient(app)
+
+
+def drop_row_label(blocks, line):
+    """Blocks without the row label on the left, e.g. "10 Adjustments to income..." """
+    return [block for block in blocks
+            if not (block.get("BlockType") == "LINE" and block.get("Text", "").startswith(f"{line} "))]
+
+
+class TestSpatialIndex:
+    """Grid nearest neighbour lookups"""
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(7)
+        boxes = [Box(str(i), x, y, x + 0.05, y + 0.01) for i in range(400)
+                 for x, y in [(rng.random(), rng.random())]]
+        index = SpatialIndex(boxes)
+
+        for _ in range(200):
+            x, y = rng.random(), rng.random()
+
+            def accept(box):
+                return int(box.text) % 5 == 0
+
+            expected = min((box for box in boxes if accept(box)),
+                           key=lambda box: math.hypot(box.center_x - x, box.center_y - y))
+            assert index.nearest(x, y, accept, max_distance=2.0) == expected
+
+    def test_nothing_within_distance(self):
+        index = SpatialIndex([Box("1", 0.9, 0.9, 0.95, 0.91)])
+        assert index.nearest(0.1, 0.1, max_distance=0.2) is None
+
+
+class TestExtractLines:
+    """Locating amount boxes by position"""
+
+    def test_locates_every_filled_line(self):
+        blocks = load_fixture('2024_peter_and_paula_professor.json')['Blocks']
+        assert extract_lines(blocks, templates=AnchorTemplates()) == {
+            "line_9": 234650.0, "line_10": 3738.0, "line_11": 230912.0,
+            "line_12": 42000.0, "line_13": 9832.0, "line_14": 51832.0,
+        }
+
+    def test_blank_row_is_not_filled_from_its_neighbours(self):
+        """Line 13 is empty on this return, the line 12 and 14 amounts are not borrowed"""
+        blocks = load_fixture('2024_samuel_singletary.json')['Blocks']
+        assert "line_13" not in extract_lines(blocks, templates=AnchorTemplates())
+
+    def test_template_locates_row_with_no_printed_anchors(self):
+        """With neither line number nor row label, only the learned template finds the row"""
+        blocks = load_fixture('2024_samuel_singletary.json')['Blocks']
+        unanchored = shift(drop_row_label(drop_line_number(blocks, 10), 10), 0.005)
+
+        assert "line_10" not in extract_lines(unanchored, templates=AnchorTemplates())
+
+        templates = AnchorTemplates()
+        extract_lines(blocks, templates=templates)
+        assert extract_lines(unanchored, templates=templates)["line_10"] == 9631.0
+        assert templates.stats()["1040:2024"]["pages"] == 2
+
+
+class TestGeometryFallback:
+    """Spatial matching in the parse pipeline"""
+
+    def test_missing_key_value_is_filled(self):
+        blocks = drop_line_keys(load_fixture('2024_samuel_singletary.json')['Blocks'], 10)
+        dyn, _ = fields_from_blocks(blocks)
+        assert dyn.fields["line_10"] == 9631.0
+
+    def test_disabled(self, monkeypatch):
+        monkeypatch.setenv("SPATIAL_MATCHING_ENABLED", "false")
+        blocks = drop_line_keys(load_fixture('2024_samuel_singletary.json')['Blocks'], 10)
+        dyn, _ = fields_from_blocks(blocks)
+        assert "line_10" not in dyn.fields
+
+    def test_defaulted_blank_is_corrected(self):
+        """Without FORMS output line 13 defaults to 0.0, the located amount makes line 14 add up"""
+        blocks = drop_forms(load_fixture('2024_peter_and_paula_professor.json')['Blocks'])
+        dyn, _ = fields_from_blocks(blocks)
+        assert dyn.fields["line_13"] == 9832.0
+
+    @patch('app.main.extract_fields_with_vlm')
+    @patch('app.textract_helper.boto3.client')
+    def test_no_forms_output_needs_no_vlm(self, mock_boto_client, mock_vlm):
+        """A response without key/values is parsed from geometry alone"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        response = load_fixture('2024_samuel_singletary.json')
+        mock_textract.analyze_document.return_value = {**response, "Blocks": drop_forms(response["Blocks"])}
+
+        result = client.post(
+            "/parse-1040",
+            files={"file": ("no_forms_1040.pdf", BytesIO(b"no forms content"), "application/pdf")}
+        ).json()
+
+        assert result["success"] is True
+        assert result["fields"]["line_11"] == 270669.0
+        assert result["fields"]["source"] == "textract"
+        assert result["fields"]["is_valid"] is True
+        mock_vlm.assert_not_called()
@@ -0,0 +1,82 @@
+import json
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from tests.conftest import load_fixture
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def run_python(code):
+    """Run code in a fresh interpreter, return its last line of output parsed as JSON"""
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+class TestLazyImports:
+    """Importing the app must not execute the heavy backends"""
+
+    def test_import_skips_heavy_backends(self):
+        """boto3, pypdf, pdf2image and httpx are only executed once something uses them"""
+        loaded = run_python(
+            "import json, sys\n"
+            "import app.main\n"
+            "print(json.dumps([m for m in ('botocore.client', 'pypdf._reader', 'PIL.Image', 'httpx._client')"
+            " if m in sys.modules]))"
+        )
+        assert loaded == []
+
+    def test_first_use_loads_module(self):
+        """Touching a lazily imported module runs its real import"""
+        loaded = run_python(
+            "import json, sys\n"
+            "from app.pages import pypdf\n"
+            "before = 'pypdf._reader' in sys.modules\n"
+            "pypdf.PdfReader\n"
+            "print(json.dumps([before, 'pypdf._reader' in sys.modules]))"
+        )
+        assert loaded == [False, True]
+
+
+class TestBackendInit:
+    """BACKEND_INIT decides when the Textract client is built"""
+
+    @patch('app.textract_helper.boto3.client')
+    def test_lazy_builds_client_on_first_request(self, mock_boto_client, monkeypatch):
+        """In lazy mode the shared client is built by the first OCR call and reused after"""
+        mock_textract = MagicMock()
+        mock_boto_client.return_value = mock_textract
+        mock_textract.analyze_document.return_value = load_fixture('2024_samuel_singletary.json')
+        monkeypatch.setenv("BACKEND_INIT", "lazy")
+
+        with TestClient(app) as client:
+            assert app.state.textract_client is None
+            for content in (b"lazy startup pdf 1", b"lazy startup pdf 2"):
+                response = client.post(
+                    "/parse-1040",
+                    files={"file": ("test_1040.pdf", BytesIO(content), "application/pdf")},
+                )
+                assert response.json()["fields"]["line_11"] == 270669.0
+            assert app.state.textract_client is mock_textract
+
+        assert mock_boto_client.call_count == 1
+
+    @patch('app.textract_helper.boto3.client')
+    def test_startup_builds_client_before_serving(self, mock_boto_client, monkeypatch):
+        """The default mode has the client ready when the lifespan starts"""
+        monkeypatch.delenv("BACKEND_INIT", raising=False)
+        with TestClient(app):
+            assert app.state.textract_client is mock_boto_client.return_value
+
+    def test_unknown_mode_fails_startup(self, monkeypatch):
+        monkeypatch.setenv("BACKEND_INIT", "eager")
+        with pytest.raises(ValueError, match="BACKEND_INIT"):
+            with TestClient(app):
+                pass
@@ -0,0 +1,61 @@
+from io import BytesIO
+from pathlib import Path
+from unittest.mock import patch
+
+import pypdf
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.pipeline import textract_to_dict
+from app.text_layer import page_key_values, text_layer_blocks
+
+client = TestClient(app)
+
+EXAMPLES = Path(__file__).parent.parent / "example_documents"
+
+
+class TestTextLayer:
+    """Tests for the text-layer fast path that skips OCR"""
+
+    def test_page_key_values_match_textract_keys(self):
+        """Text-layer keys come out normalized like Textract keys"""
+        reader = pypdf.PdfReader(EXAMPLES / "2024 Samuel Singletary.pdf")
+        _, pairs = page_key_values(reader.pages[0])
+        assert pairs['9 add lines 1z, 2b, 3b, 4b, 5b, 6b, 7, and 8. this is your total income 9'] == '280,300.'
+        assert pairs['11 subtract line 10 from line 9. this is your adjusted gross income 11'] == '270,669.'
+        # Blank line 13 is not reported with its own line number as the amount
+        assert not any(key.startswith('13 ') for key in pairs)
+
+    def test_blocks_round_trip_through_textract_to_dict(self):
+        """Synthetic blocks produce the same pairs via textract_to_dict"""
+        document_bytes = (EXAMPLES / "2024_Peter_and_Paula_Professor.pdf").read_bytes()
+        blocks = text_layer_blocks(document_bytes, [1])
+        textract_dict = textract_to_dict(blocks)
+        assert textract_dict['14 add lines 12 and 13 14'] == '51,832.'
+
+    def test_non_pdf_has_no_text_layer(self):
+        """Anything that is not a PDF goes to OCR"""
+        assert text_layer_blocks(b"fake pdf content", [1]) is None
+
+    @patch('app.textract_helper.boto3.client')
+    def test_fillable_return_skips_textract(self, mock_boto_client):
+        """An e-filed return is parsed without any Textract call"""
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("return.pdf", BytesIO((EXAMPLES / "2024_Peter_and_Paula_Professor.pdf").read_bytes()),
+                            "application/pdf")}
+        )
+
+        data = response.json()
+        assert data['success'] is True
+        fields = data['fields']
+        assert fields['line_9'] == 234650.0
+        assert fields['line_10'] == 3738.0
+        assert fields['line_11'] == 230912.0
+        assert fields['line_12'] == 42000.0
+        assert fields['line_13'] == 9832.0
+        assert fields['line_14'] == 51832.0
+        assert fields['is_valid'] is True
+        assert fields['source'] == 'text_layer'
+        mock_boto_client.assert_not_called()
+        assert client.get("/ingest/stats").json()['text_layer']['documents'] >= 1
@@ -0,0 +1,33 @@
+import io
+import json
+
+from app.pipeline import parse_blocks
+from app.textract_stream import stream_blocks
+from tests.conftest import FIXTURES
+
+
+class TestStreamingTextractParser:
+    """Streamed, trimmed blocks must parse exactly like the full response"""
+
+    def test_same_result_as_full_response(self):
+        """Identical parse_blocks result on every fixture"""
+        for path in sorted(FIXTURES.glob("*.json")):
+            with open(path) as f:
+                expected = parse_blocks(json.load(f)["Blocks"])
+            with open(path, "rb") as f:
+                streamed = parse_blocks(stream_blocks(f))
+            assert streamed.model_dump() == expected.model_dump(), path.name
+
+    def test_drops_what_is_never_read(self):
+        """PAGE and SELECTION_ELEMENT blocks are not kept, nor polygons"""
+        with open(FIXTURES / "2024_samuel_singletary.json") as f:
+            blocks = json.load(f)["Blocks"]
+        with open(FIXTURES / "2024_samuel_singletary.json", "rb") as f:
+            streamed = stream_blocks(f)
+        kept_types = {"LINE", "WORD", "KEY_VALUE_SET"}
+        assert len(streamed) == sum(1 for b in blocks if b["BlockType"] in kept_types)
+        assert all(set(block.get("Geometry", {})) <= {"BoundingBox"} for block in streamed)
+
+    def test_missing_blocks_key(self):
+        """A response without Blocks streams no blocks"""
+        assert stream_blocks(io.BytesIO(b'{"DocumentMetadata": {"Pages": 1}}')) == []
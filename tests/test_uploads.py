@@ -0,0 +1,175 @@
+import asyncio
+import inspect
+import json
+import mmap
+import subprocess
+import sys
+from io import BytesIO
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from unittest.mock import patch
+
+import pytest
+from fastapi import UploadFile
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+
+from app.documents import BufferReader, map_path
+from app.main import UPLOAD_LIMITS, app
+from app.text_layer import text_layer_blocks
+from app.textract_helper import render_page
+from app.uploads import upload_view
+from benchmarks.bench_upload_memory import multipart_parts, padded_pdf, post
+
+ROOT = Path(__file__).resolve().parent.parent
+EXAMPLE_PDF = ROOT / "example_documents" / "2024_Peter_and_Paula_Professor.pdf"
+
+client = TestClient(app)
+
+
+def spooled_upload(content, max_size):
+    spool = SpooledTemporaryFile(max_size=max_size)
+    spool.write(content)
+    spool.seek(0)
+    return UploadFile(file=spool, filename="scan.pdf")
+
+
+class TestUploadLimits:
+    """MAX_UPLOAD_BYTES rejects oversized uploads before they are parsed"""
+
+    @patch('app.textract_helper.boto3.client')
+    def test_content_length_over_limit_is_rejected(self, mock_boto_client, monkeypatch):
+        """A declared size over the limit gets a 413 without the body being read"""
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        response = client.post(
+            "/parse-1040",
+            files={"file": ("test_1040.pdf", BytesIO(b"%PDF" + b"0" * 5000), "application/pdf")},
+        )
+        assert response.status_code == 413
+        assert "1000 byte limit" in response.json()["detail"]
+        mock_boto_client.assert_not_called()
+
+    def test_chunked_body_cut_off_at_limit(self, monkeypatch):
+        """Without Content-Length the body is counted as it streams in"""
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", str(256 * 1024))
+        response = asyncio.run(post(app, multipart_parts(padded_pdf(1024 * 1024), 0)))
+        assert response["status"] == 413
+
+    def test_batch_limit_is_per_file(self, monkeypatch):
+        """One oversized file fails on its own, the batch still runs"""
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        response = client.post(
+            "/parse-1040/batch",
+            files=[("files", ("big.pdf", BytesIO(b"%PDF" + b"0" * 5000), "application/pdf"))],
+        )
+        (line,) = response.text.splitlines()
+        assert "1000 byte limit" in json.loads(line)["error"]
+
+
+    def test_every_upload_route_is_limited(self):
+        """A new route taking an UploadFile has to be added to UPLOAD_LIMITS"""
+        upload_routes = {route.path for route in app.routes if isinstance(route, APIRoute)
+                         and any("UploadFile" in str(parameter.annotation)
+                                 for parameter in inspect.signature(route.endpoint).parameters.values())}
+        assert upload_routes == set(UPLOAD_LIMITS)
+
+    @pytest.mark.parametrize("path", ["/parse-1040/jobs", "/parse-1040/replay"])
+    def test_single_document_routes_are_limited(self, path, monkeypatch):
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        response = client.post(path, files={"file": ("big.pdf", BytesIO(b"%PDF" + b"0" * 5000), "application/pdf")})
+        assert response.status_code == 413
+        assert "1000 byte limit" in response.json()["detail"]
+
+    def test_batch_request_is_limited_as_a_whole(self, monkeypatch):
+        """Files each under MAX_UPLOAD_BYTES still add up to MAX_BATCH_UPLOAD_BYTES at most"""
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        monkeypatch.setenv("MAX_BATCH_UPLOAD_BYTES", "3000")
+        response = client.post(
+            "/parse-1040/batch",
+            files=[("files", (f"doc_{i}.pdf", BytesIO(b"%PDF" + b"0" * 900), "application/pdf")) for i in range(5)],
+        )
+        assert response.status_code == 413
+        assert "3000 byte limit" in response.json()["detail"]
+
+    def test_oversized_manifest_is_rejected(self, monkeypatch):
+        monkeypatch.setenv("MAX_UPLOAD_BYTES", "1000")
+        response = client.post(
+            "/parse-1040/batch",
+            files={"manifest": ("manifest.json", BytesIO(json.dumps(["a.pdf"] * 500).encode()), "application/json")},
+        )
+        assert response.json()["success"] is False
+        assert "1000 byte limit" in response.json()["error"]
+
+
+class TestZeroCopy:
+    """Uploads and batch files are shared as views, not read into new bytes"""
+
+    def test_large_upload_is_mapped(self):
+        """Past the spool size the view maps the temp file and outlives it"""
+        content = b"%PDF" + bytes(range(256)) * 64
+        upload = spooled_upload(content, max_size=1024)
+        view = asyncio.run(upload_view(upload))
+        upload.file.close()
+
+        assert isinstance(view.obj, mmap.mmap)
+        assert view == content
+
+    def test_small_upload_stays_in_memory(self):
+        view = asyncio.run(upload_view(spooled_upload(b"%PDF small", max_size=1024)))
+        assert isinstance(view.obj, bytes)
+        assert view == b"%PDF small"
+
+    def test_pypdf_reads_mapped_file(self):
+        """The text layer parses straight from the mapped pages"""
+        blocks = text_layer_blocks(map_path(EXAMPLE_PDF), [1])
+        assert blocks
+
+    def test_buffer_reader_seeks_like_bytesio(self):
+        data = bytes(range(100))
+        reader, expected = BufferReader(memoryview(data)), BytesIO(data)
+        for stream in (reader, expected):
+            stream.seek(-10, 2)
+        assert reader.read(4) == expected.read(4)
+        assert reader.tell() == expected.tell() == 94
+        reader.seek(0)
+        assert reader.read() == data
+
+    @patch('app.textract_helper.pdf2image.convert_from_bytes')
+    def test_render_reads_poppler_output(self, mock_convert, monkeypatch):
+        """JPEG comes from poppler's file as is, quality steps down while too large"""
+        qualities = []
+
+        def convert(document, output_folder, jpegopt=None, **kwargs):
+            qualities.append(jpegopt["quality"])
+            path = Path(output_folder) / "page.jpg"
+            path.write_bytes(b"\xff\xd8" + b"0" * (3000 if jpegopt["quality"] > 70 else 500))
+            return [str(path)]
+
+        mock_convert.side_effect = convert
+        monkeypatch.setenv("TEXTRACT_MAX_IMAGE_BYTES", "1000")
+
+        image = render_page(memoryview(b"%PDF"), 1)
+
+        assert qualities == [95, 80, 65]
+        assert len(image) == 502
+
+
+@pytest.mark.skipif(not Path("/proc/self/status").exists(), reason="reads RssAnon from /proc")
+class TestUploadMemory:
+    """Peak memory per request under concurrent large uploads"""
+
+    def run_profile(self, *args):
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_upload_memory", "--size-mb", "8", "--concurrency", "6", *args],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout
+        return json.loads(out.strip().splitlines()[-1])
+
+    def test_peak_rss_per_request_is_a_fraction_of_the_upload(self):
+        """Mapped uploads cost each request far less heap than the document size, copies cost all of it"""
+        shared = self.run_profile()
+        copying = self.run_profile("--copying")
+
+        assert shared["all_parsed"] and copying["all_parsed"]
+        assert shared["per_request_fraction_of_upload"] < 0.25
+        assert copying["per_request_fraction_of_upload"] > 0.75
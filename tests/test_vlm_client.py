@@ -0,0 +1,319 @@
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from app.backends import BackendPool
+from app.cache import MemoryTier
+from app.main import extract_fields
+from app.routing import VlmRouter
+from app.vlm_client import (MicroBatcher, TokenBudget, VlmBudgetExceededError, VlmClient, VlmReplyError, VlmRequest,
+                            image_tokens, is_vlm_failure, parse_reply)
+from app.vlm_helper import batch_prompt, page_image
+from tests.conftest import load_fixture
+from tests.vlm_stub import DEFAULT_VALUES, StubVlmServer, batch_keys, requested_keys
+
+
+def page_png(width=850, height=1100, color="white"):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(output, format="PNG")
+    return output.getvalue()
+
+
+def reply(content):
+    return {"choices": [{"message": {"content": content}}]}
+
+
+def fresh_client(**kwargs):
+    return VlmClient(cache=MemoryTier(100, 100 * 1024, 0), **kwargs)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPageImage:
+    """Only as many pixels as the model will look at"""
+
+    def test_large_page_is_shrunk(self, monkeypatch):
+        monkeypatch.setenv("VLM_MAX_IMAGE_SIDE", "1024")
+        image, size = page_image(page_png(2550, 3300))
+        assert size == (791, 1024)
+        assert Image.open(io.BytesIO(image)).size == size
+        assert bytes(image[:2]) == b"\xff\xd8"
+
+    def test_small_page_is_sent_as_is(self):
+        original = page_png(600, 776)
+        image, size = page_image(original)
+        assert image is original and size == (600, 776)
+
+    def test_crop_costs_fewer_tokens(self):
+        _, full = page_image(page_png(1275, 1650))
+        _, band = page_image(page_png(1275, 1650), (0.0, 0.5, 1.0, 0.1))
+        assert band == (1024, 133)
+        assert image_tokens(band) < image_tokens(full) == 765
+
+
+class TestReplyValidation:
+    """Whatever the model sends is read here, without asking again"""
+
+    def test_fenced_json_and_quoted_amounts(self):
+        (lines,) = parse_reply(reply('```json\n{"line_9": "85,000.00", "line_10": "$5,000", "line_11": 80000}\n```'),
+                               [("line_9", "line_10", "line_11")])
+        assert lines == {"line_9": 85000.0, "line_10": 5000.0, "line_11": 80000.0}
+
+    def test_lines_that_are_not_numbers_are_left_out(self):
+        (lines,) = parse_reply(reply('{"line_9": "about 85k", "line_10": true, "line_11": null, "line_12": 1.5,'
+                                     ' "line_99": 3}'), [("line_9", "line_10", "line_11", "line_12")])
+        assert lines == {"line_12": 1.5}
+
+    def test_unreadable_replies_raise(self):
+        for body in (reply("I cannot read this form."), reply("[1, 2]"), {"choices": []}):
+            with pytest.raises(VlmReplyError):
+                parse_reply(body, [("line_9",)])
+        (error,) = parse_reply(reply('{"error": "unreadable"}'), [("line_9",)])
+        assert isinstance(error, VlmReplyError)
+
+    def test_malformed_reply_is_not_retried(self, monkeypatch):
+        """One round trip, the pool only retries overload"""
+        with StubVlmServer(reply="Sure! Here are the values you asked for.") as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            client = fresh_client()
+            pool = BackendPool("vlm", max_concurrency=2, timeout_seconds=5, max_attempts=3)
+            with pytest.raises(VlmReplyError):
+                asyncio.run(pool.run(client.extract, page_png(), ("line_9",)))
+            pool.shutdown()
+
+        assert len(stub.requests) == 1
+        assert client.stats()["reply_errors"] == 1
+        assert pool.breaker.consecutive_failures == 0
+
+
+class TestResponseCache:
+    """Same image, same question: one call"""
+
+    def test_repeat_question_is_answered_from_cache(self, monkeypatch):
+        with StubVlmServer() as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            client = fresh_client()
+            first = client.extract(page_png(), ("line_10",), (0.0, 0.8, 1.0, 0.1))
+            second = client.extract(page_png(), ("line_10",), (0.0, 0.8, 1.0, 0.1))
+            client.extract(page_png(), ("line_9", "line_10"))
+
+        assert {**second, "usage": first["usage"]} == first and first["usage"] > 0
+        # Nothing was spent on the cached answer, the router must not count its tokens again
+        assert second["usage"] == 0
+        assert len(stub.requests) == 2
+        assert client.stats()["cache_hits"] == 1
+
+    def test_other_endpoint_is_another_question(self, monkeypatch):
+        client = fresh_client()
+        for values in ({"line_9": 1.0}, {"line_9": 2.0}):
+            with StubVlmServer(values=values) as stub:
+                monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+                assert client.extract(page_png(), ("line_9",))["line_9"] == values["line_9"]
+
+    def test_incomplete_reply_is_not_cached(self, monkeypatch):
+        with StubVlmServer(values={"line_9": 1.0}) as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            client = fresh_client()
+            for _ in range(2):
+                assert "line_10" not in client.extract(page_png(), ("line_9", "line_10"))
+        assert len(stub.requests) == 2
+
+
+class TestBudget:
+    """Per-minute token and cost caps"""
+
+    def test_window_slides(self):
+        clock = FakeClock()
+        budget = TokenBudget(tokens_per_minute=1000, clock=clock)
+        budget.reserve(600, 0)
+        with pytest.raises(VlmBudgetExceededError):
+            budget.reserve(500, 0)
+        clock.now = 60.0
+        budget.reserve(500, 0)
+        assert budget.stats() == {"budget_tokens": 500, "budget_cost": 0.0, "budget_rejections": 1}
+
+    def test_settles_to_reported_usage(self):
+        budget = TokenBudget(cost_per_minute=0.01, input_cost_per_1k=0.005, output_cost_per_1k=0.015)
+        spend = budget.reserve(1500, 100)
+        budget.settle(spend, 800, 20)
+        budget.release(budget.reserve(500, 0))
+        assert budget.stats()["budget_tokens"] == 820
+        assert budget.stats()["budget_cost"] == pytest.approx(0.0043)
+
+    def test_over_budget_keeps_textract_lines(self, monkeypatch):
+        """The VLM is not called, the result is what Textract read, nothing is held against the route"""
+        blocks = load_fixture('2024_samuel_singletary.json')["Blocks"]
+        for block in blocks:
+            if block.get("Text") == "270,669.":
+                block["Text"] = "270,000."
+        client = fresh_client(budget=TokenBudget(tokens_per_minute=10))
+        router = VlmRouter(explore=0.0)
+        monkeypatch.setattr("app.vlm_client._client", client)
+        monkeypatch.setattr("app.main.vlm_router", router)
+        with StubVlmServer() as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            pool = BackendPool("vlm", max_concurrency=2, timeout_seconds=5, max_attempts=3)
+            result = asyncio.run(extract_fields(blocks, page_png(), pool))
+            pool.shutdown()
+
+        assert stub.requests == []
+        assert result.fields["line_11"] == 270000.0
+        assert result.fields["source"] == "textract" and result.fields["is_valid"] is False
+        assert client.stats()["budget_rejections"] == 1
+        assert router.stats() == {}
+        assert pool.breaker.consecutive_failures == 0
+
+
+class TestRouteOutcomes:
+    """Only the VLM's own failures count against a route"""
+
+    def invalid_blocks(self):
+        blocks = load_fixture('2024_samuel_singletary.json')["Blocks"]
+        for block in blocks:
+            if block.get("Text") == "270,669.":
+                block["Text"] = "270,000."
+        return blocks
+
+    def test_classification(self):
+        class HTTPStatusError(Exception):
+            def __init__(self, status_code):
+                super().__init__(f"HTTP {status_code}")
+                self.response = type("Response", (), {"status_code": status_code})()
+
+        for failure in (VlmReplyError("no JSON"), ConnectionError("refused"), HTTPStatusError(429),
+                        HTTPStatusError(400)):
+            assert is_vlm_failure(failure), failure
+        for not_failure in (RuntimeError("VLM not configured"), OSError("cannot identify image file"),
+                            KeyError("line_9")):
+            assert not is_vlm_failure(not_failure), not_failure
+
+    def test_missing_configuration_is_not_recorded(self, monkeypatch):
+        """No VLM_BASE_URL: Textract's lines are kept and the route is not blamed"""
+        monkeypatch.delenv("VLM_BASE_URL", raising=False)
+        router = VlmRouter(explore=0.0)
+        monkeypatch.setattr("app.vlm_client._client", fresh_client())
+        monkeypatch.setattr("app.main.vlm_router", router)
+        pool = BackendPool("vlm", max_concurrency=2, timeout_seconds=5, max_attempts=1)
+        result = asyncio.run(extract_fields(self.invalid_blocks(), page_png(), pool))
+        pool.shutdown()
+
+        assert result.fields["source"] == "textract"
+        assert router.stats() == {}
+
+    def test_unreadable_reply_is_recorded(self, monkeypatch):
+        router = VlmRouter(explore=0.0)
+        monkeypatch.setattr("app.vlm_client._client", fresh_client())
+        monkeypatch.setattr("app.main.vlm_router", router)
+        with StubVlmServer(reply="I cannot read this form.") as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            pool = BackendPool("vlm", max_concurrency=2, timeout_seconds=5, max_attempts=1)
+            result = asyncio.run(extract_fields(self.invalid_blocks(), page_png(), pool))
+            pool.shutdown()
+
+        assert result.fields["source"] == "textract"
+        (routes,) = router.stats().values()
+        assert [summary["success_rate"] for summary in routes.values()] == [0.0]
+
+
+class TestBatching:
+    """Documents arriving together share one request"""
+
+    def test_batch_prompt_lists_each_document(self):
+        prompt = batch_prompt([(("line_10",), True), (("line_9", "line_11"), False)])
+        assert requested_keys(prompt) == ["document_1", "document_2"]
+        assert batch_keys(prompt) == {"document_1": ["line_10"], "document_2": ["line_9", "line_11"]}
+        assert "line_12" not in prompt
+
+    def test_concurrent_documents_share_a_request(self, monkeypatch):
+        # Small enough to be sent as they are, so the stub sees the same bytes
+        images = {color: page_png(600, 776, color) for color in ("white", "gray", "black")}
+        image_values = {image: {"line_9": float(n), "line_10": float(n * 10)}
+                        for n, image in enumerate(images.values(), start=1)}
+        with StubVlmServer(image_values=image_values) as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            client = fresh_client(max_batch_documents=3, batch_wait_seconds=2.0)
+            results = {}
+
+            def extract(color, fields):
+                results[color] = client.extract(images[color], fields)
+
+            threads = [threading.Thread(target=extract, args=(color, fields))
+                       for color, fields in (("white", ("line_9",)), ("gray", ("line_10",)),
+                                             ("black", ("line_9", "line_10")))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        (request,) = stub.requests
+        assert len(request["messages"][0]["content"]) == 4
+        assert {color: {k: v for k, v in lines.items() if k != "usage"} for color, lines in results.items()} == {
+            "white": {"line_9": 1.0}, "gray": {"line_10": 20.0}, "black": {"line_9": 3.0, "line_10": 30.0}}
+        assert len({lines["usage"] for lines in results.values()}) == 1
+        assert client.stats()["batches"] == 1 and client.stats()["batched_documents"] == 3
+
+    def test_batch_is_capped_at_pool_concurrency(self, monkeypatch):
+        """Every waiting document holds a pool slot, so a batch fills at the pool's size instead of timing out"""
+        monkeypatch.setenv("VLM_BATCH_MAX_DOCUMENTS", "8")
+        monkeypatch.setenv("VLM_BATCH_WAIT_MS", "2000")
+        monkeypatch.setenv("VLM_MAX_CONCURRENCY", "3")
+        images = [page_png(600, 776, color) for color in ("white", "gray", "black")]
+        with StubVlmServer() as stub:
+            monkeypatch.setenv("VLM_BASE_URL", stub.base_url)
+            client = VlmClient.from_env()
+            pool = BackendPool.from_env("vlm")
+
+            async def burst():
+                return await asyncio.gather(*[pool.run(client.extract, image, ("line_9",)) for image in images])
+
+            start = time.monotonic()
+            results = asyncio.run(burst())
+            elapsed = time.monotonic() - start
+            pool.shutdown()
+
+        assert client.batcher.max_documents == pool.max_concurrency == 3
+        assert [lines["line_9"] for lines in results] == [DEFAULT_VALUES["line_9"]] * 3
+        assert len(stub.requests) == 1
+        assert elapsed < 1.5
+
+    def test_one_bad_document_does_not_fail_the_batch(self):
+        batcher = MicroBatcher(lambda requests: [{"line_9": 1.0}, VlmReplyError("unreadable")], max_documents=2,
+                               wait_seconds=2.0)
+        outcomes = []
+
+        def submit(n):
+            try:
+                outcomes.append(batcher.submit(VlmRequest(b"page %d" % n, ("line_9",), "prompt")))
+            except VlmReplyError as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=submit, args=(n,)) for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(type(outcome).__name__ for outcome in outcomes) == ["VlmReplyError", "dict"]
+
+    def test_slow_batches_are_skipped_under_the_slo(self):
+        """Once batched calls are slower than the SLO allows, documents go alone and do not wait"""
+        sent = []
+        batcher = MicroBatcher(lambda requests: sent.append(len(requests)) or [dict(DEFAULT_VALUES)] * len(requests),
+                               max_documents=2, wait_seconds=0.5, latency_slo_seconds=1.0)
+        batcher._latency[2] = (0.9, time.monotonic() - MicroBatcher.SAMPLE_TTL_SECONDS)
+        assert batcher.expected_seconds(2) is None
+        batcher._latency[2] = (0.9, time.monotonic())
+
+        batcher.submit(VlmRequest(b"page", ("line_9",), "prompt"))
+
+        assert sent == [1]
+        assert batcher.stats()["batch_slo_bypasses"] == 1
@@ -0,0 +1,50 @@
+"""
+Local stand-in for the boto3 Textract client that can be overloaded
+
+Answers analyze_document with a fixed response after latency_seconds. Past
+capacity concurrent calls it raises botocore's ClientError with
+ThrottlingException, during an outage ServiceUnavailableException for every call.
+Counts calls, throttles and the highest concurrency it actually served.
+Shared by the tests and the benchmarks; with the defaults it is a plain stub
+that answers every call.
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+
+def client_error(code: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, "AnalyzeDocument")
+
+
+class OverloadedTextract:
+    def __init__(self, response: Dict[str, Any], capacity: Optional[int] = None, latency_seconds: float = 0.0):
+        self.response = response
+        self.capacity = capacity
+        self.latency_seconds = latency_seconds
+        self.outage = False
+        self.calls = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+    def analyze_document(self, Document, FeatureTypes):
+        with self.lock:
+            self.calls += 1
+            if self.outage:
+                raise client_error("ServiceUnavailableException")
+            if self.capacity is not None and self.in_flight >= self.capacity:
+                self.throttled += 1
+                raise client_error("ThrottlingException")
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds)
+            return self.response
+        finally:
+            with self.lock:
+                self.in_flight -= 1
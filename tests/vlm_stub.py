@@ -0,0 +1,144 @@
+"""
+Local stand-in for an OpenAI-compatible VLM server
+
+Answers /chat/completions with configured line values, only for the keys the
+prompt asks for, and reports token usage proportional to the prompt and image
+size so narrowed requests are visibly cheaper. Every request is kept for assertions.
+Batched prompts (several images, keys per "document_<n>") get an object per
+document, from image_values for that image's bytes when given. Overload can be
+injected: added latency, HTTP 429 past a number of concurrent requests, or a
+fixed error status (e.g. 503) for every request. reply replaces the message
+content, e.g. to send malformed JSON.
+
+Run with: python -m tests.vlm_stub [PORT]
+then point VLM_BASE_URL at http://127.0.0.1:PORT
+"""
+import base64
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+KEYS_HEADER = "Return ONLY a compact JSON object with keys:"
+BATCH_DOCUMENTS_HEADER = "Each value is a JSON object for that document's image, with keys:"
+
+DEFAULT_VALUES = {"line_9": 280300.0, "line_10": 9631.0, "line_11": 270669.0,
+                  "line_12": 27800.0, "line_13": 0.0, "line_14": 27800.0}
+
+
+def requested_keys(prompt: str) -> List[str]:
+    """Keys listed on the line after KEYS_HEADER"""
+    lines = prompt.splitlines()
+    keys_line = lines[lines.index(KEYS_HEADER) + 1]
+    return [key.strip() for key in keys_line.rstrip(".").split(",")]
+
+
+def batch_keys(prompt: str) -> Dict[str, List[str]]:
+    """{"document_1": [keys], ...} listed under BATCH_DOCUMENTS_HEADER"""
+    lines = prompt.splitlines()
+    keys = {}
+    for line in lines[lines.index(BATCH_DOCUMENTS_HEADER) + 1:]:
+        if not line.startswith("document_"):
+            break
+        name, keys_line = line.split(":", 1)
+        keys[name] = [key.strip() for key in keys_line.strip().rstrip(".").split(",")]
+    return keys
+
+
+class StubVlmServer:
+    """Threaded HTTP server, use as a context manager"""
+
+    def __init__(self, values: Optional[Dict[str, Any]] = None, port: int = 0, latency_seconds: float = 0.0,
+                 capacity: Optional[int] = None, error_status: Optional[int] = None,
+                 image_values: Optional[Dict[bytes, Dict[str, Any]]] = None, reply: Optional[str] = None):
+        self.values = dict(DEFAULT_VALUES if values is None else values)
+        self.image_values = image_values or {}
+        self.reply = reply
+        self.requests: List[Dict[str, Any]] = []
+        self.latency_seconds = latency_seconds
+        self.capacity = capacity
+        self.error_status = error_status
+        self.in_flight = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub.lock:
+                    stub.requests.append(body)
+                    status = stub.error_status
+                    if status is None and stub.capacity is not None and stub.in_flight >= stub.capacity:
+                        status = 429
+                    if status is not None:
+                        stub.rejected += 1
+                    else:
+                        stub.in_flight += 1
+                if status is not None:
+                    self._reply({"error": {"message": "overloaded"}}, status)
+                    return
+                try:
+                    time.sleep(stub.latency_seconds)
+                    self._reply(stub.complete(body))
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+            def _reply(self, payload, status=200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def answer(self, keys: List[str], image_bytes: bytes) -> Dict[str, Any]:
+        values = self.image_values.get(image_bytes, self.values)
+        return {key: values[key] for key in keys if key in values}
+
+    def complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        content = body["messages"][0]["content"]
+        prompt = next(part["text"] for part in content if part["type"] == "text")
+        images = [base64.b64decode(part["image_url"]["url"].split(",", 1)[1])
+                  for part in content if part["type"] == "image_url"]
+        if BATCH_DOCUMENTS_HEADER in prompt:
+            answer = {name: self.answer(keys, image_bytes)
+                      for (name, keys), image_bytes in zip(batch_keys(prompt).items(), images)}
+        else:
+            answer = self.answer(requested_keys(prompt), images[0])
+        reply = json.dumps(answer) if self.reply is None else self.reply
+        # Roughly 4 characters per text token, one token per 750 image bytes
+        prompt_tokens = len(prompt) // 4 + sum(len(image_bytes) for image_bytes in images) // 750
+        completion_tokens = len(reply) // 4
+        return {
+            "choices": [{"message": {"role": "assistant", "content": reply}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def __enter__(self) -> "StubVlmServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    with StubVlmServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8100) as stub:
+        print(f"Stub VLM listening on {stub.base_url}")
+        stub.thread.join()